@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Concurrency stress test: handler threads and dispatcher run concurrently
+on behalf of one tenant, telegram client is stubbed (outgoing messages are
+only recorded), so no network access is made.
+
+    Measured: throughput and latency of handlers, wait and hold times of
+shared locks (vocabulary cache, connection pool, outbound queue)
+and SQLite busy retries ("database is locked") of bot and sessions
+databases. After the run shared state is checked for lost updates:
+    - every question added by dispatcher is removed by exactly one handler
+      (answer or reveal) or is still pending
+    - concurrent /start registers user only once
+    - cached vocabularies match database (i.e. vocabulary read before
+      concurrent upload is not cached after upload invalidated it)
+    - statistics rollups match answer events
+Every run is made in fresh process, runs with growing number of handler
+threads show how far threading model scales.
+
+Usage: python3 benchmarks/concurrency.py [threads,...] [seconds]
+"""
+
+
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sqlite3
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter, defaultdict
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+USERS = 50
+NEW_USERS = 20
+WORDS_PER_USER = 30
+# users getting questions on every simulated dispatcher tick
+USERS_PER_TICK = 10
+TICK_DELAY = 0.01
+DISPATCHER_DELAY = 0.05
+
+# operation: weight
+OPERATIONS = {
+    'answer': 30,
+    'wrong_answer': 10,
+    'reveal_last': 15,
+    'reveal_button': 15,
+    'upload': 10,
+    'show_words': 10,
+    'start': 10,
+}
+
+# questions added by dispatcher are unique, so every one can be tracked
+MARKER = re.compile(r't\d{6}')
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+class InstrumentedLock:
+    """Lock (or RLock) wrapper recording wait and hold times"""
+
+    def __init__(self, lock, name: str):
+        self.lock = lock
+        self.name = name
+        self.contended = 0
+        self.waits = []
+        self.holds = []
+        self._owner = None
+        self._depth = 0
+        self._acquired_at = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        started = time.perf_counter()
+        if not self.lock.acquire(False):
+            if not blocking or not self.lock.acquire(True, timeout):
+                return False
+            self.contended += 1
+        # reentrant acquisitions are neither waited for nor held separately
+        if self._owner == threading.get_ident():
+            self._depth += 1
+            return True
+        self._acquired_at = time.perf_counter()
+        self._owner, self._depth = threading.get_ident(), 1
+        self.waits.append(self._acquired_at - started)
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if not self._depth:
+            self.holds.append(time.perf_counter() - self._acquired_at)
+            self._owner = None
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def metrics(self) -> dict:
+        return {'acquired': len(self.waits),
+                'contended': self.contended,
+                'wait_p99': _percentile(self.waits, 99),
+                'wait_max': max(self.waits, default=0),
+                'hold_p99': _percentile(self.holds, 99),
+                'hold_max': max(self.holds, default=0)}
+
+
+# SQLite waits for locked database inside of the library, so connections
+# are opened with zero timeout and busy statements are retried here (until
+# original timeout expires) to make every retry visible
+_connect = sqlite3.connect
+_sqlite_stats = defaultdict(Counter)
+_sqlite_stats_lock = threading.Lock()
+# full-text index reports locked database as failure of its constructor
+_BUSY_ERRORS = ('database is locked', 'vtable constructor failed')
+
+
+def _retrying(conn, func, *args):
+    started = time.perf_counter()
+    delay = 0.001
+    retries = 0
+    while True:
+        try:
+            res = func(*args)
+            break
+        except sqlite3.OperationalError as e:
+            waited = time.perf_counter() - started
+            if not str(e).startswith(_BUSY_ERRORS) or \
+                    waited >= conn.busy_timeout:
+                with _sqlite_stats_lock:
+                    _sqlite_stats[conn.label]['errors'] += 1
+                raise
+            retries += 1
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+    with _sqlite_stats_lock:
+        stats = _sqlite_stats[conn.label]
+        stats['statements'] += 1
+        if retries:
+            waited = time.perf_counter() - started
+            stats['busy_statements'] += 1
+            stats['retries'] += retries
+            stats['busy_wait'] += waited
+            stats['busy_wait_max'] = max(stats['busy_wait_max'], waited)
+    return res
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+
+    def execute(self, *args):
+        return _retrying(self.connection, super().execute, *args)
+
+    def executemany(self, *args):
+        return _retrying(self.connection, super().executemany, *args)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        return _retrying(self, super().commit)
+
+
+def _instrumented_connect(path, timeout=5.0, **kwargs):
+    conn = _connect(path, timeout=0, factory=InstrumentedConnection,
+                    **kwargs)
+    conn.busy_timeout = timeout
+    conn.label = os.path.basename(path)
+    return conn
+
+
+class StubBot:
+    """Telegram client stub, outgoing messages are recorded"""
+
+    def __init__(self):
+        self.sent = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            self.sent[chat_id].append(text)
+
+    def answer_callback_query(self, *args, **kwargs):
+        pass
+
+
+def _message(uid, text):
+    return types.SimpleNamespace(content_type='text', text=text,
+                                 chat=types.SimpleNamespace(id=uid))
+
+
+def _callback_query(uid, data):
+    return types.SimpleNamespace(id='0', data=data,
+                                 message=_message(uid, None))
+
+
+class StressTest:
+    """One run: fixture, workload and checks"""
+
+    def __init__(self, threads: int, seconds: float, directory: str):
+        # sqlite3.connect is looked up on every call, so all connections
+        # made from now on are instrumented
+        sqlite3.connect = _instrumented_connect
+        from telegram_language_bot import bot
+        from telegram_language_bot.tenants import Tenant
+        self.bot = bot
+        self.threads = threads
+        self.seconds = seconds
+        self.db_path = os.path.join(directory, 'bot.db')
+        self.tenant = Tenant('stress', 'stress', self.db_path,
+                             os.path.join(directory, 'sessions.db'))
+        self.client = self.tenant.bot = StubBot()
+        self.users = list(range(1, USERS + 1))
+        self.new_users = list(range(USERS + 1, USERS + NEW_USERS + 1))
+        self.markers = ('q{:06}'.format(i) for i in itertools.count())
+        self.added = []
+        self.latencies = []
+        self.errors = Counter()
+        self.lock = threading.Lock()
+        self.locks = []
+
+    def _instrument(self, owner, attr, name):
+        lock = InstrumentedLock(getattr(owner, attr), name)
+        setattr(owner, attr, lock)
+        self.locks.append(lock)
+
+    def setup(self):
+        from language_bot_core import DBManager, vocabulary_cache
+        from language_bot_core import dbmanager
+        from language_bot_core.schedule import make_rule
+        from telegram_language_bot.outbound import OutboundScheduler
+        from telegram_language_bot.sessions import ANSWER
+        from telegram_language_bot.constants import OUTBOUND_LANES, \
+            OUTBOUND_WORKERS
+        db = DBManager(self.db_path)
+        db.connect()
+        for uid in self.users:
+            db.register(uid)
+            db.add_words(uid, [('word{}'.format(i), 'слово{}'.format(i))
+                               for i in range(WORDS_PER_USER)])
+            # real dispatcher fires every minute
+            db.add_schedule_rule(uid, make_rule('00:00', '23:59:59', 1))
+        db.disconnect()
+        for uid in self.users:
+            self.tenant.sessions.set_mode(uid, ANSWER)
+        self.tenant.registered_users.update(self.users)
+        self.tenant.warmed_up.set()
+        # messages are not rate limited, so queues are drained after run
+        lanes = [(lane, 1e9, 1e9) for lane, _, _ in OUTBOUND_LANES]
+        self.bot.outbound = OutboundScheduler(self.bot._call, lanes, 1e9,
+                                              OUTBOUND_WORKERS)
+        self.bot.outbound.cond = threading.Condition(
+            InstrumentedLock(threading.Lock(), 'outbound'))
+        self.locks.append(self.bot.outbound.cond._lock)
+        # questions are never dropped to fit pending limit, so each one is
+        # either pending or removed by handler
+        self.bot.MAX_PENDING_QUESTIONS = sys.maxsize
+        self._instrument(vocabulary_cache, '_lock', 'vocabulary_cache')
+        self._instrument(dbmanager.connection_pool, '_lock',
+                         'connection_pool')
+
+    # operations (run on behalf of tenant)
+
+    def _pending_marker(self, uid, rng):
+        pending = [pair for pair in self.tenant.sessions.get(uid).pending
+                   if MARKER.fullmatch(pair[1])]
+        return rng.choice(pending) if pending else None
+
+    def answer(self, rng):
+        uid = rng.choice(self.users)
+        pair = self._pending_marker(uid, rng)
+        self.bot.message_router.dispatch(
+            _message(uid, pair[1] if pair else '???'))
+
+    def wrong_answer(self, rng):
+        self.bot.message_router.dispatch(
+            _message(rng.choice(self.users), '???'))
+
+    def reveal_last(self, rng):
+        self.bot.message_router.dispatch(
+            _message(rng.choice(self.users), '/reveal_last'))
+
+    def reveal_button(self, rng):
+        from telegram_language_bot.delivery import question_key, \
+            REVEAL_PREFIX
+        uid = rng.choice(self.users)
+        pair = self._pending_marker(uid, rng)
+        if pair is not None:
+            self.bot.reveal_button_handler(_callback_query(
+                uid, REVEAL_PREFIX + question_key(pair)))
+
+    def upload(self, rng):
+        uid = rng.choice(self.users)
+        word = ''.join(rng.choice(string.ascii_lowercase) for _ in range(8))
+        self.bot.message_router.dispatch(_message(uid, '/add_words'))
+        self.bot.message_router.dispatch(_message(uid, word + ' слово'))
+
+    def show_words(self, rng):
+        self.bot.message_router.dispatch(
+            _message(rng.choice(self.users), '/show_words'))
+
+    def start(self, rng):
+        self.bot.message_router.dispatch(
+            _message(rng.choice(self.new_users), '/start'))
+
+    # workload
+
+    def _record_error(self, e):
+        with self.lock:
+            self.errors['{}: {}'.format(type(e).__name__, e)] += 1
+
+    def _handlers(self, deadline, seed):
+        rng = random.Random(seed)
+        names, weights = zip(*OPERATIONS.items())
+        latencies = []
+        while time.monotonic() < deadline:
+            operation = getattr(self, rng.choices(names, weights)[0])
+            started = time.perf_counter()
+            try:
+                self.tenant.run(operation, rng)
+            except Exception as e:
+                self._record_error(e)
+            latencies.append(time.perf_counter() - started)
+        with self.lock:
+            self.latencies.extend(latencies)
+
+    def _ticks(self, deadline, seed):
+        """Dispatcher ticks, every one asks a few users a new question"""
+        from language_bot_core import DBManager, \
+            build_random_word_lists_by_uids
+        rng = random.Random(seed)
+        db = DBManager(self.db_path)
+        while time.monotonic() < deadline:
+            uids = rng.sample(self.users, USERS_PER_TICK)
+            try:
+                db.connect()
+                try:
+                    words = build_random_word_lists_by_uids(
+                        db, dict.fromkeys(uids, 1))
+                finally:
+                    db.disconnect()
+                added = []
+                for uid in uids:
+                    marker = next(self.markers)
+                    added.append((uid, (marker, 't' + marker[1:])))
+                    words.setdefault(uid, []).append(added[-1][1])
+                self.tenant.run(self.bot.callback, list(words), words)
+                self.added.extend(added)
+            except Exception as e:
+                self._record_error(e)
+            time.sleep(TICK_DELAY)
+
+    def _dispatcher(self):
+        from language_bot_core import dispatch_mainloop
+        try:
+            dispatch_mainloop(self.db_path, DISPATCHER_DELAY,
+                              self.tenant.bind(self.bot.callback))
+        except Exception as e:
+            self._record_error(e)
+
+    def run(self):
+        self.bot.outbound.start()
+        threading.Thread(target=self._dispatcher, daemon=True).start()
+        deadline = time.monotonic() + self.seconds
+        workers = [threading.Thread(target=self._handlers,
+                                    args=(deadline, i))
+                   for i in range(self.threads)]
+        workers.append(threading.Thread(target=self._ticks,
+                                        args=(deadline, -1)))
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        while any(lane['enqueued'] != lane['sent'] + lane['failed']
+                  for lane in self.bot.outbound.metrics().values()):
+            time.sleep(0.01)
+        self.bot.outbound.stop()
+        return elapsed
+
+    # checks
+
+    def _removed_questions(self, conn) -> Counter:
+        from language_bot_core.dbmanager import ANSWER_EVENT
+        removed = Counter()
+        for uid, word_from, word_to in conn.execute(
+                "select user_id, word_from, word_to from answer_events "
+                "where kind = ? and correct = 1", (ANSWER_EVENT, )):
+            if MARKER.fullmatch(word_to):
+                removed[uid, (word_from, word_to)] += 1
+        with self.client.lock:
+            sent = dict(self.client.sent)
+        for uid, texts in sent.items():
+            for text in texts:
+                # replies of reveal button ("word - translation") and
+                # /reveal_last (translation)
+                pair = tuple(text.split(' - ')) if ' - ' in text \
+                    else ('q' + text[1:], text)
+                if MARKER.fullmatch(pair[1]) and \
+                        pair[0] == 'q' + pair[1][1:]:
+                    removed[uid, pair] += 1
+        return removed
+
+    def check(self) -> dict:
+        from language_bot_core import DBManager, vocabulary_cache
+        from language_bot_core.dbmanager import ANSWER_EVENT
+        from telegram_language_bot.constants import GREETING_MSG
+        conn = _connect(self.db_path)
+        removed = self._removed_questions(conn)
+        handled = Counter()
+        for uid in self.users:
+            for pair in self.tenant.sessions.get(uid).pending:
+                if MARKER.fullmatch(pair[1]):
+                    handled[uid, pair] += 1
+        handled.update(removed)
+        anomalies = {
+            'lost_questions': sum(1 for key in self.added
+                                  if not handled[key]),
+            'doubly_handled_questions': sum(1 for key in self.added
+                                            if handled[key] > 1),
+        }
+        anomalies['duplicate_registrations'] = conn.execute(
+            "select count(*) from (select user_id from user_ids group by "
+            "user_id having count(*) > 1)").fetchone()[0]
+        anomalies['duplicate_greetings'] = sum(
+            1 for uid in self.new_users
+            if self.client.sent[uid].count(GREETING_MSG) > 1)
+        anomalies['rollup_mismatches'] = conn.execute(
+            "select count(*) from user_stats s where answers != (select "
+            "count(*) from answer_events e where e.user_id = s.user_id "
+            "and kind = ?)", (ANSWER_EVENT, )).fetchone()[0]
+        conn.close()
+        db = DBManager(self.db_path)
+        db.connect()
+        anomalies['stale_cached_vocabularies'] = sum(
+            1 for uid in self.users
+            if (self.db_path, uid) in vocabulary_cache and
+            list(vocabulary_cache.get((self.db_path, uid))) !=
+            list(db.get_all_words_by_uid(uid)))
+        db.disconnect()
+        return anomalies
+
+
+def run_child(threads: int, seconds: float):
+    """
+    Runs test in current directory (bot.db has to be copy of source.db),
+    prints results as JSON
+    """
+    logging.disable(logging.CRITICAL)
+    test = StressTest(threads, seconds, os.getcwd())
+    test.setup()
+    elapsed = test.run()
+    anomalies = test.check()
+    print(json.dumps({
+        'operations': len(test.latencies),
+        'elapsed': elapsed,
+        'latency_p50': _percentile(test.latencies, 50),
+        'latency_p99': _percentile(test.latencies, 99),
+        'questions': len(test.added),
+        'errors': test.errors,
+        'locks': {lock.name: lock.metrics() for lock in test.locks},
+        'sqlite': _sqlite_stats,
+        'anomalies': anomalies,
+    }))
+
+
+def _report(threads, res):
+    print("{} handler threads: {} operations, {:.0f} ops/s, latency p50 "
+          "{:.1f} ms, p99 {:.1f} ms, {} questions".format(
+              threads, res['operations'],
+              res['operations'] / res['elapsed'],
+              1000 * res['latency_p50'], 1000 * res['latency_p99'],
+              res['questions']))
+    print("  {:<18} {:>9} {:>9} {:>12} {:>12} {:>12} {:>12}".format(
+        'lock', 'acquired', 'contended', 'wait p99 ms', 'wait max ms',
+        'hold p99 ms', 'hold max ms'))
+    for name, m in res['locks'].items():
+        print("  {:<18} {:>9} {:>9} {:>12.3f} {:>12.3f} {:>12.3f} "
+              "{:>12.3f}".format(name, m['acquired'], m['contended'],
+                                 1000 * m['wait_p99'], 1000 * m['wait_max'],
+                                 1000 * m['hold_p99'], 1000 * m['hold_max']))
+    for name, m in res['sqlite'].items():
+        print("  sqlite {}: {} statements, {} busy ({} retries, {:.1f} ms "
+              "total wait, {:.1f} ms max), {} locked errors".format(
+                  name, m.get('statements', 0), m.get('busy_statements', 0),
+                  m.get('retries', 0), 1000 * m.get('busy_wait', 0),
+                  1000 * m.get('busy_wait_max', 0), m.get('errors', 0)))
+    for error, count in res['errors'].items():
+        print("  error x{}: {}".format(count, error))
+    print("  " + ", ".join("{} {}".format(name.replace('_', ' '), count)
+                           for name, count in res['anomalies'].items()))
+
+
+def main(thread_counts, seconds):
+    for threads in thread_counts:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy(os.path.join(ROOT, 'source.db'),
+                        os.path.join(tmp_dir, 'bot.db'))
+            env = dict(os.environ, PYTHONPATH=ROOT)
+            out = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--child',
+                 str(threads), str(seconds)], cwd=tmp_dir, env=env)
+        finally:
+            shutil.rmtree(tmp_dir)
+        _report(threads, json.loads(out.decode()))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        run_child(int(sys.argv[2]), float(sys.argv[3]))
+    else:
+        main([int(n) for n in sys.argv[1].split(',')]
+             if len(sys.argv) > 1 else [1, 2, 4, 8],
+             float(sys.argv[2]) if len(sys.argv) > 2 else 3)
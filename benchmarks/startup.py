@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Startup time benchmark: import time of bot package and time from process
+start to the first handled update (no network access: update is fed to bot
+directly and outgoing messages are only enqueued).
+
+Usage: python3 benchmarks/startup.py [repeats]
+"""
+
+
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UID = 123456
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import telegram_language_bot
+print(time.perf_counter() - start)
+"""
+
+FIRST_UPDATE_SCRIPT = """
+import time
+start = time.perf_counter()
+from telegram_language_bot import bot as b
+from threading import Thread
+import telebot as tb
+Thread(target=b._initialize_variables, daemon=True).start()
+update = tb.types.Update.de_json({{
+    'update_id': 1,
+    'message': {{'message_id': 1, 'date': 0, 'text': '/info',
+                 'chat': {{'id': {uid}, 'type': 'private'}},
+                 'entities': [{{'type': 'bot_command', 'offset': 0,
+                                'length': 5}}]}}}})
+b.get_bot().process_new_updates([update])
+while not b.outbound.metrics()['interactive']['enqueued']:
+    time.sleep(0.0005)
+print(time.perf_counter() - start)
+b.get_bot().stop_bot()
+"""
+
+
+def _run(script, cwd):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    out = subprocess.check_output([sys.executable, '-c', script],
+                                  cwd=cwd, env=env)
+    return float(out.decode().split()[0])
+
+
+def main(repeats):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(tmp_dir, 'source.db')
+        shutil.copy(os.path.join(ROOT, 'source.db'), db_path)
+        conn = sqlite3.connect(db_path)
+        conn.execute("insert into user_ids values (?)", (UID,))
+        conn.commit()
+        conn.close()
+
+        results = {
+            'import telegram_language_bot':
+                [_run(IMPORT_SCRIPT, tmp_dir) for _ in range(repeats)],
+            'start to first handled update':
+                [_run(FIRST_UPDATE_SCRIPT.format(uid=UID), tmp_dir)
+                 for _ in range(repeats)],
+        }
+    finally:
+        shutil.rmtree(tmp_dir)
+    for name, timings in results.items():
+        print("{:<32} median {:7.1f} ms   min {:7.1f} ms".format(
+            name, 1000 * statistics.median(timings), 1000 * min(timings)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -4,8 +4,13 @@
 
 from .parser import parse
 from .dbmanager import DBManager
-from .dispatcher import dispatch_mainloop, build_random_words_by_uids
+from .dispatcher import dispatch_mainloop, multi_dispatch_mainloop, \
+    build_random_words_by_uids, build_random_word_lists_by_uids
+from .cache import vocabulary_cache
+from . import memory_backend    # registers 'memory' storage backend
 
 
 __all__ = ['parse', 'DBManager', 'dispatch_mainloop',
-           'build_random_words_by_uids']
+           'multi_dispatch_mainloop',
+           'build_random_words_by_uids', 'build_random_word_lists_by_uids',
+           'vocabulary_cache']
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Online backups of SQLite database.
+
+    Database is copied by VACUUM INTO in one read transaction, so copy is
+consistent and concurrent writes do not restart it (as they restart
+stepwise copy of SQLite backup API, which may then never finish on busy
+database). Writers wait while copy is made, copy which takes too long is
+aborted. Copy is compressed into '<name>-<timestamp>.db.gz' file, only
+BACKUP_RETENTION newest backups are kept. Restoring checks integrity of
+backup before it replaces database (bot has to be stopped).
+
+Command line usage:
+    python -m language_bot_core.backup backup <database> <directory>
+    python -m language_bot_core.backup restore <backup.db.gz> <database>
+"""
+
+
+import argparse
+import datetime
+import gzip
+import os
+import shutil
+import logging
+import sqlite3
+import time
+from threading import Event
+
+from .constants import BACKUP_DIR, BACKUP_INTERVAL, BACKUP_RETENTION, \
+    BACKUP_TIMEOUT
+from .dbmanager import connection_pool
+from .logs import get_logger, log_event, DB_ERROR
+
+
+logger = get_logger('backup')
+
+# log event category
+BACKUP = 'backup'
+
+SUFFIX = '.db.gz'
+
+# number of SQLite virtual machine instructions between timeout checks
+_PROGRESS_STEPS = 10000
+
+
+class BackupError(Exception):
+    pass
+
+
+def _prefix(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0] + '-'
+
+
+def list_backups(path: str, directory: str) -> list:
+    """
+    :param path: database path
+    :param directory: backups directory
+    :return: backups of given database, oldest first
+    """
+    if not os.path.isdir(directory):
+        return []
+    prefix = _prefix(path)
+    return sorted(os.path.join(directory, name)
+                  for name in os.listdir(directory)
+                  if name.startswith(prefix) and name.endswith(SUFFIX))
+
+
+def backup_database(path: str, directory: str,
+                    retention: int = BACKUP_RETENTION,
+                    timeout: float = BACKUP_TIMEOUT) -> str:
+    """
+    Makes compressed snapshot of live database and removes old backups
+
+    :param path: database path
+    :param directory: backups directory
+    :param retention: number of newest backups kept
+    :param timeout: max seconds snapshot may take
+    :return: path of new backup
+    :raise BackupError: if snapshot took longer than timeout
+    """
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    target = os.path.join(directory, _prefix(path) + stamp + SUFFIX)
+    copy_path = target + '.tmp'
+    try:
+        src = sqlite3.connect(path)
+        deadline = time.monotonic() + timeout
+        src.set_progress_handler(lambda: time.monotonic() > deadline,
+                                 _PROGRESS_STEPS)
+        try:
+            src.execute("vacuum into ?", (copy_path,))
+        except sqlite3.OperationalError as e:
+            if time.monotonic() > deadline:
+                raise BackupError("Backup took longer than {} seconds"
+                                  .format(timeout))
+            raise
+        finally:
+            src.close()
+        with open(copy_path, 'rb') as f_in, \
+                gzip.open(target + '.part', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.replace(target + '.part', target)
+    finally:
+        # failed backup leaves no partial files
+        for leftover in (copy_path, target + '.part'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    for old in list_backups(path, directory)[:-retention]:
+        os.remove(old)
+    return target
+
+
+def verify_database(path: str) -> None:
+    """
+    :param path: database path
+    :raise BackupError: if database is corrupted
+    """
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute("pragma integrity_check").fetchone()[0]
+        tables = {row[0] for row in conn.execute(
+            "select name from sqlite_master where type = 'table'")}
+    except sqlite3.DatabaseError as e:
+        raise BackupError("Backup is not a valid database: {}".format(e))
+    finally:
+        conn.close()
+    if result != 'ok':
+        raise BackupError("Integrity check failed: {}".format(result))
+    if 'user_ids' not in tables:
+        raise BackupError("Backup does not contain bot tables")
+
+
+def restore_database(backup_path: str, path: str) -> None:
+    """
+    Decompresses and verifies backup, then atomically replaces database
+    with it. Bot must not be running.
+
+    :param backup_path: backup file
+    :param path: database path
+    :raise BackupError: if backup is corrupted (database is left intact)
+    """
+    restored = path + '.restore'
+    try:
+        try:
+            with gzip.open(backup_path, 'rb') as f_in, \
+                    open(restored, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        except (OSError, EOFError) as e:
+            raise BackupError("Backup can not be read: {}".format(e))
+        verify_database(restored)
+    except BackupError:
+        if os.path.exists(restored):
+            os.remove(restored)
+        raise
+    # pooled connections would keep reading replaced file
+    connection_pool.clear(path)
+    # stale rollback journal would be applied to restored database
+    for suffix in ('-journal', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.replace(restored, path)
+
+
+def backup_mainloop(path, directory: str = BACKUP_DIR,
+                    interval: float = BACKUP_INTERVAL, stop: Event = None):
+    """
+    mainloop of periodic backups, intended to be target of Thread. Failed
+    backup is logged and retried after interval.
+
+    :param path: database path or list of paths (backups of all databases
+                 are kept in one directory, so their file names have to
+                 differ)
+    :param directory: backups directory
+    :param interval: seconds between backups of each database
+    :param stop: backups are stopped once event is set
+    :return:
+    """
+    stop = stop or Event()
+    paths = [path] if isinstance(path, str) else list(path)
+    # time of the last failed backup of each database
+    failed = {}
+    while not stop.is_set():
+        # time left until the next backup of each database
+        left = dict.fromkeys(paths, 0)
+        for p in paths:
+            backups = list_backups(p, directory)
+            last = failed.get(p, 0)
+            if backups:
+                last = max(last, os.path.getmtime(backups[-1]))
+            if last:
+                left[p] = interval - (time.time() - last)
+        due = [p for p in paths if left[p] <= 0]
+        if not due:
+            stop.wait(min(left.values()))
+            continue
+        for p in due:
+            started = time.perf_counter()
+            try:
+                target = backup_database(p, directory)
+            except (sqlite3.Error, OSError, BackupError) as e:
+                failed[p] = time.time()
+                log_event(logger, DB_ERROR, logging.ERROR, exc_info=e,
+                          where='backup', path=p, error=repr(e))
+                continue
+            log_event(logger, BACKUP, path=target,
+                      size=os.path.getsize(target),
+                      duration_ms=round((time.perf_counter() - started)
+                                        * 1000, 3))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bot database backups")
+    commands = parser.add_subparsers(dest='command', required=True)
+    make = commands.add_parser('backup', help="make backup of database")
+    make.add_argument('database')
+    make.add_argument('directory', nargs='?', default=BACKUP_DIR)
+    restore = commands.add_parser('restore', help="verify backup and "
+                                                  "restore database from it")
+    restore.add_argument('backup')
+    restore.add_argument('database')
+    args = parser.parse_args()
+    try:
+        if args.command == 'backup':
+            print(backup_database(args.database, args.directory))
+        else:
+            restore_database(args.backup, args.database)
+            print("Restored {} from {}".format(args.database, args.backup))
+    except BackupError as e:
+        parser.exit(1, "Error: {}\n".format(e))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+import random
+import sys
+from array import array
+from collections import OrderedDict
+from threading import RLock
+
+from .constants import VOCABULARY_CACHE_BUDGET
+
+
+class PackedWords:
+    """
+    Immutable compact representation of user's (word_from, word_to) pairs.
+
+        All words are encoded into one utf-8 buffer, i-th word occupies
+    buffer[offsets[i]:offsets[i + 1]], pairs are stored as two consequent
+    words. Comparing to list of tuples of str it costs one object per user
+    instead of three objects per pair.
+    """
+
+    __slots__ = ('buffer', 'offsets', '__weakref__')
+
+    def __init__(self, pairs):
+        chunks = []
+        offsets = array('L', [0])
+        pos = 0
+        for pair in pairs:
+            for word in pair:
+                encoded = word.encode('utf-8')
+                chunks.append(encoded)
+                pos += len(encoded)
+                offsets.append(pos)
+        self.buffer = b''.join(chunks)
+        self.offsets = offsets
+
+    def _word(self, i):
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def __len__(self):
+        return (len(self.offsets) - 1) // 2
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError('word index out of range')
+        i %= len(self)
+        return self._word(2 * i), self._word(2 * i + 1)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self.buffer) + sys.getsizeof(self.offsets) + \
+               sys.getsizeof(self)
+
+    def random_pair(self):
+        if not len(self):
+            return None
+        return self[random.randrange(len(self))]
+
+
+class VocabularyCache:
+    """
+    Thread-safe LRU cache of users vocabularies
+    {(database path, uid): PackedWords} bounded by total memory budget
+    (one process may serve several databases with overlapping user ids)
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # key: number of invalidations, vocabulary read from database is
+        # cached only if key was not invalidated while it was read (clear
+        # invalidates all keys at once by bumping epoch)
+        self._generations = {}
+        self._epoch = 0
+        self._lock = RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key: tuple):
+        """
+        :param key: (database path, user id)
+        :return: cached PackedWords or None if user is not cached
+        """
+        with self._lock:
+            words = self._data.get(key, None)
+            if words is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return words
+
+    def generation(self, key: tuple) -> tuple:
+        with self._lock:
+            return self._epoch, self._generations.get(key, 0)
+
+    def put(self, key: tuple, words: PackedWords,
+            generation: tuple = None) -> None:
+        """
+        :param key: (database path, user id)
+        :param words: vocabulary
+        :param generation: value of generation(key) taken before words were
+                           read, words are not cached if key was invalidated
+                           since then
+        :return: None
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation(key):
+                return
+            self._discard(key)
+            if words.nbytes > self.budget:
+                return
+            self._data[key] = words
+            self.size += words.nbytes
+            while self.size > self.budget:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    def load(self, db, uid: int) -> PackedWords:
+        """
+        Retrieves user's vocabulary, querying database only on cache miss
+
+        :param db: DBManager instance (already connected!)
+        :param uid: user id
+        :return: PackedWords
+        """
+        key = (db.path, uid)
+        generation = self.generation(key)
+        words = self.get(key)
+        if words is None:
+            words = PackedWords(db.get_all_words_by_uid(uid))
+            self.put(key, words, generation)
+        return words
+
+    def _discard(self, key: tuple) -> None:
+        words = self._data.pop(key, None)
+        if words is not None:
+            self.size -= words.nbytes
+
+    def invalidate(self, key: tuple) -> None:
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._discard(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+            self._epoch += 1
+            self.size = 0
+
+
+# process-wide cache instance, invalidated by DBManager.add_words
+vocabulary_cache = VocabularyCache(VOCABULARY_CACHE_BUDGET)
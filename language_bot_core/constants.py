@@ -10,3 +10,56 @@ RUS_LOWERCASE = 'абвгдеёжзиклмнопрстуфхцчшщъыьэю
 RUS_UPPERCASE = 'АБВГДЕЁЖЗИКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ'
 RUS_CHARS = RUS_LOWERCASE + RUS_UPPERCASE
 
+
+# memory budget (in bytes) of in-process vocabulary cache
+VOCABULARY_CACHE_BUDGET = 32 * 1024 * 1024
+
+# number of rows fetched/inserted at once during export/import of words
+TRANSFER_CHUNK_SIZE = 1000
+
+# storage engine used by DBManager by default: 'sqlite' or 'memory'
+DB_BACKEND = 'sqlite'
+
+# max number of idle SQLite connections kept open per database file
+DB_POOL_SIZE = 4
+
+# in-memory storage engine persistence: full snapshot is written after this
+# many seconds or journaled operations (whichever comes first)
+MEMORY_SNAPSHOT_INTERVAL = 300
+MEMORY_SNAPSHOT_OPERATIONS = 10000
+
+# normalized storage: unique (word_from, word_to) pairs are stored once in
+# global lexicon table, users words reference them by id (existing databases
+# are migrated on first connection)
+LEXICON_STORAGE = False
+
+# words are moved from active set into archive once user answered them
+# correctly at least ARCHIVE_MIN_CORRECT times with at least
+# ARCHIVE_MIN_ACCURACY share of correct answers (or their status is
+# WORD_STATUS_LEARNED)
+ARCHIVE_MIN_CORRECT = 3
+ARCHIVE_MIN_ACCURACY = 0.8
+WORD_STATUS_LEARNED = 'learned'
+
+# daily (off-peak) time of database maintenance: archiving of learned
+# words, VACUUM, ANALYZE
+MAINTENANCE_TIME = '04:00:00'
+
+# VACUUM waits for other connections to finish their transactions up to
+# this many seconds (instead of default busy timeout), while it runs
+# dispatcher skips ticks of maintained database
+COMPACT_BUSY_TIMEOUT = 600
+
+# online backups: consistent snapshot of database is taken every
+# BACKUP_INTERVAL seconds, BACKUP_RETENTION newest compressed backups are
+# kept. Writers wait while snapshot is taken, snapshot which takes longer
+# than BACKUP_TIMEOUT seconds is aborted (and logged as failed)
+BACKUP_DIR = 'backups'
+BACKUP_INTERVAL = 6 * 60 * 60
+BACKUP_RETENTION = 7
+BACKUP_TIMEOUT = 120
+
+# multiple-choice questions: distractors are picked among words, which
+# translations have the same length class (length // DISTRACTOR_LENGTH_STEP)
+# and first letter as translation of question
+DISTRACTOR_LENGTH_STEP = 3
@@ -2,13 +2,299 @@
 # -*-encoding: utf-8-*-
 
 
+import os
+import re
 import sqlite3
+import time
+from threading import Lock
+
+from .cache import vocabulary_cache
+from .schedule import ScheduleRule, TIME_GLOB
+from .constants import DB_BACKEND, LEXICON_STORAGE, ARCHIVE_MIN_CORRECT, \
+    ARCHIVE_MIN_ACCURACY, WORD_STATUS_LEARNED, DB_POOL_SIZE, \
+    COMPACT_BUSY_TIMEOUT
+
+
+# tables which are not a part of initial database layout, created on first
+# connection to every database file
+SCHEMA = """
+    create table if not exists answer_events (
+        event_id integer primary key,
+        user_id integer,
+        word_from text,
+        word_to text,
+        kind text,
+        correct integer,
+        answer_time real,
+        created real
+    );
+    create table if not exists user_stats (
+        user_id integer primary key,
+        questions integer default 0,
+        answers integer default 0,
+        correct_answers integer default 0,
+        learned_words integer default 0,
+        total_answer_time real default 0
+    );
+    create table if not exists word_stats (
+        user_id integer,
+        word_from text,
+        word_to text,
+        questions integer default 0,
+        answers integer default 0,
+        correct_answers integer default 0,
+        total_answer_time real default 0,
+        attempts_to_learn integer,
+        last_asked real,
+        primary key (user_id, word_from, word_to)
+    );
+    create table if not exists meta (
+        key text primary key,
+        value text
+    );
+    create table if not exists word_archive (
+        user_id integer,
+        word_from text,
+        word_to text,
+        status text,
+        archived real
+    );
+    create index if not exists word_archive_user_id
+        on word_archive (user_id);
+    create table if not exists broadcasts (
+        broadcast_id integer primary key,
+        text text,
+        created real,
+        cursor integer,
+        finished real
+    );
+    create table if not exists broadcast_deliveries (
+        broadcast_id integer,
+        user_id integer,
+        status text,
+        error text,
+        primary key (broadcast_id, user_id)
+    );
+    create table if not exists schedule_rules (
+        rule_id integer primary key,
+        user_id integer,
+        start_time integer,
+        end_time integer,
+        interval integer,
+        weekdays integer
+    );
+    create index if not exists schedule_rules_user_id
+        on schedule_rules (user_id);
+"""
+
+# learned words condition (see constants.ARCHIVE_MIN_CORRECT)
+LEARNED_CONDITION = """
+    status = :status or exists (
+        select 1 from word_stats s
+        where s.user_id = word_src.user_id
+          and s.word_from = word_src.word_from
+          and s.word_to = word_src.word_to
+          and s.correct_answers >= :min_correct
+          and s.correct_answers >= :min_accuracy * s.answers
+    )
+"""
+
+# full-text index over word_src (external content table, so words are not
+# stored twice), kept in sync by triggers. NOTE: rows are referenced by
+# implicit rowid, so index has to be rebuilt after VACUUM
+FTS_SCHEMA = """
+    create virtual table word_src_fts using fts5(
+        user_id, word_from, word_to,
+        content='word_src',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+    create trigger if not exists word_src_fts_ai after insert on word_src
+    begin
+        insert into word_src_fts(rowid, user_id, word_from, word_to)
+        values (new.rowid, new.user_id, new.word_from, new.word_to);
+    end;
+    create trigger if not exists word_src_fts_ad after delete on word_src
+    begin
+        insert into word_src_fts(word_src_fts, rowid, user_id, word_from,
+                                 word_to)
+        values ('delete', old.rowid, old.user_id, old.word_from, old.word_to);
+    end;
+    create trigger if not exists word_src_fts_au after update on word_src
+    begin
+        insert into word_src_fts(word_src_fts, rowid, user_id, word_from,
+                                 word_to)
+        values ('delete', old.rowid, old.user_id, old.word_from, old.word_to);
+        insert into word_src_fts(rowid, user_id, word_from, word_to)
+        values (new.rowid, new.user_id, new.word_from, new.word_to);
+    end;
+    insert into word_src_fts(word_src_fts) values ('rebuild');
+"""
+
+# normalized storage layout: word_src table is replaced with view over
+# global lexicon of unique pairs and slim per-user links to it, so all
+# queries to word_src keep working. Full-text index statements are
+# substituted only if FTS5 is available
+LEXICON_MIGRATION = """
+    drop trigger if exists word_src_fts_ai;
+    drop trigger if exists word_src_fts_ad;
+    drop trigger if exists word_src_fts_au;
+    drop table if exists word_src_fts;
+    create table lexicon (
+        lexicon_id integer primary key,
+        word_from text,
+        word_to text,
+        unique (word_from, word_to)
+    );
+    create table word_links (
+        link_id integer primary key,
+        user_id integer,
+        lexicon_id integer,
+        status text
+    );
+    insert or ignore into lexicon (word_from, word_to)
+        select word_from, word_to from word_src order by rowid;
+    insert into word_links (user_id, lexicon_id, status)
+        select w.user_id, l.lexicon_id, w.status
+        from word_src w join lexicon l
+            on l.word_from = w.word_from and l.word_to = w.word_to
+        order by w.rowid;
+    drop table word_src;
+    create index word_links_user_id on word_links (user_id);
+    create view word_src as
+        select k.link_id, k.user_id, l.word_from, l.word_to, k.status
+        from word_links k join lexicon l using (lexicon_id);
+    {fts_schema}
+    create trigger word_src_insert instead of insert on word_src
+    begin
+        insert or ignore into lexicon (word_from, word_to)
+        values (new.word_from, new.word_to);
+        insert into word_links (user_id, lexicon_id, status)
+            select new.user_id, lexicon_id, new.status from lexicon
+            where word_from = new.word_from and word_to = new.word_to;
+        {fts_insert}
+    end;
+    create trigger word_src_delete instead of delete on word_src
+    begin
+        {fts_delete}
+        delete from word_links where link_id = old.link_id;
+    end;
+    create trigger word_src_update instead of update of status on word_src
+    begin
+        update word_links set status = new.status
+        where link_id = old.link_id;
+    end;
+    {fts_rebuild}
+"""
+
+LEXICON_FTS = {
+    'fts_schema': """
+    create virtual table word_src_fts using fts5(
+        user_id, word_from, word_to,
+        content='word_src',
+        content_rowid='link_id',
+        tokenize='unicode61 remove_diacritics 2'
+    );""",
+    'fts_insert': """
+        insert into word_src_fts (rowid, user_id, word_from, word_to)
+        values (last_insert_rowid(), new.user_id, new.word_from,
+                new.word_to);""",
+    'fts_delete': """
+        insert into word_src_fts (word_src_fts, rowid, user_id, word_from,
+                                  word_to)
+        values ('delete', old.link_id, old.user_id, old.word_from,
+                old.word_to);""",
+    'fts_rebuild': """
+    insert into word_src_fts (word_src_fts) values ('rebuild');""",
+}
+
+QUESTION_EVENT = 'question'
+ANSWER_EVENT = 'answer'
 
 
 class BaseDatabaseException(Exception):
     pass
 
 
+def _create_schema(conn):
+    """
+    Creates all missing tables, full-text index is created (and filled
+    with already present words) only if sqlite is built with FTS5
+
+    :param conn: sqlite3 connection
+    :return: None
+    """
+    conn.executescript(SCHEMA)
+    if _object_type(conn, 'word_src') == 'table':
+        # all hot queries select words of one user
+        conn.execute("create index if not exists word_src_user_id "
+                     "on word_src (user_id)")
+    if _object_type(conn, 'user_ids') == 'table' and \
+            _object_type(conn, 'user_ids_unique_user_id') is None:
+        # users are iterated in order of ids (see get_uids_after), user is
+        # registered only once (duplicates left by concurrent
+        # registrations are dropped)
+        conn.execute("delete from user_ids where rowid not in "
+                     "(select min(rowid) from user_ids group by user_id)")
+        conn.execute("drop index if exists user_ids_user_id")
+        conn.execute("create unique index user_ids_unique_user_id "
+                     "on user_ids (user_id)")
+        conn.commit()
+    q = "select count(*) from sqlite_master where name = 'word_src_fts'"
+    if not conn.execute(q).fetchone()[0] and not _is_lexicon_storage(conn):
+        try:
+            conn.executescript("begin;" + FTS_SCHEMA + "commit;")
+        except sqlite3.OperationalError:    # no fts5 module
+            conn.rollback()
+    if LEXICON_STORAGE and not _is_lexicon_storage(conn):
+        _migrate_to_lexicon(conn)
+
+
+def _object_type(conn, name: str):
+    q = "select type from sqlite_master where name = ?"
+    resp = conn.execute(q, (name,)).fetchone()
+    return None if resp is None else resp[0]
+
+
+def _is_lexicon_storage(conn) -> bool:
+    return _object_type(conn, 'word_src') == 'view'
+
+
+def _migrate_to_lexicon(conn):
+    """
+    Converts database to normalized (lexicon) storage layout in one
+    transaction
+
+    :param conn: sqlite3 connection
+    :return: None
+    """
+    options = [row[0] for row in conn.execute("pragma compile_options")]
+    if 'ENABLE_FTS5' in options:
+        script = LEXICON_MIGRATION.format(**LEXICON_FTS)
+    else:
+        script = LEXICON_MIGRATION.format(**dict.fromkeys(LEXICON_FTS, ''))
+    conn.executescript("begin;" + script + "commit;")
+
+
+def _build_fts_query(uid: int, query: str):
+    """
+    Builds FTS5 MATCH expression: every word of query is a prefix which
+    has to be present either in word_from or word_to. Index is narrowed
+    to words of given user only approximately (tokenizer drops sign of
+    negative ids, i.e. of group chats), results have to be filtered by
+    user_id in SQL.
+
+    :param uid: user id
+    :param query: raw user query
+    :return: MATCH expression or None if query has no words
+    """
+    tokens = re.findall(r'\w+', query)
+    if not tokens:
+        return None
+    terms = " ".join('"{}"*'.format(token) for token in tokens)
+    return 'user_id:"{}" AND {{word_from word_to}}: ({})'.format(abs(uid),
+                                                                 terms)
+
+
 class DisconnectedDatabaseError(BaseDatabaseException):
     pass
 
@@ -17,6 +303,10 @@ class ConnectedDatabaseError(BaseDatabaseException):
     pass
 
 
+class UnknownBackendError(BaseDatabaseException):
+    pass
+
+
 class DisconnectedDBMeta(type):
     """Metaclass which defines common behavior of unimplemented methods for
         DisconnectedDB class
@@ -39,16 +329,100 @@ class DisconnectedDBMeta(type):
                                         'on closed database')
 
 
-class ConnectedDB:
-    """Class which represents connected database state"""
+class ConnectionPool:
+    """
+    Idle SQLite connections by database path. DBManager takes connection
+    from pool on connect and returns it on disconnect, so short-lived
+    managers (one per handler call) do not open database file every time.
+    Connections are shared by all databases hosted by process, `size` is
+    max number of idle connections kept per database.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._idle = {}
+        self._pid = os.getpid()
+        self._lock = Lock()
+
+    def acquire(self, path: str):
+        with self._lock:
+            # connections must never be shared with forked process
+            if self._pid != os.getpid():
+                self._idle, self._pid = {}, os.getpid()
+            idle = self._idle.get(path, None)
+            if idle:
+                return idle.pop()
+        return sqlite3.connect(path, check_same_thread=False)
+
+    def release(self, path: str, conn) -> None:
+        if conn.in_transaction:     # left by failed operation
+            conn.rollback()
+        if path != ':memory:':
+            with self._lock:
+                idle = self._idle.setdefault(path, [])
+                if self._pid == os.getpid() and len(idle) < self.size:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def clear(self, path: str = None) -> None:
+        """
+        Closes idle connections (i.e. before database file is replaced)
+
+        :param path: database path, all databases if None
+        :return: None
+        """
+        with self._lock:
+            paths = list(self._idle) if path is None else [path]
+            for p in paths:
+                for conn in self._idle.pop(p, []):
+                    conn.close()
+
+
+connection_pool = ConnectionPool(DB_POOL_SIZE)
+
+
+class StorageBackend:
+    """Storage backend protocol.
+
+        Backend is a connected state class of DBManager: `open` is invoked
+    by DisconnectedDB.connect and has to switch manager into backend's
+    state, after that every DBManager operation is delegated to backend's
+    static method of the same name with manager passed as first argument.
+    Backends are registered in BACKENDS by name.
+    """
+
+    @staticmethod
+    def open(db_manager):
+        raise NotImplementedError
 
     @staticmethod
     def connect(db_manager):
         raise ConnectedDatabaseError("Already connected")
 
+
+class ConnectedDB(StorageBackend):
+    """Class which represents connected database state (SQLite backend)"""
+
+    # database files, which already have all tables from SCHEMA created
+    initialized_paths = set()
+
+    @staticmethod
+    def open(db_manager):
+        db_manager.new_state(ConnectedDB)
+        db_manager.conn = connection_pool.acquire(db_manager.path)
+        db_manager.curs = db_manager.conn.cursor()
+        if db_manager.path == ':memory:':
+            _create_schema(db_manager.conn)
+        elif db_manager.path not in ConnectedDB.initialized_paths:
+            _create_schema(db_manager.conn)
+            ConnectedDB.initialized_paths.add(db_manager.path)
+
     @staticmethod
     def disconnect(db_manager):
-        db_manager.conn.close()
+        db_manager.curs.close()
+        connection_pool.release(db_manager.path, db_manager.conn)
+        db_manager.conn = None
         db_manager.curs = None
         db_manager.new_state(DisconnectedDB)
 
@@ -59,12 +433,69 @@ class ConnectedDB:
         res = [item[0] for item in db_manager.curs.fetchall()]
         return res
 
+    @staticmethod
+    def get_uids_after(db_manager, after, limit: int):
+        if after is None:
+            q = "select user_id from user_ids order by user_id limit ?"
+            params = (limit,)
+        else:
+            q = "select user_id from user_ids where user_id > ? " \
+                "order by user_id limit ?"
+            params = (after, limit)
+        return [item[0] for item in db_manager.curs.execute(q, params)]
+
     @staticmethod
     def get_schedule_by_uid(db_manager, uid):
         q = """select time from schedule where user_id=?"""
         res = [item[0] for item in db_manager.curs.execute(q, (uid,))]
         return res
 
+    @staticmethod
+    def add_schedule_rule(db_manager, uid: int, rule: ScheduleRule):
+        q = "insert into schedule_rules (user_id, start_time, end_time, " \
+            "interval, weekdays) values (?, ?, ?, ?, ?)"
+        db_manager.curs.execute(q, (uid, *rule))
+        db_manager.conn.commit()
+        return db_manager.curs.lastrowid
+
+    @staticmethod
+    def delete_schedule_rule(db_manager, uid: int, rule_id: int):
+        q = "delete from schedule_rules where user_id = ? and rule_id = ?"
+        db_manager.curs.execute(q, (uid, rule_id))
+        db_manager.conn.commit()
+        return db_manager.curs.rowcount
+
+    @staticmethod
+    def get_schedule_rules_by_uid(db_manager, uid: int):
+        q = "select rule_id, start_time, end_time, interval, weekdays " \
+            "from schedule_rules where user_id = ? order by rule_id"
+        return [(row[0], ScheduleRule(*row[1:]))
+                for row in db_manager.curs.execute(q, (uid,))]
+
+    @staticmethod
+    def get_schedule_rules(db_manager):
+        q = "select user_id, start_time, end_time, interval, weekdays " \
+            "from schedule_rules " \
+            "where user_id in (select user_id from user_ids) " \
+            "order by rule_id"
+        res = {}
+        for row in db_manager.curs.execute(q):
+            res.setdefault(row[0], []).append(ScheduleRule(*row[1:]))
+        return res
+
+    @staticmethod
+    def count_scheduled_fires(db_manager, segments: list):
+        if not segments:
+            return {}
+        fires = " + ".join(["(time > ? and time <= ?) * ?"] * len(segments))
+        q = "select user_id, sum({}) as fires from schedule " \
+            "where time glob ? and " \
+            "user_id in (select user_id from user_ids) " \
+            "group by user_id having fires > 0".format(fires)
+        params = [value for segment in segments for value in segment]
+        db_manager.curs.execute(q, (*params, TIME_GLOB))
+        return dict(db_manager.curs.fetchall())
+
     @staticmethod
     def is_registered(db_manager, uid):
         q = """select * from user_ids where user_id=?"""
@@ -73,10 +504,10 @@ class ConnectedDB:
 
     @staticmethod
     def register(db_manager, uid):
-        if not db_manager.is_registered(uid):
-            q = """insert into user_ids values (?)"""
-            db_manager.curs.execute(q, (uid,))
-            db_manager.conn.commit()
+        q = """insert or ignore into user_ids values (?)"""
+        db_manager.curs.execute(q, (uid,))
+        db_manager.conn.commit()
+        return db_manager.curs.rowcount > 0
 
     @staticmethod
     def get_all_words_by_uid(db_manager, uid):
@@ -86,8 +517,8 @@ class ConnectedDB:
 
     @staticmethod
     def add_scheduled_time_by_uid(db_manager, uid: int, time_string: str):
-        q = "select * from schedule where time=?"
-        db_manager.curs.execute(q, (time_string, ))
+        q = "select * from schedule where user_id=? and time=?"
+        db_manager.curs.execute(q, (uid, time_string))
         if not db_manager.curs.fetchall():
             q = "insert into schedule values (?, ?)"
             db_manager.curs.execute(q, (uid, time_string))
@@ -106,11 +537,29 @@ class ConnectedDB:
 
     @staticmethod
     def add_words(db_manager, uid: int, words: list):
-        q = "insert into word_src values (?, ?, ?, ?)"
-        for word_from, word_to in words:
-            db_manager.curs.execute(q, (uid, word_from, word_to, 0))
+        q = "insert into word_src (user_id, word_from, word_to, status) " \
+            "values (?, ?, ?, ?)"
+        db_manager.curs.executemany(q, ((uid, word_from, word_to, 0)
+                                        for word_from, word_to in words))
         db_manager.conn.commit()
 
+    @staticmethod
+    def iter_words_by_uid(db_manager, uid: int, chunk_size: int):
+        # separate cursor, so other queries may be executed while iterating
+        curs = db_manager.conn.cursor()
+        q = "select word_from, word_to from word_src where user_id = ? " \
+            "union all " \
+            "select word_from, word_to from word_archive where user_id = ?"
+        curs.execute(q, (uid, uid))
+        try:
+            while True:
+                rows = curs.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            curs.close()
+
     @staticmethod
     def get_next_time_by_uid(db_manager, cur_time_str, uid):
         q = "select time from schedule where time >= ? and user_id = ? " \
@@ -121,6 +570,240 @@ class ConnectedDB:
             return None
         return resp[0]
 
+    @staticmethod
+    def search_words(db_manager, uid: int, query: str, limit: int):
+        match = _build_fts_query(uid, query)
+        if match is None:
+            return []
+        q = "select word_from, word_to from word_src_fts " \
+            "where word_src_fts match ? and user_id = ? " \
+            "order by rank limit ?"
+        try:
+            db_manager.curs.execute(q, (match, uid, limit))
+        except sqlite3.OperationalError:    # no full-text index, slow path
+            q = "select word_from, word_to from word_src where user_id = ? " \
+                "and (word_from like ? or word_to like ?) limit ?"
+            pattern = '%{}%'.format(query.strip())
+            db_manager.curs.execute(q, (uid, pattern, pattern, limit))
+        return db_manager.curs.fetchall()
+
+    @staticmethod
+    def is_lexicon_storage(db_manager):
+        return _is_lexicon_storage(db_manager.conn)
+
+    @staticmethod
+    def migrate_to_lexicon(db_manager):
+        if _is_lexicon_storage(db_manager.conn):
+            return False
+        _migrate_to_lexicon(db_manager.conn)
+        return True
+
+    @staticmethod
+    def get_meta(db_manager, key: str):
+        q = "select value from meta where key = ?"
+        db_manager.curs.execute(q, (key,))
+        resp = db_manager.curs.fetchone()
+        if not resp:
+            return None
+        return resp[0]
+
+    @staticmethod
+    def set_meta(db_manager, key: str, value: str):
+        q = "insert or replace into meta values (?, ?)"
+        db_manager.curs.execute(q, (key, value))
+        db_manager.conn.commit()
+
+    @staticmethod
+    def record_questions(db_manager, words: dict, ts: float):
+        q1 = "insert into answer_events (user_id, word_from, word_to, " \
+             "kind, created) values (?, ?, ?, ?, ?)"
+        q2 = "insert or ignore into user_stats (user_id) values (?)"
+        q3 = "update user_stats set questions = questions + 1 " \
+             "where user_id = ?"
+        q4 = "insert or ignore into word_stats (user_id, word_from, word_to) " \
+             "values (?, ?, ?)"
+        q5 = "update word_stats set questions = questions + 1, " \
+             "last_asked = ? where user_id = ? and word_from = ? " \
+             "and word_to = ?"
+        for uid, pairs in words.items():
+            for word_from, word_to in pairs:
+                db_manager.curs.execute(q1, (uid, word_from, word_to,
+                                             QUESTION_EVENT, ts))
+                db_manager.curs.execute(q2, (uid,))
+                db_manager.curs.execute(q3, (uid,))
+                db_manager.curs.execute(q4, (uid, word_from, word_to))
+                db_manager.curs.execute(q5, (ts, uid, word_from, word_to))
+        db_manager.conn.commit()
+
+    @staticmethod
+    def record_answer(db_manager, uid: int, word: tuple, correct: bool,
+                      ts: float):
+        word_from, word_to = word
+        q = "select last_asked, attempts_to_learn, answers from word_stats " \
+            "where user_id = ? and word_from = ? and word_to = ?"
+        db_manager.curs.execute(q, (uid, word_from, word_to))
+        row = db_manager.curs.fetchone()
+        if row is None:
+            q = "insert or ignore into word_stats " \
+                "(user_id, word_from, word_to) values (?, ?, ?)"
+            db_manager.curs.execute(q, (uid, word_from, word_to))
+            last_asked, attempts_to_learn, answers = None, None, 0
+        else:
+            last_asked, attempts_to_learn, answers = row
+        answer_time = None if last_asked is None else max(ts - last_asked, 0)
+        newly_learned = correct and attempts_to_learn is None
+
+        q = "insert into answer_events (user_id, word_from, word_to, kind, " \
+            "correct, answer_time, created) values (?, ?, ?, ?, ?, ?, ?)"
+        db_manager.curs.execute(q, (uid, word_from, word_to, ANSWER_EVENT,
+                                    int(correct), answer_time, ts))
+        q = "update word_stats set answers = answers + 1, " \
+            "correct_answers = correct_answers + ?, " \
+            "total_answer_time = total_answer_time + ?, " \
+            "attempts_to_learn = ? " \
+            "where user_id = ? and word_from = ? and word_to = ?"
+        db_manager.curs.execute(q, (int(correct), answer_time or 0,
+                                    answers + 1 if newly_learned
+                                    else attempts_to_learn,
+                                    uid, word_from, word_to))
+        q = "insert or ignore into user_stats (user_id) values (?)"
+        db_manager.curs.execute(q, (uid,))
+        q = "update user_stats set answers = answers + 1, " \
+            "correct_answers = correct_answers + ?, " \
+            "learned_words = learned_words + ?, " \
+            "total_answer_time = total_answer_time + ? where user_id = ?"
+        db_manager.curs.execute(q, (int(correct), int(newly_learned),
+                                    answer_time or 0, uid))
+        db_manager.conn.commit()
+        return answer_time
+
+    @staticmethod
+    def get_stats_by_uid(db_manager, uid: int):
+        q = "select questions, answers, correct_answers, learned_words, " \
+            "total_answer_time from user_stats where user_id = ?"
+        db_manager.curs.execute(q, (uid,))
+        row = db_manager.curs.fetchone()
+        if row is None:
+            return None
+        keys = ('questions', 'answers', 'correct_answers', 'learned_words',
+                'total_answer_time')
+        return dict(zip(keys, row))
+
+    @staticmethod
+    def get_word_stats_by_uid(db_manager, uid: int, word: tuple):
+        q = "select questions, answers, correct_answers, total_answer_time, " \
+            "attempts_to_learn from word_stats " \
+            "where user_id = ? and word_from = ? and word_to = ?"
+        db_manager.curs.execute(q, (uid, *word))
+        row = db_manager.curs.fetchone()
+        if row is None:
+            return None
+        keys = ('questions', 'answers', 'correct_answers', 'total_answer_time',
+                'attempts_to_learn')
+        return dict(zip(keys, row))
+
+    @staticmethod
+    def compact_answer_events(db_manager, before: float):
+        q = "delete from answer_events where created < ?"
+        db_manager.curs.execute(q, (before,))
+        db_manager.conn.commit()
+        return db_manager.curs.rowcount
+
+    @staticmethod
+    def archive_learned_words(db_manager, min_correct: int,
+                              min_accuracy: float, ts: float):
+        params = {'status': WORD_STATUS_LEARNED, 'min_correct': min_correct,
+                  'min_accuracy': min_accuracy, 'ts': ts}
+        q = "select user_id, count(*) from word_src where " + \
+            LEARNED_CONDITION + " group by user_id"
+        # affected users (whose cached vocabulary is invalidated) must match
+        # moved rows, so they are selected in the same write transaction
+        db_manager.conn.commit()
+        db_manager.curs.execute("begin immediate")
+        try:
+            archived = dict(db_manager.curs.execute(q, params).fetchall())
+            if archived:
+                db_manager.curs.execute(
+                    "insert into word_archive "
+                    "(user_id, word_from, word_to, status, archived) "
+                    "select user_id, word_from, word_to, status, :ts "
+                    "from word_src where " + LEARNED_CONDITION, params)
+                db_manager.curs.execute(
+                    "delete from word_src where " + LEARNED_CONDITION, params)
+        except BaseException:
+            db_manager.conn.rollback()
+            raise
+        db_manager.conn.commit()
+        return archived
+
+    @staticmethod
+    def compact(db_manager):
+        conn = db_manager.conn
+        conn.commit()
+        # connection is pooled, so its own busy timeout is restored after
+        timeout = conn.execute("pragma busy_timeout").fetchone()[0]
+        conn.execute("pragma busy_timeout = {}".format(
+            COMPACT_BUSY_TIMEOUT * 1000))
+        try:
+            conn.execute("vacuum")
+            conn.execute("analyze")
+            conn.execute("pragma optimize")
+            q = "select count(*) from sqlite_master " \
+                "where name = 'word_src_fts'"
+            if conn.execute(q).fetchone()[0]:
+                # vacuum may renumber implicit rowids, which index refers to
+                conn.execute("insert into word_src_fts(word_src_fts) "
+                             "values ('rebuild')")
+            conn.commit()
+        finally:
+            conn.execute("pragma busy_timeout = {}".format(timeout))
+
+    @staticmethod
+    def create_broadcast(db_manager, text: str, ts: float):
+        q = "insert into broadcasts (text, created) values (?, ?)"
+        db_manager.curs.execute(q, (text, ts))
+        db_manager.conn.commit()
+        return db_manager.curs.lastrowid
+
+    @staticmethod
+    def get_broadcast(db_manager, broadcast_id: int):
+        q = "select broadcast_id, text, created, cursor, finished " \
+            "from broadcasts where broadcast_id = ?"
+        row = db_manager.curs.execute(q, (broadcast_id,)).fetchone()
+        if row is None:
+            return None
+        keys = ('broadcast_id', 'text', 'created', 'cursor', 'finished')
+        return dict(zip(keys, row))
+
+    @staticmethod
+    def get_unfinished_broadcasts(db_manager):
+        q = "select broadcast_id from broadcasts where finished is null " \
+            "order by broadcast_id"
+        return [item[0] for item in db_manager.curs.execute(q)]
+
+    @staticmethod
+    def checkpoint_broadcast(db_manager, broadcast_id: int, cursor: int,
+                             deliveries: list):
+        q = "insert or replace into broadcast_deliveries " \
+            "(broadcast_id, user_id, status, error) values (?, ?, ?, ?)"
+        db_manager.curs.executemany(q, ((broadcast_id, *item)
+                                        for item in deliveries))
+        q = "update broadcasts set cursor = ? where broadcast_id = ?"
+        db_manager.curs.execute(q, (cursor, broadcast_id))
+        db_manager.conn.commit()
+
+    @staticmethod
+    def finish_broadcast(db_manager, broadcast_id: int, ts: float):
+        q = "update broadcasts set finished = ? where broadcast_id = ?"
+        db_manager.curs.execute(q, (ts, broadcast_id))
+        db_manager.conn.commit()
+
+    @staticmethod
+    def get_broadcast_stats(db_manager, broadcast_id: int):
+        q = "select status, count(*) from broadcast_deliveries " \
+            "where broadcast_id = ? group by status"
+        return dict(db_manager.curs.execute(q, (broadcast_id,)).fetchall())
+
     @staticmethod
     def get_random_word_by_uid(db_manager, uid: int):
         q = """select t1.word_from, t1.word_to from
@@ -135,14 +818,20 @@ class ConnectedDB:
         return db_manager.curs.fetchone()
 
 
+# storage backends by name, other backends register themselves on import
+BACKENDS = {'sqlite': ConnectedDB}
+
+
 class DisconnectedDB(metaclass=DisconnectedDBMeta):
     """Class which represents disconnected database state"""
 
     @staticmethod
     def connect(db_manager):
-        db_manager.new_state(ConnectedDB)
-        db_manager.conn = sqlite3.connect(db_manager.path)
-        db_manager.curs = db_manager.conn.cursor()
+        backend = BACKENDS.get(db_manager.backend, None)
+        if backend is None:
+            raise UnknownBackendError('Unknown storage backend: '
+                                      '{}'.format(db_manager.backend))
+        backend.open(db_manager)
 
 
 class DBManager:
@@ -150,12 +839,15 @@ class DBManager:
 
         Implemented as a state machine, each state is implemented
         in it's own class. Any operation on database is delegated to be
-        executed by current state class.
+        executed by current state class. Connected state is defined by
+        storage backend (see StorageBackend).
     """
-    def __init__(self, path):
+    def __init__(self, path, backend=DB_BACKEND):
         self.path = path
+        self.backend = backend
         self.conn = None
         self.curs = None
+        self.store = None
         self._state = None
         self.new_state(DisconnectedDB)
 
@@ -171,6 +863,16 @@ class DBManager:
     def get_uids(self):
         return self._state.get_uids(self)
 
+    def get_uids_after(self, after: int = None, limit: int = 1000) -> list:
+        """
+        Keyset pagination over users: only one page is held in memory
+
+        :param after: last user id of previous page (None for first page)
+        :param limit: max page size
+        :return: user ids greater than `after` in ascending order
+        """
+        return self._state.get_uids_after(self, after, limit)
+
     def get_schedule_by_uid(self, uid: int) -> tuple:
         return self._state.get_schedule_by_uid(self, uid)
 
@@ -183,11 +885,55 @@ class DBManager:
     def get_next_time_by_uid(self, cur_time_str, uid):
         return self._state.get_next_time_by_uid(self, cur_time_str, uid)
 
+    def add_schedule_rule(self, uid: int, rule: ScheduleRule) -> int:
+        """
+        :param uid: user id
+        :param rule: periodic schedule (see language_bot_core.schedule)
+        :return: rule id
+        """
+        return self._state.add_schedule_rule(self, uid, rule)
+
+    def delete_schedule_rule(self, uid: int, rule_id: int) -> int:
+        """
+        :return: number of deleted rules (0 if user has no such rule)
+        """
+        return self._state.delete_schedule_rule(self, uid, rule_id)
+
+    def get_schedule_rules_by_uid(self, uid: int) -> list:
+        """
+        :param uid: user id
+        :return: [(rule_id, ScheduleRule), ...]
+        """
+        return self._state.get_schedule_rules_by_uid(self, uid)
+
+    def get_schedule_rules(self) -> dict:
+        """
+        :return: dict({user_id: [ScheduleRule, ...]}) rules of all
+                 registered users
+        """
+        return self._state.get_schedule_rules(self)
+
+    def count_scheduled_fires(self, segments: list) -> dict:
+        """
+        Counts fires of one-off times of all registered users in one query
+
+        :param segments: time-of-day ranges of interval (see
+                         language_bot_core.schedule.day_segments)
+        :return: dict({user_id: number of fires}), users without fires
+                 are omitted
+        """
+        return self._state.count_scheduled_fires(self, segments)
+
     def is_registered(self, uid: int) -> bool:
         return self._state.is_registered(self, uid)
 
-    def register(self, uid: int) -> None:
-        self._state.register(self, uid)
+    def register(self, uid: int) -> bool:
+        """
+        :param uid: user id
+        :return: True if user is registered now, False if it was
+                 registered before (i.e. by concurrent /start)
+        """
+        return self._state.register(self, uid)
 
     def get_all_words_by_uid(self, uid: int) -> tuple:
         return self._state.get_all_words_by_uid(self, uid)
@@ -197,6 +943,177 @@ class DBManager:
 
     def add_words(self, uid: int, words: list):
         self._state.add_words(self, uid, words)
+        vocabulary_cache.invalidate((self.path, uid))
+
+    def iter_words_by_uid(self, uid: int, chunk_size: int = 1000):
+        """
+        Lazily iterates over all user's words (archived ones included),
+        fetching them by chunks
+
+        :param uid: user id
+        :param chunk_size: number of rows fetched at once
+        :return: generator of (word_from, word_to)
+        """
+        return self._state.iter_words_by_uid(self, uid, chunk_size)
+
+    def search_words(self, uid: int, query: str, limit: int = 20) -> list:
+        """
+        Full-text search in user's words: each word of query is matched as
+        a prefix (case and diacritics insensitive) in either word or its
+        translation
+
+        :param uid: user id
+        :param query: search query
+        :param limit: max number of results
+        :return: [(word_from, word_to), ...] best matches first
+        """
+        return self._state.search_words(self, uid, query, limit)
+
+    def is_lexicon_storage(self) -> bool:
+        """
+        :return: whether words are stored in normalized (lexicon) layout
+        """
+        return self._state.is_lexicon_storage(self)
+
+    def migrate_to_lexicon(self) -> bool:
+        """
+        Moves words into normalized layout: unique pairs are stored once
+        in global lexicon table, users reference them by id
+
+        :return: False if database was already migrated
+        """
+        return self._state.migrate_to_lexicon(self)
+
+    def get_meta(self, key: str):
+        """
+        :param key: service value name
+        :return: stored string value or None
+        """
+        return self._state.get_meta(self, key)
+
+    def set_meta(self, key: str, value: str) -> None:
+        self._state.set_meta(self, key, value)
+
+    def record_questions(self, words: dict, ts: float = None):
+        """
+        Appends 'question' events for each {uid: [(word_from, word_to)]}
+        and updates statistics rollups
+
+        :param words: dict({user_id: [(word_from, word_to), ...]})
+        :param ts: unix timestamp of questioning, current time by default
+        :return: None
+        """
+        if ts is None:
+            ts = time.time()
+        self._state.record_questions(self, words, ts)
+
+    def record_answer(self, uid: int, word: tuple, correct: bool,
+                      ts: float = None):
+        """
+        Appends 'answer' event and updates statistics rollups
+
+        :param uid: user id
+        :param word: (word_from, word_to) pair which was answered
+        :param correct: whether answer was correct
+        :param ts: unix timestamp of answer, current time by default
+        :return: seconds passed since word was asked (None if unknown)
+        """
+        if ts is None:
+            ts = time.time()
+        return self._state.record_answer(self, uid, word, correct, ts)
+
+    def get_stats_by_uid(self, uid: int):
+        return self._state.get_stats_by_uid(self, uid)
+
+    def get_word_stats_by_uid(self, uid: int, word: tuple):
+        return self._state.get_word_stats_by_uid(self, uid, word)
+
+    def compact_answer_events(self, before: float) -> int:
+        """
+        Removes events older than given timestamp. Rollups are
+        left untouched, so statistics are not affected
+
+        :param before: unix timestamp
+        :return: number of removed events
+        """
+        return self._state.compact_answer_events(self, before)
+
+    def archive_learned_words(self, min_correct: int = ARCHIVE_MIN_CORRECT,
+                              min_accuracy: float = ARCHIVE_MIN_ACCURACY,
+                              ts: float = None) -> dict:
+        """
+        Moves learned words out of active set (which is used for questions
+        and listings) into archive, so active set of long-time users does
+        not grow with their history. Archived words are still exported.
+
+        :param min_correct: min number of correct answers to a word
+        :param min_accuracy: min share of correct answers to a word
+        :param ts: unix timestamp of archiving, current time by default
+        :return: dict({user_id: number of archived words})
+        """
+        if ts is None:
+            ts = time.time()
+        archived = self._state.archive_learned_words(self, min_correct,
+                                                     min_accuracy, ts)
+        for uid in archived:
+            vocabulary_cache.invalidate((self.path, uid))
+        return archived
+
+    def create_broadcast(self, text: str, ts: float = None) -> int:
+        """
+        :param text: message to send to every registered user
+        :param ts: unix timestamp of creation, current time by default
+        :return: broadcast id
+        """
+        if ts is None:
+            ts = time.time()
+        return self._state.create_broadcast(self, text, ts)
+
+    def get_broadcast(self, broadcast_id: int):
+        """
+        :param broadcast_id: broadcast id
+        :return: dict(broadcast_id, text, created, cursor (last processed
+                 user id), finished) or None
+        """
+        return self._state.get_broadcast(self, broadcast_id)
+
+    def get_unfinished_broadcasts(self) -> list:
+        return self._state.get_unfinished_broadcasts(self)
+
+    def checkpoint_broadcast(self, broadcast_id: int, cursor: int,
+                             deliveries: list) -> None:
+        """
+        Atomically records delivery statuses of processed users and moves
+        broadcast cursor
+
+        :param broadcast_id: broadcast id
+        :param cursor: last processed user id
+        :param deliveries: [(user_id, status, error or None), ...]
+        :return: None
+        """
+        self._state.checkpoint_broadcast(self, broadcast_id, cursor,
+                                         deliveries)
+
+    def finish_broadcast(self, broadcast_id: int, ts: float = None) -> None:
+        if ts is None:
+            ts = time.time()
+        self._state.finish_broadcast(self, broadcast_id, ts)
+
+    def get_broadcast_stats(self, broadcast_id: int) -> dict:
+        """
+        :param broadcast_id: broadcast id
+        :return: dict({delivery status: number of users})
+        """
+        return self._state.get_broadcast_stats(self, broadcast_id)
+
+    def compact(self) -> None:
+        """
+        Defragments storage and refreshes query planner statistics
+        (VACUUM, ANALYZE), may take a while on large databases
+
+        :return: None
+        """
+        self._state.compact(self)
 
 
 if __name__ == '__main__':
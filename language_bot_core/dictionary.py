@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Offline bilingual dictionary.
+
+    Dictionary is compiled into sorted string table:
+
+        magic | N | offsets[N + 1] | entries
+
+where offsets are little-endian uint64 positions of entries in file, and
+each entry is b'<word>\\t<translation>\\n' (words are normalized and
+sorted by their utf-8 bytes). File is memory-mapped read-only, so it is
+loaded instantly, its pages are shared by all processes through OS page
+cache and lookup is a binary search over offsets (O(log N)).
+
+Source file has one 'word<TAB>translation' pair per line, command line
+usage:
+    python -m language_bot_core.dictionary <source.tsv> <output> [--reverse]
+"""
+
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+
+from .parser import split_by_lang
+
+
+MAGIC = b'LBDICT1\0'
+HEADER = struct.Struct('<8sQ')
+OFFSET = struct.Struct('<Q')
+
+
+class DictionaryError(Exception):
+    pass
+
+
+def normalize(word: str) -> str:
+    return ' '.join(word.casefold().split())
+
+
+def compile_dictionary(pairs, path: str, reverse: bool = False) -> int:
+    """
+    Builds dictionary file, translations of duplicate words are joined
+
+    :param pairs: iterable of (word, translation)
+    :param path: output file
+    :param reverse: add translation -> word entries too
+    :return: number of entries
+    """
+    entries = {}
+    for word, translation in pairs:
+        items = [(word, translation)]
+        if reverse:
+            items.append((translation, word))
+        for key, value in items:
+            key, value = normalize(key), ' '.join(value.split())
+            if not key or not value or '\t' in key:
+                continue
+            values = entries.setdefault(key.encode('utf-8'), [])
+            if value not in values:
+                values.append(value)
+    keys = sorted(entries)
+    data_start = HEADER.size + OFFSET.size * (len(keys) + 1)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(keys)))
+        pos = data_start
+        encoded = []
+        for key in keys:
+            entry = key + b'\t' + ', '.join(entries[key]).encode('utf-8') + \
+                b'\n'
+            encoded.append(entry)
+            f.write(OFFSET.pack(pos))
+            pos += len(entry)
+        f.write(OFFSET.pack(pos))
+        for entry in encoded:
+            f.write(entry)
+    os.replace(tmp_path, path)
+    return len(keys)
+
+
+class Dictionary:
+    """Read-only memory-mapped dictionary"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            try:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise DictionaryError("Not a dictionary: {}".format(path))
+        if len(self._mm) < HEADER.size:
+            raise DictionaryError("Not a dictionary: {}".format(path))
+        magic, self._count = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise DictionaryError("Not a dictionary: {}".format(path))
+
+    def __len__(self):
+        return self._count
+
+    def _offset(self, i: int) -> int:
+        return OFFSET.unpack_from(self._mm, HEADER.size + OFFSET.size * i)[0]
+
+    def _key(self, i: int) -> bytes:
+        start = self._offset(i)
+        return self._mm[start:self._mm.find(b'\t', start)]
+
+    def lookup(self, word: str):
+        """
+        :param word: word (case and extra spaces are ignored)
+        :return: translation or None
+        """
+        key = normalize(word).encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._count or self._key(lo) != key:
+            return None
+        start = self._offset(lo) + len(key) + 1
+        return self._mm[start:self._offset(lo + 1) - 1].decode('utf-8')
+
+    def close(self) -> None:
+        self._mm.close()
+
+
+def suggest_translations(dictionary: Dictionary, words) -> list:
+    """
+    Looks up translations of words, which were uploaded without them
+    (infinitive particle 'to' is ignored if verb itself is not found)
+
+    :param dictionary: Dictionary instance
+    :param words: iterable of words
+    :return: [(word, translation), ...] for found words
+    """
+    res = []
+    for word in words:
+        translation = dictionary.lookup(word)
+        if translation is None and normalize(word).startswith('to '):
+            translation = dictionary.lookup(normalize(word)[3:])
+        if translation is not None:
+            res.append((word, translation))
+    return res
+
+
+def read_pairs(f):
+    """
+    :param f: text file of 'word<TAB>translation' lines (lines without tab
+              are split by language, as user notes)
+    :return: generator of (word, translation)
+    """
+    for line in f:
+        if '\t' in line:
+            word, translation = line.rstrip('\n').split('\t', 1)
+        elif line.strip():
+            word, translation = split_by_lang(line)
+        else:
+            continue
+        yield word, translation
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile dictionary")
+    parser.add_argument('source')
+    parser.add_argument('output')
+    parser.add_argument('--reverse', action='store_true',
+                        help="add translation -> word entries")
+    args = parser.parse_args()
+    with open(args.source, encoding='utf-8') as f:
+        count = compile_dictionary(read_pairs(f), args.output, args.reverse)
+    print("Compiled {} entries into {}".format(count, args.output),
+          file=sys.stderr)
@@ -2,85 +2,232 @@
 # -*-encoding: utf-8-*-
 
 
+import datetime
+import logging
+import random
+import sqlite3
 import time
 import types
 
-from .dbmanager import DBManager
+from .dbmanager import DBManager, BaseDatabaseException
+from .cache import vocabulary_cache
+from .maintenance import maintenance_lock
+from .schedule import count_rule_fires, count_time_fires, day_segments
+from .logs import get_logger, log_event, TICK, DB_ERROR
 
 
-def get_cur_time_str():
-    cur_time = time.localtime()
-    s = "{H:>02}:{M:>02}:{S:>02}"
-    return s.format(H=cur_time.tm_hour, M=cur_time.tm_min, S=cur_time.tm_sec)
+logger = get_logger('dispatcher')
+
+
+# meta key of the last moment, for which all scheduled fires were dispatched
+WATERMARK_KEY = 'dispatcher_watermark'
+
+# fires missed for longer than this period (i.e. during long downtime)
+# are not caught up
+MAX_CATCH_UP = datetime.timedelta(days=1)
+
+
+def count_fires(times: list, since: datetime.datetime,
+                until: datetime.datetime, rules=()) -> int:
+    """
+    Counts how many times daily schedule fired in (since, until] interval
+
+    :param times: daily schedule, list of 'hh:mm:ss' strings
+    :param since: interval start (exclusive)
+    :param until: interval end (inclusive)
+    :param rules: periodic schedule, list of ScheduleRule
+    :return: number of fires
+    """
+    since = max(since, until - MAX_CATCH_UP)
+    return count_time_fires(times, day_segments(since, until)) + \
+        sum(count_rule_fires(rule, since, until) for rule in rules)
+
+
+def count_all_fires(db: DBManager, since: datetime.datetime,
+                    until: datetime.datetime) -> dict:
+    """
+    Same as count_fires, but for all registered users at once: one-off
+    times are counted by one range query
+
+    :param db: DBManager instance (already connected!)
+    :param since: interval start (exclusive)
+    :param until: interval end (inclusive)
+    :return: dict({user_id: number of fires}), users without fires are
+             omitted
+    """
+    since = max(since, until - MAX_CATCH_UP)
+    fires = db.count_scheduled_fires(day_segments(since, until))
+    for uid, rules in db.get_schedule_rules().items():
+        count = sum(count_rule_fires(rule, since, until) for rule in rules)
+        if count:
+            fires[uid] = fires.get(uid, 0) + count
+    return fires
+
+
+def next_deadline(deadline: float, delay: float, now: float = None) -> float:
+    """
+    Ticks are aligned to wall clock (multiples of delay since epoch), so
+    time spent on tick does not shift the following ones. Deadline which
+    has already passed is returned as is (tick runs at once), boundaries
+    missed by overrunning tick are not repeated: their fires are caught
+    up by watermark.
+
+    :param deadline: unix timestamp, deadline of previous tick
+    :param delay: polling delay
+    :param now: unix timestamp, current time by default
+    :return: unix timestamp, deadline of next tick
+    """
+    if now is None:
+        now = time.time()
+    if delay <= 0:
+        return now
+    deadline += delay
+    if deadline < now:
+        deadline += (now - deadline) // delay * delay
+    return deadline
 
 
 def build_random_words_by_uids(db: DBManager, uids: list):
     """
     For given database manager instance and user id list builds
-    dict {user_id: (word_from, word_to)}
+    dict {user_id: (word_from, word_to)}. Words are served from vocabulary
+    cache, database is queried only for users which are not cached yet.
+    Users without any words are omitted.
 
     :param db: DBManager instance (already connected!)
     :param uids: user_id's list
     :return: dict({user_id: (word_from, word_to)})
     """
-    res = {uid: db.get_random_word_by_uid(uid) for uid in uids}
+    res = {}
+    for uid in uids:
+        pair = vocabulary_cache.load(db, uid).random_pair()
+        if pair is not None:
+            res[uid] = pair
     return res
 
 
-def dispatch_mainloop(path:str, delay: int, callback: types.FunctionType):
+def build_random_word_lists_by_uids(db: DBManager, counts: dict):
+    """
+    Same as build_random_words_by_uids, but picks several distinct
+    (as far as vocabulary size allows) words for each user
+
+    :param db: DBManager instance (already connected!)
+    :param counts: dict({user_id: number of words})
+    :return: dict({user_id: [(word_from, word_to), ...]})
+    """
+    res = {}
+    for uid, count in counts.items():
+        words = vocabulary_cache.load(db, uid)
+        if not len(words):
+            continue
+        indexes = random.sample(range(len(words)), min(count, len(words)))
+        res[uid] = [words[i] for i in indexes]
+    return res
+
+
+def dispatch_mainloop(path:str, delay: int, callback: types.FunctionType,
+                      select=build_random_word_lists_by_uids):
     """
     mainloop for scheduled word dispatching, intended to be target of Thread
 
+        On every tick all schedule times passed since previous tick are
+    counted for each user, and user receives as many words as many
+    times fired. Last processed moment is persisted, so fires which were
+    missed while bot was down are dispatched (in one batch) after restart.
+    Ticks are aligned to wall clock: fire is dispatched at most `delay`
+    seconds (plus duration of tick) after it is due, a tick which took
+    longer than delay is followed by the next one immediately (see
+    next_deadline).
+
     :param path: database path
     :param delay: polling delay
     :param callback: callable - callback function, which (supposedly)
-                     processes scheduled word dispatch
+                     processes scheduled word dispatch, receives
+                     (uids, {uid: [(word_from, word_to), ...]})
+    :param select: callable(db, {uid: number of fires}), picks words
+                   for users, its result is passed to callback (pass
+                   lambda db, counts: counts to pick words elsewhere)
     :return:
     """
-    db = DBManager(path)
+    multi_dispatch_mainloop({path: callback}, delay, select)
 
-    # first preparation
-    db.connect()
-    uids = db.get_uids()
-    cur_time_str = get_cur_time_str()
 
-    # next schedule time for each user id
-    uids_next_time = {uid: db.get_next_time_by_uid(cur_time_str, uid)
-                      for uid in uids}
-    db.disconnect()
-    while True:
-        # print("DISPATCHER AWAKE")
-        # print("prev uids map:", uids_next_time)
+def dispatch_tick(db: DBManager, since: datetime.datetime,
+                  callback: types.FunctionType,
+                  select=build_random_word_lists_by_uids,
+                  lag_ms: float = 0) -> datetime.datetime:
+    """
+    Dispatches all fires passed since watermark. Tick is skipped (and its
+    fires are caught up by the next one) while database is maintained or
+    if database fails, so dispatcher thread outlives locked database.
+
+    :param db: DBManager instance (disconnected)
+    :param since: watermark
+    :param callback: see dispatch_mainloop
+    :param select: see dispatch_mainloop
+    :param lag_ms: delay of tick behind its schedule (logged)
+    :return: new watermark (unchanged if tick was skipped)
+    """
+    lock = maintenance_lock(db.path)
+    if not lock.acquire(blocking=False):
+        log_event(logger, TICK, path=db.path, skipped='maintenance')
+        return since
+    started = time.perf_counter()
+    until = datetime.datetime.now()
+    try:
         db.connect()
+        try:
+            # number of fires passed since last tick for each user
+            fires = count_all_fires(db, since, until)
+            new_words = select(db, fires) if fires else {}
+            if new_words:
+                callback(list(new_words), new_words)
+            db.set_meta(WATERMARK_KEY, str(until.timestamp()))
+        finally:
+            db.disconnect()
+    except (sqlite3.Error, BaseDatabaseException) as e:
+        log_event(logger, DB_ERROR, logging.ERROR, exc_info=e,
+                  where='dispatcher', path=db.path, error=repr(e))
+        return since
+    finally:
+        lock.release()
+    log_event(logger, TICK, path=db.path, fired=len(fires),
+              notified=len(new_words), lag_ms=lag_ms,
+              duration_ms=round((time.perf_counter() - started) * 1000, 3))
+    return until
+
+
+def _load_watermark(db: DBManager) -> datetime.datetime:
+    db.connect()
+    watermark = db.get_meta(WATERMARK_KEY)
+    db.disconnect()
+    if watermark is None:
+        return datetime.datetime.now()
+    return datetime.datetime.fromtimestamp(float(watermark))
+
 
-        # list with user ids, which needs to be processed now
-        # (scheduled time arrived)
-        uids = []
-        cur_time_str = get_cur_time_str()
-        for uid in db.get_uids():
-            cur_uid_time = db.get_next_time_by_uid(cur_time_str, uid)
-
-            # if new user added:
-            if uid not in uids_next_time:
-                uids_next_time[uid] = None
-                continue
-
-            # if new time was added, user is not supposed to be notified
-            # immediately
-            if uids_next_time[uid] is None and cur_uid_time is not None:
-                uids_next_time[uid] = cur_uid_time
-                continue
-
-            # next time changed => last scheduled time passed => needs
-            # to be processed
-            if cur_uid_time != uids_next_time[uid]:
-                uids_next_time[uid] = cur_uid_time
-                uids.append(uid)
-        new_words = build_random_words_by_uids(db, uids)
-        if new_words:
-            callback(uids, new_words)
-        db.disconnect()
-        # print("upd uids map:", uids_next_time)
-        # print(f"DISPATCHER ASLEEP FOR: {delay} sec")
-        time.sleep(delay)
+def multi_dispatch_mainloop(targets: dict, delay: int,
+                            select=build_random_word_lists_by_uids):
+    """
+    Same as dispatch_mainloop, but one thread (and one timer) serves
+    several databases, they are processed one by one on every tick
 
+    :param targets: dict({database path: callback})
+    :param delay: polling delay
+    :param select: see dispatch_mainloop
+    :return:
+    """
+    dbs = {path: DBManager(path) for path in targets}
+    since = {path: _load_watermark(db) for path, db in dbs.items()}
+    # first tick runs at once, as if its boundary has just passed
+    deadline = time.time()
+    if delay > 0:
+        deadline -= deadline % delay
+    while True:
+        for path, db in dbs.items():
+            # delay of tick behind its wall clock boundary
+            lag_ms = round((time.time() - deadline) * 1000, 3)
+            since[path] = dispatch_tick(db, since[path], targets[path],
+                                        select, lag_ms)
+        deadline = next_deadline(deadline, delay)
+        time.sleep(max(deadline - time.time(), 0))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Structured logging.
+
+    Events are JSON objects with category (handler invocation, dispatcher
+tick, database error, ...) and arbitrary fields. Logging call only checks
+per-category sampling and rate limits and puts record into a queue, all
+formatting and I/O is done by background listener thread, so hot paths
+(polling, dispatching) never wait for log writes.
+"""
+
+
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from threading import Lock
+
+
+# root of all project loggers
+LOGGER_NAME = 'language_bot'
+
+# event categories
+HANDLER = 'handler'
+TICK = 'tick'
+DB_ERROR = 'db_error'
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(LOGGER_NAME + '.' + name)
+
+
+def log_event(logger: logging.Logger, category: str, level=logging.INFO,
+              exc_info=None, **fields) -> None:
+    """
+    Logs structured event
+
+    :param logger: logger
+    :param category: event category (used for sampling and rate limiting)
+    :param level: logging level
+    :param exc_info: exception info to attach, as in logging
+    :param fields: event fields (json serializable)
+    :return: None
+    """
+    logger.log(level, category, exc_info=exc_info,
+               extra={'category': category, 'fields': fields})
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats record as one line JSON object"""
+
+    def format(self, record):
+        event = {'ts': round(record.created, 6),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'category': getattr(record, 'category', None),
+                 'thread': record.threadName}
+        fields = getattr(record, 'fields', None)
+        if fields is None:
+            event['message'] = record.getMessage()
+        else:
+            event.update(fields)
+        dropped = getattr(record, 'dropped', 0)
+        if dropped:
+            event['dropped'] = dropped
+        if record.exc_text:
+            event['exc'] = record.exc_text
+        elif record.exc_info:
+            event['exc'] = self.formatException(record.exc_info)
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class CategoryFilter(logging.Filter):
+    """
+    Per-category sampling and rate limiting.
+
+        sampling: {category: share of events passed (0..1)},
+    rate_limits: {category: max events per second}. Categories not
+    mentioned are passed as is. Number of events dropped by rate limit is
+    attached to the next passed event of the same category. Records of
+    WARNING level and higher are never sampled out.
+    """
+
+    def __init__(self, sampling: dict = None, rate_limits: dict = None):
+        super().__init__()
+        self.sampling = sampling or {}
+        self.rate_limits = rate_limits or {}
+        self.lock = Lock()
+        self._allowance = {}    # category: (tokens, last check time)
+        self._dropped = {}      # category: dropped events count
+
+    def _within_rate(self, category, rate) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self._allowance.get(category, (rate, now))
+            tokens = min(rate, tokens + (now - last) * rate)
+            if tokens < 1:
+                self._allowance[category] = (tokens, now)
+                self._dropped[category] = self._dropped.get(category, 0) + 1
+                return False
+            self._allowance[category] = (tokens - 1, now)
+            return True
+
+    def filter(self, record):
+        category = getattr(record, 'category', None)
+        if category is None:
+            return True
+        rate = self.sampling.get(category, 1)
+        if record.levelno < logging.WARNING and rate < 1 and \
+                random.random() >= rate:
+            return False
+        limit = self.rate_limits.get(category, None)
+        if limit is not None and not self._within_rate(category, limit):
+            return False
+        with self.lock:
+            record.dropped = self._dropped.pop(category, 0)
+        return True
+
+
+class EventQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler which keeps event fields and exception text apart
+    from message (default one merges traceback into message)
+    """
+
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def setup_logging(path: str = None, level=logging.INFO,
+                  sampling: dict = None, rate_limits: dict = None,
+                  stream=None) -> logging.handlers.QueueListener:
+    """
+    Configures project loggers to write JSON events from background thread
+
+    :param path: log file path, events are written to stream if not given
+    :param level: minimal logging level
+    :param sampling: {category: share of events passed}
+    :param rate_limits: {category: max events per second}
+    :param stream: output stream (sys.stderr by default)
+    :return: started QueueListener (stop it to flush pending events)
+    """
+    if path is None:
+        output = logging.StreamHandler(stream or sys.stderr)
+    else:
+        output = logging.FileHandler(path, encoding='utf-8')
+    output.setFormatter(JsonFormatter())
+
+    events = queue.SimpleQueue()
+    handler = EventQueueHandler(events)
+    handler.addFilter(CategoryFilter(sampling, rate_limits))
+
+    logger = logging.getLogger(LOGGER_NAME)
+    for old in list(logger.handlers):
+        if isinstance(old, EventQueueHandler):
+            logger.removeHandler(old)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(events, output)
+    listener.start()
+    return listener
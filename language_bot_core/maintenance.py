@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Periodic database maintenance: learned words are moved into archive (so
+hot queries touch only active words) and storage is compacted. Runs once
+a day at off-peak time.
+"""
+
+
+import datetime
+import logging
+import sqlite3
+import time
+import types
+from threading import Lock
+
+from .dbmanager import DBManager, BaseDatabaseException
+from .constants import MAINTENANCE_TIME
+from .logs import get_logger, log_event, DB_ERROR
+
+
+logger = get_logger('maintenance')
+
+# log event category
+MAINTENANCE = 'maintenance'
+
+# database path: lock held while database is maintained
+_locks = {}
+_locks_guard = Lock()
+
+
+def maintenance_lock(path: str) -> Lock:
+    """
+    :param path: database path
+    :return: lock, which is held while database is maintained (i.e.
+             dispatcher skips its ticks instead of failing on locked
+             database)
+    """
+    with _locks_guard:
+        return _locks.setdefault(path, Lock())
+
+
+def seconds_until(time_str: str, now: datetime.datetime) -> float:
+    """
+    :param time_str: daily time 'hh:mm:ss'
+    :param now: current moment
+    :return: seconds until the next occurrence of given time
+    """
+    moment = datetime.datetime.combine(now.date(),
+                                       datetime.time.fromisoformat(time_str))
+    if moment <= now:
+        moment += datetime.timedelta(days=1)
+    return (moment - now).total_seconds()
+
+
+def run_maintenance(db: DBManager) -> dict:
+    """
+    :param db: DBManager instance (already connected!)
+    :return: dict({user_id: number of archived words})
+    """
+    archived = db.archive_learned_words()
+    db.compact()
+    return archived
+
+
+def maintenance_mainloop(path, callback: types.FunctionType = None,
+                         at: str = MAINTENANCE_TIME):
+    """
+    mainloop of daily maintenance, intended to be target of Thread
+
+    :param path: database path or list of paths (maintained one by one)
+    :param callback: callable, receives dict({user_id: number of archived
+                     words}) (i.e. to invalidate caches of other processes)
+    :param at: daily time of maintenance 'hh:mm:ss'
+    :return:
+    """
+    paths = [path] if isinstance(path, str) else list(path)
+    while True:
+        time.sleep(seconds_until(at, datetime.datetime.now()))
+        for p in paths:
+            started = time.perf_counter()
+            db = DBManager(p)
+            try:
+                with maintenance_lock(p):
+                    db.connect()
+                    try:
+                        archived = run_maintenance(db)
+                    finally:
+                        db.disconnect()
+            except (sqlite3.Error, BaseDatabaseException) as e:
+                # maintenance is retried next day
+                log_event(logger, DB_ERROR, logging.ERROR, exc_info=e,
+                          where='maintenance', path=p, error=repr(e))
+                continue
+            if archived and callback is not None:
+                callback(archived)
+            log_event(logger, MAINTENANCE, path=p, users=len(archived),
+                      archived=sum(archived.values()),
+                      duration_ms=round((time.perf_counter() - started)
+                                        * 1000, 3))
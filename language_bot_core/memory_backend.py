@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Pure in-memory storage backend.
+
+    All data lives in process memory (dict of arrays per user), every
+modification is appended to journal file and full snapshot is written
+periodically, so data survives restarts. Snapshot is stored at database
+path, journal at database path + '.journal'. Path ':memory:' disables
+persistence.
+"""
+
+
+import heapq
+import json
+import os
+import random
+import re
+import sys
+import time
+import unicodedata
+from threading import RLock
+
+from .constants import MEMORY_SNAPSHOT_INTERVAL, MEMORY_SNAPSHOT_OPERATIONS
+from .dbmanager import StorageBackend, DisconnectedDB, BACKENDS, \
+    QUESTION_EVENT, ANSWER_EVENT
+from .schedule import ScheduleRule, count_time_fires
+
+
+MEMORY_PATH = ':memory:'
+
+
+def _fold(text: str) -> str:
+    """Case and diacritics insensitive form of text"""
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+class MemoryStore:
+    """
+    In-memory database. One store is shared by all managers connected to
+    the same path within process.
+    """
+
+    _stores = {}
+    _stores_lock = RLock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = RLock()
+        self.uids = {}          # uid: None, insertion ordered set
+        self.schedule = {}      # uid: [time, ...]
+        self.rules = {}         # rule_id: [uid, start, end, interval,
+                                #           weekdays]
+        self.words = {}         # uid: {'from': [...], 'to': [...]}
+        self.archive = {}       # uid: [[word_from, word_to, archived], ...]
+        self.meta = {}
+        self.broadcasts = {}    # broadcast_id: dict
+        self.deliveries = {}    # broadcast_id: {uid: [status, error]}
+        self.events = []        # [uid, word_from, word_to, kind, correct,
+                                #  answer_time, created]
+        self.user_stats = {}    # uid: dict
+        self.word_stats = {}    # (uid, word_from, word_to): dict
+        self._journal = None
+        self._journaled = 0
+        self._snapshot_time = time.monotonic()
+        if path != MEMORY_PATH:
+            self._load()
+
+    @classmethod
+    def open(cls, path: str):
+        if path == MEMORY_PATH:
+            return cls(path)
+        with cls._stores_lock:
+            store = cls._stores.get(path, None)
+            if store is None:
+                store = cls._stores[path] = cls(path)
+            return store
+
+    # persistence
+
+    @property
+    def journal_path(self):
+        return self.path + '.journal'
+
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                self._restore(json.load(f))
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        op, args = json.loads(line)
+                    except ValueError:  # partially written last operation
+                        break
+                    getattr(self, '_apply_' + op)(*args)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _dump(self) -> dict:
+        return {'uids': list(self.uids),
+                'schedule': list(self.schedule.items()),
+                'rules': list(self.rules.items()),
+                'words': list(self.words.items()),
+                'archive': list(self.archive.items()),
+                'meta': self.meta,
+                'broadcasts': list(self.broadcasts.values()),
+                'deliveries': [[k, list(v.items())]
+                               for k, v in self.deliveries.items()],
+                'events': self.events,
+                'user_stats': list(self.user_stats.items()),
+                'word_stats': [list(k) + [v]
+                               for k, v in self.word_stats.items()]}
+
+    def _restore(self, data: dict):
+        self.uids = dict.fromkeys(data['uids'])
+        self.schedule = dict(data['schedule'])
+        self.rules = dict(data.get('rules', []))
+        self.words = dict(data['words'])
+        self.archive = dict(data.get('archive', []))
+        self.meta = data['meta']
+        self.broadcasts = {b['broadcast_id']: b
+                           for b in data.get('broadcasts', [])}
+        self.deliveries = {k: dict(v) for k, v in data.get('deliveries', [])}
+        self.events = data['events']
+        self.user_stats = dict(data['user_stats'])
+        self.word_stats = {tuple(item[:3]): item[3]
+                           for item in data['word_stats']}
+
+    def snapshot(self) -> None:
+        """
+        Writes full snapshot (atomically) and truncates journal
+
+        :return: None
+        """
+        if self.path == MEMORY_PATH:
+            return
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._dump(), f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._journal.close()
+            self._journal = open(self.journal_path, 'w', encoding='utf-8')
+            self._journaled = 0
+            self._snapshot_time = time.monotonic()
+
+    def apply(self, op: str, *args):
+        """
+        Performs modifying operation and journals it
+
+        :param op: operation name, implemented by _apply_<op> method
+        :param args: operation arguments (json serializable)
+        :return: operation result
+        """
+        with self.lock:
+            res = getattr(self, '_apply_' + op)(*args)
+            if self._journal is not None:
+                self._journal.write(json.dumps([op, args],
+                                               ensure_ascii=False) + '\n')
+                self._journal.flush()
+                self._journaled += 1
+                if self._journaled >= MEMORY_SNAPSHOT_OPERATIONS or \
+                        time.monotonic() - self._snapshot_time > \
+                        MEMORY_SNAPSHOT_INTERVAL:
+                    self.snapshot()
+            return res
+
+    # modifying operations
+
+    def _apply_register(self, uid):
+        registered = uid not in self.uids
+        self.uids[uid] = None
+        return registered
+
+    def _apply_add_time(self, uid, time_string):
+        times = self.schedule.setdefault(uid, [])
+        if time_string not in times:
+            times.append(time_string)
+
+    def _apply_delete_time(self, uid, time_string):
+        times = self.schedule.get(uid, [])
+        status = times.count(time_string)
+        times[:] = [t for t in times if t != time_string]
+        return status
+
+    def _apply_add_rule(self, uid, rule):
+        rule_id = max(self.rules, default=0) + 1
+        self.rules[rule_id] = [uid] + rule
+        return rule_id
+
+    def _apply_delete_rule(self, uid, rule_id):
+        if self.rules.get(rule_id, [None])[0] != uid:
+            return 0
+        del self.rules[rule_id]
+        return 1
+
+    def _apply_add_words(self, uid, words):
+        arrays = self.words.setdefault(uid, {'from': [], 'to': []})
+        # equal words of different users share one string object
+        for word_from, word_to in words:
+            arrays['from'].append(sys.intern(word_from))
+            arrays['to'].append(sys.intern(word_to))
+
+    def _apply_set_meta(self, key, value):
+        self.meta[key] = value
+
+    def _apply_create_broadcast(self, text, ts):
+        broadcast_id = max(self.broadcasts, default=0) + 1
+        self.broadcasts[broadcast_id] = {
+            'broadcast_id': broadcast_id, 'text': text, 'created': ts,
+            'cursor': None, 'finished': None}
+        return broadcast_id
+
+    def _apply_checkpoint_broadcast(self, broadcast_id, cursor, deliveries):
+        statuses = self.deliveries.setdefault(broadcast_id, {})
+        for uid, status, error in deliveries:
+            statuses[uid] = [status, error]
+        self.broadcasts[broadcast_id]['cursor'] = cursor
+
+    def _apply_finish_broadcast(self, broadcast_id, ts):
+        self.broadcasts[broadcast_id]['finished'] = ts
+
+    def _user_stats(self, uid):
+        return self.user_stats.setdefault(uid, {
+            'questions': 0, 'answers': 0, 'correct_answers': 0,
+            'learned_words': 0, 'total_answer_time': 0})
+
+    def _word_stats(self, uid, word_from, word_to):
+        return self.word_stats.setdefault((uid, word_from, word_to), {
+            'questions': 0, 'answers': 0, 'correct_answers': 0,
+            'total_answer_time': 0, 'attempts_to_learn': None,
+            'last_asked': None})
+
+    def _apply_record_questions(self, words, ts):
+        for uid, pairs in words:
+            for word_from, word_to in pairs:
+                self.events.append([uid, word_from, word_to, QUESTION_EVENT,
+                                    None, None, ts])
+                self._user_stats(uid)['questions'] += 1
+                stats = self._word_stats(uid, word_from, word_to)
+                stats['questions'] += 1
+                stats['last_asked'] = ts
+
+    def _apply_record_answer(self, uid, word, correct, ts):
+        word_from, word_to = word
+        stats = self._word_stats(uid, word_from, word_to)
+        last_asked = stats['last_asked']
+        answer_time = None if last_asked is None else max(ts - last_asked, 0)
+        newly_learned = correct and stats['attempts_to_learn'] is None
+        self.events.append([uid, word_from, word_to, ANSWER_EVENT,
+                            int(correct), answer_time, ts])
+        stats['answers'] += 1
+        stats['correct_answers'] += int(correct)
+        stats['total_answer_time'] += answer_time or 0
+        if newly_learned:
+            stats['attempts_to_learn'] = stats['answers']
+        user_stats = self._user_stats(uid)
+        user_stats['answers'] += 1
+        user_stats['correct_answers'] += int(correct)
+        user_stats['learned_words'] += int(newly_learned)
+        user_stats['total_answer_time'] += answer_time or 0
+        return answer_time
+
+    def _apply_archive_learned_words(self, min_correct, min_accuracy, ts):
+        archived = {}
+        for uid, arrays in self.words.items():
+            keep_from, keep_to = [], []
+            for word_from, word_to in zip(arrays['from'], arrays['to']):
+                stats = self.word_stats.get((uid, word_from, word_to), None)
+                if stats is not None and \
+                        stats['correct_answers'] >= min_correct and \
+                        stats['correct_answers'] >= \
+                        min_accuracy * stats['answers']:
+                    self.archive.setdefault(uid, []).append(
+                        [word_from, word_to, ts])
+                    archived[uid] = archived.get(uid, 0) + 1
+                else:
+                    keep_from.append(word_from)
+                    keep_to.append(word_to)
+            if uid in archived:
+                arrays['from'], arrays['to'] = keep_from, keep_to
+        # json does not support integer keys
+        return list(archived.items())
+
+    def _apply_compact_answer_events(self, before):
+        left = [event for event in self.events if event[-1] >= before]
+        removed = len(self.events) - len(left)
+        self.events = left
+        return removed
+
+
+class ConnectedMemoryDB(StorageBackend):
+    """Class which represents connected database state (in-memory backend)"""
+
+    @staticmethod
+    def open(db_manager):
+        db_manager.store = MemoryStore.open(db_manager.path)
+        db_manager.new_state(ConnectedMemoryDB)
+
+    @staticmethod
+    def disconnect(db_manager):
+        db_manager.store = None
+        db_manager.new_state(DisconnectedDB)
+
+    @staticmethod
+    def get_uids(db_manager):
+        with db_manager.store.lock:
+            return list(db_manager.store.uids)
+
+    @staticmethod
+    def get_uids_after(db_manager, after, limit: int):
+        with db_manager.store.lock:
+            uids = db_manager.store.uids
+            if after is not None:
+                uids = (uid for uid in uids if uid > after)
+            return heapq.nsmallest(limit, uids)
+
+    @staticmethod
+    def get_schedule_by_uid(db_manager, uid):
+        with db_manager.store.lock:
+            return list(db_manager.store.schedule.get(uid, []))
+
+    @staticmethod
+    def is_registered(db_manager, uid):
+        return uid in db_manager.store.uids
+
+    @staticmethod
+    def register(db_manager, uid):
+        if db_manager.is_registered(uid):
+            return False
+        return db_manager.store.apply('register', uid)
+
+    @staticmethod
+    def get_all_words_by_uid(db_manager, uid):
+        with db_manager.store.lock:
+            arrays = db_manager.store.words.get(uid, None)
+            if arrays is None:
+                return []
+            return list(zip(arrays['from'], arrays['to']))
+
+    @staticmethod
+    def add_scheduled_time_by_uid(db_manager, uid: int, time_string: str):
+        db_manager.store.apply('add_time', uid, time_string)
+
+    @staticmethod
+    def delete_scheduled_time_by_uid(db_manager, uid: int, time_string: str):
+        return db_manager.store.apply('delete_time', uid, time_string)
+
+    @staticmethod
+    def add_schedule_rule(db_manager, uid: int, rule: ScheduleRule):
+        return db_manager.store.apply('add_rule', uid, list(rule))
+
+    @staticmethod
+    def delete_schedule_rule(db_manager, uid: int, rule_id: int):
+        return db_manager.store.apply('delete_rule', uid, rule_id)
+
+    @staticmethod
+    def get_schedule_rules_by_uid(db_manager, uid: int):
+        with db_manager.store.lock:
+            return [(rule_id, ScheduleRule(*rule[1:]))
+                    for rule_id, rule in sorted(db_manager.store.rules.items())
+                    if rule[0] == uid]
+
+    @staticmethod
+    def get_schedule_rules(db_manager):
+        res = {}
+        with db_manager.store.lock:
+            for _, rule in sorted(db_manager.store.rules.items()):
+                if rule[0] not in db_manager.store.uids:
+                    continue
+                res.setdefault(rule[0], []).append(ScheduleRule(*rule[1:]))
+        return res
+
+    @staticmethod
+    def count_scheduled_fires(db_manager, segments: list):
+        res = {}
+        with db_manager.store.lock:
+            for uid, times in db_manager.store.schedule.items():
+                if uid not in db_manager.store.uids:
+                    continue
+                fires = count_time_fires(times, segments)
+                if fires:
+                    res[uid] = fires
+        return res
+
+    @staticmethod
+    def add_words(db_manager, uid: int, words: list):
+        db_manager.store.apply('add_words', uid, [list(w) for w in words])
+
+    @staticmethod
+    def iter_words_by_uid(db_manager, uid: int, chunk_size: int):
+        words = ConnectedMemoryDB.get_all_words_by_uid(db_manager, uid)
+        with db_manager.store.lock:
+            archived = [(w[0], w[1])
+                        for w in db_manager.store.archive.get(uid, [])]
+        yield from words
+        yield from archived
+
+    @staticmethod
+    def get_next_time_by_uid(db_manager, cur_time_str, uid):
+        with db_manager.store.lock:
+            times = [t for t in db_manager.store.schedule.get(uid, [])
+                     if t >= cur_time_str]
+        return min(times) if times else None
+
+    @staticmethod
+    def get_random_word_by_uid(db_manager, uid: int):
+        with db_manager.store.lock:
+            arrays = db_manager.store.words.get(uid, None)
+            if not arrays or not arrays['from']:
+                return None
+            i = random.randrange(len(arrays['from']))
+            return arrays['from'][i], arrays['to'][i]
+
+    @staticmethod
+    def search_words(db_manager, uid: int, query: str, limit: int):
+        prefixes = [_fold(token) for token in re.findall(r'[^\W_]+', query)]
+        if not prefixes:
+            return []
+        res = []
+        for pair in ConnectedMemoryDB.get_all_words_by_uid(db_manager, uid):
+            tokens = re.findall(r'[^\W_]+', _fold(' '.join(pair)))
+            if all(any(t.startswith(p) for t in tokens) for p in prefixes):
+                res.append(pair)
+                if len(res) == limit:
+                    break
+        return res
+
+    @staticmethod
+    def is_lexicon_storage(db_manager):
+        return True
+
+    @staticmethod
+    def migrate_to_lexicon(db_manager):
+        # strings are interned, so storage is always normalized
+        return False
+
+    @staticmethod
+    def get_meta(db_manager, key: str):
+        return db_manager.store.meta.get(key, None)
+
+    @staticmethod
+    def set_meta(db_manager, key: str, value: str):
+        db_manager.store.apply('set_meta', key, value)
+
+    @staticmethod
+    def record_questions(db_manager, words: dict, ts: float):
+        # json does not support integer keys, so dict is journaled as list
+        words = [[uid, [list(p) for p in pairs]]
+                 for uid, pairs in words.items()]
+        db_manager.store.apply('record_questions', words, ts)
+
+    @staticmethod
+    def record_answer(db_manager, uid: int, word: tuple, correct: bool,
+                      ts: float):
+        return db_manager.store.apply('record_answer', uid, list(word),
+                                      correct, ts)
+
+    @staticmethod
+    def get_stats_by_uid(db_manager, uid: int):
+        with db_manager.store.lock:
+            stats = db_manager.store.user_stats.get(uid, None)
+            return None if stats is None else dict(stats)
+
+    @staticmethod
+    def get_word_stats_by_uid(db_manager, uid: int, word: tuple):
+        with db_manager.store.lock:
+            stats = db_manager.store.word_stats.get((uid, *word), None)
+            if stats is None:
+                return None
+            stats = dict(stats)
+            stats.pop('last_asked')
+            return stats
+
+    @staticmethod
+    def compact_answer_events(db_manager, before: float):
+        return db_manager.store.apply('compact_answer_events', before)
+
+    @staticmethod
+    def create_broadcast(db_manager, text: str, ts: float):
+        return db_manager.store.apply('create_broadcast', text, ts)
+
+    @staticmethod
+    def get_broadcast(db_manager, broadcast_id: int):
+        with db_manager.store.lock:
+            broadcast = db_manager.store.broadcasts.get(broadcast_id, None)
+            return None if broadcast is None else dict(broadcast)
+
+    @staticmethod
+    def get_unfinished_broadcasts(db_manager):
+        with db_manager.store.lock:
+            return sorted(k for k, v in db_manager.store.broadcasts.items()
+                          if v['finished'] is None)
+
+    @staticmethod
+    def checkpoint_broadcast(db_manager, broadcast_id: int, cursor: int,
+                             deliveries: list):
+        db_manager.store.apply('checkpoint_broadcast', broadcast_id, cursor,
+                               [list(item) for item in deliveries])
+
+    @staticmethod
+    def finish_broadcast(db_manager, broadcast_id: int, ts: float):
+        db_manager.store.apply('finish_broadcast', broadcast_id, ts)
+
+    @staticmethod
+    def get_broadcast_stats(db_manager, broadcast_id: int):
+        with db_manager.store.lock:
+            stats = {}
+            for status, _ in db_manager.store.deliveries.get(broadcast_id,
+                                                             {}).values():
+                stats[status] = stats.get(status, 0) + 1
+            return stats
+
+    @staticmethod
+    def archive_learned_words(db_manager, min_correct: int,
+                              min_accuracy: float, ts: float):
+        return dict(db_manager.store.apply('archive_learned_words',
+                                           min_correct, min_accuracy, ts))
+
+    @staticmethod
+    def compact(db_manager):
+        # journal is folded into snapshot
+        db_manager.store.snapshot()
+
+
+BACKENDS['memory'] = ConnectedMemoryDB
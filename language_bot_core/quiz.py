@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Multiple-choice questions: wrong answers (distractors) are picked from
+user's own vocabulary.
+
+    Distractor index is built once per cached vocabulary: positions of
+pairs are sorted by (length class, first letter) of translation, so pairs
+with similar looking translations occupy one contiguous range and each
+length class is a contiguous range too. Picking distractors for a question
+is a dict lookup and sampling of a few positions from the range of
+question's bucket (falling back to its length class and then to whole
+vocabulary), no vocabulary scans are made.
+"""
+
+
+import random
+import weakref
+from array import array
+from threading import Lock
+
+from .cache import PackedWords
+from .constants import DISTRACTOR_LENGTH_STEP
+
+
+def _bucket(translation: str) -> tuple:
+    """
+    :param translation: word_to
+    :return: (length class, first letter)
+    """
+    translation = translation.casefold()
+    return (len(translation) // DISTRACTOR_LENGTH_STEP,
+            translation[:1])
+
+
+class DistractorIndex:
+    """Positions of user's pairs bucketed by shape of their translation"""
+
+    __slots__ = ('order', 'buckets', 'lengths')
+
+    def __init__(self, words: PackedWords):
+        keys = [_bucket(pair[1]) for pair in words]
+        self.order = array('L', sorted(range(len(keys)),
+                                       key=keys.__getitem__))
+        # key: (start, end) range of positions in self.order
+        self.buckets = {}
+        self.lengths = {}
+        for pos, i in enumerate(self.order):
+            key = keys[i]
+            start, _ = self.buckets.get(key, (pos, pos))
+            self.buckets[key] = (start, pos + 1)
+            start, _ = self.lengths.get(key[0], (pos, pos))
+            self.lengths[key[0]] = (start, pos + 1)
+
+    def distractors(self, words: PackedWords, pair: tuple, n: int) -> list:
+        """
+        :param words: vocabulary index is built for (index does not keep
+                      reference to it, so vocabulary can be collected)
+        :param pair: question (word_from, word_to)
+        :param n: number of distractors
+        :return: up to n pairs of vocabulary with translations different
+                 from pair's one (and each other)
+        """
+        key = _bucket(pair[1])
+        ranges = (self.buckets.get(key, (0, 0)),
+                  self.lengths.get(key[0], (0, 0)),
+                  (0, len(self.order)))
+        seen = {pair[1].casefold()}
+        picked = set()
+        res = []
+        for start, end in ranges:
+            # a few extra samples cover duplicates of question itself
+            count = min(end - start, n - len(res) + 2)
+            for pos in random.sample(range(start, end), count):
+                if pos in picked:
+                    continue
+                picked.add(pos)
+                candidate = words[self.order[pos]]
+                if candidate[0] == pair[0] or \
+                        candidate[1].casefold() in seen:
+                    continue
+                seen.add(candidate[1].casefold())
+                res.append(candidate)
+                if len(res) == n:
+                    return res
+        return res
+
+
+# indexes live as long as vocabularies they are built for (i.e. until
+# vocabulary is evicted from cache or invalidated)
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = Lock()
+
+
+def distractor_index(words: PackedWords) -> DistractorIndex:
+    """
+    :param words: user's vocabulary
+    :return: index of vocabulary, built on first call
+    """
+    with _indexes_lock:
+        index = _indexes.get(words, None)
+        if index is None:
+            index = _indexes[words] = DistractorIndex(words)
+        return index
+
+
+def build_choices(words: PackedWords, pair: tuple, n: int) -> list:
+    """
+    :param words: user's vocabulary
+    :param pair: question (word_from, word_to)
+    :param n: total number of choices
+    :return: shuffled [(word_from, word_to), ...] -- question and up to
+             n - 1 distractors
+    """
+    choices = distractor_index(words).distractors(words, pair, n - 1)
+    choices.append(tuple(pair))
+    random.shuffle(choices)
+    return choices
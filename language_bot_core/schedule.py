@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Rule-based schedules.
+
+    Periodic schedule ("every 30 minutes from 08:00 to 22:00 on weekdays")
+is stored as one rule instead of one row per time slot. Rule fires at
+start, start + interval, ... while not later than end, on days enabled in
+weekdays mask (bit 0 - Monday, ..., bit 6 - Sunday). Fires are computed
+arithmetically: next fire of a rule takes constant time, number of fires
+in an interval takes time proportional to number of days in it.
+
+    One-off times are 'hh:mm:ss' strings, so they are matched against
+time-of-day ranges of an interval by string comparison (and by one range
+query in database).
+"""
+
+
+import datetime
+import re
+from collections import namedtuple
+
+
+DAY_SECONDS = 24 * 60 * 60
+EVERY_DAY = 0b1111111
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+# last moment of a day one-off time may have, malformed times never fire
+END_OF_DAY = '23:59:59'
+TIME_GLOB = '[0-2][0-9]:[0-5][0-9]:[0-5][0-9]'
+_TIME_PATTERN = re.compile(r'[0-2]\d:[0-5]\d:[0-5]\d')
+
+
+# start, end: seconds since midnight (end is inclusive), interval: seconds,
+# weekdays: bit mask of enabled days
+ScheduleRule = namedtuple('ScheduleRule', 'start end interval weekdays')
+
+
+class ScheduleRuleError(ValueError):
+    pass
+
+
+def parse_time(time_str: str) -> int:
+    """
+    :param time_str: 'hh:mm' or 'hh:mm:ss'
+    :return: seconds since midnight
+    :raise ScheduleRuleError: if time is malformed
+    """
+    try:
+        moment = datetime.time.fromisoformat(time_str)
+    except ValueError:
+        raise ScheduleRuleError("Invalid time: {}".format(time_str))
+    return moment.hour * 3600 + moment.minute * 60 + moment.second
+
+
+def format_time(seconds: int) -> str:
+    return '{:02}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60,
+                                      seconds % 60)
+
+
+def parse_weekdays(spec: str) -> int:
+    """
+    :param spec: comma separated days or ranges, e.g. 'mon-fri' or
+                 'sat,sun'
+    :return: weekdays mask
+    :raise ScheduleRuleError: if day is unknown
+    """
+    mask = 0
+    for part in spec.lower().split(','):
+        first, _, last = part.strip().partition('-')
+        try:
+            first = WEEKDAYS.index(first[:3])
+            last = WEEKDAYS.index(last[:3]) if last else first
+        except ValueError:
+            raise ScheduleRuleError("Invalid days: {}".format(spec))
+        for day in range(first, last + 1 if last >= first else last + 8):
+            mask |= 1 << day % 7
+    return mask
+
+
+def format_weekdays(mask: int) -> str:
+    if mask == EVERY_DAY:
+        return 'every day'
+    return ','.join(day for i, day in enumerate(WEEKDAYS) if mask & 1 << i)
+
+
+def make_rule(start: str, end: str, minutes: int,
+              weekdays: int = EVERY_DAY) -> ScheduleRule:
+    """
+    :param start: first daily fire 'hh:mm[:ss]'
+    :param end: last possible daily fire 'hh:mm[:ss]'
+    :param minutes: interval between fires
+    :param weekdays: enabled days mask
+    :return: ScheduleRule
+    :raise ScheduleRuleError: if rule is inconsistent
+    """
+    rule = ScheduleRule(parse_time(start), parse_time(end), minutes * 60,
+                        weekdays)
+    if rule.interval <= 0:
+        raise ScheduleRuleError("Interval has to be positive")
+    if rule.end < rule.start:
+        raise ScheduleRuleError("Rule has to end after it starts")
+    if not 0 < rule.weekdays <= EVERY_DAY:
+        raise ScheduleRuleError("Rule has to fire at least one day a week")
+    return rule
+
+
+def format_rule(rule: ScheduleRule) -> str:
+    return 'every {} min from {} to {}, {}'.format(
+        rule.interval // 60, format_time(rule.start), format_time(rule.end),
+        format_weekdays(rule.weekdays))
+
+
+def _fires_until(rule: ScheduleRule, seconds: float) -> int:
+    """
+    :return: number of rule fires within one (enabled) day up to given
+             second since midnight inclusive
+    """
+    if seconds < rule.start:
+        return 0
+    return int((min(seconds, rule.end) - rule.start) // rule.interval) + 1
+
+
+def _seconds(moment: datetime.datetime) -> float:
+    return moment.hour * 3600 + moment.minute * 60 + moment.second + \
+        moment.microsecond / 1e6
+
+
+def next_fire(rule: ScheduleRule, after: datetime.datetime):
+    """
+    :param rule: ScheduleRule
+    :param after: moment
+    :return: first fire strictly after given moment (datetime) or None,
+             if rule never fires
+    """
+    midnight = datetime.datetime.combine(after.date(), datetime.time())
+    # fires of rest of current day are passed as already fired
+    passed = _fires_until(rule, _seconds(after))
+    # rule fires at least once a week, so at most 8 days are checked
+    for days in range(8):
+        day = midnight + datetime.timedelta(days=days)
+        if rule.weekdays & 1 << day.weekday():
+            fire = rule.start + passed * rule.interval
+            if fire <= rule.end:
+                return day + datetime.timedelta(seconds=fire)
+        passed = 0
+    return None
+
+
+def count_rule_fires(rule: ScheduleRule, since: datetime.datetime,
+                     until: datetime.datetime) -> int:
+    """
+    :param rule: ScheduleRule
+    :param since: interval start (exclusive)
+    :param until: interval end (inclusive)
+    :return: number of rule fires in (since, until]
+    """
+    fires = 0
+    day = since.date()
+    while day <= until.date():
+        if rule.weekdays & 1 << day.weekday():
+            upper = _seconds(until) if day == until.date() else DAY_SECONDS
+            fires += _fires_until(rule, upper)
+            if day == since.date():
+                fires -= _fires_until(rule, _seconds(since))
+        day += datetime.timedelta(days=1)
+    return max(fires, 0)
+
+
+def day_segments(since: datetime.datetime,
+                 until: datetime.datetime) -> list:
+    """
+    Splits interval into time-of-day ranges: one-off time t fires
+    `multiplier` times in (since, until] for every range with
+    after < t <= upto
+
+    :param since: interval start (exclusive)
+    :param until: interval end (inclusive)
+    :return: [(after, upto, multiplier), ...], bounds are isoformat times
+    """
+    if until <= since:
+        return []
+    after, upto = since.time().isoformat(), until.time().isoformat()
+    if since.date() == until.date():
+        return [(after, upto, 1)]
+    segments = [(after, END_OF_DAY, 1), ('', upto, 1)]
+    days = (until.date() - since.date()).days - 1
+    if days:
+        segments.append(('', END_OF_DAY, days))
+    return segments
+
+
+def count_time_fires(times: list, segments: list) -> int:
+    """
+    :param times: one-off times, list of 'hh:mm:ss' strings
+    :param segments: see day_segments
+    :return: number of fires
+    """
+    return sum(multiplier for t in times if _TIME_PATTERN.fullmatch(t)
+               for after, upto, multiplier in segments if after < t <= upto)
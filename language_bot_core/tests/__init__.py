@@ -5,7 +5,9 @@
 from itertools import product
 import unittest
 
-from .tests import DBManagerTester, DispatcherTester, ParserTester
+from .tests import DBManagerTester, DispatcherTester, ParserTester, \
+    VocabularyCacheTester, MemoryBackendTester, LogsTester, \
+    BackupTester, DictionaryTester, QuizTester, ScheduleTester
 
 
 def test_language_core(db_path):
@@ -19,7 +21,15 @@ def test_language_core(db_path):
     tests = [DBManagerTester(p1, p2) for p1, p2 in params]
     suite.addTests(tests)
 
+    suite.addTests(BackupTester(db_path, name)
+                   for name in loader.getTestCaseNames(BackupTester))
+    suite.addTest(loader.loadTestsFromTestCase(MemoryBackendTester))
+    suite.addTest(loader.loadTestsFromTestCase(VocabularyCacheTester))
     suite.addTest(loader.loadTestsFromTestCase(DispatcherTester))
+    suite.addTest(loader.loadTestsFromTestCase(LogsTester))
+    suite.addTest(loader.loadTestsFromTestCase(DictionaryTester))
+    suite.addTest(loader.loadTestsFromTestCase(QuizTester))
+    suite.addTest(loader.loadTestsFromTestCase(ScheduleTester))
     suite.addTest(loader.loadTestsFromTestCase(ParserTester))
 
     test_runner = unittest.TextTestRunner(verbosity=2)
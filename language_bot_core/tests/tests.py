@@ -2,8 +2,24 @@
 # -*-encoding: utf-8-*-
 
 
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
 import language_bot_core
+from language_bot_core import transfer, logs, maintenance, backup, \
+    dictionary, quiz, schedule
+from language_bot_core.cache import PackedWords, VocabularyCache
 
 
 class DBManagerTester(unittest.TestCase):
@@ -38,6 +54,27 @@ class DBManagerTester(unittest.TestCase):
         retrieved = self.data.get_uids()
         self.assertEqual(expected, retrieved, "Incorrect user id return")
 
+    def test_get_uids_after(self):
+        self.assertEqual(self.data.get_uids_after(None, 2), [123456, 347698])
+        self.assertEqual(self.data.get_uids_after(347698, 5),
+                         [654321, 827569])
+
+    def test_broadcast_checkpoints(self):
+        broadcast_id = self.data.create_broadcast('news', ts=1.0)
+        self.data.checkpoint_broadcast(broadcast_id, 347698,
+                                       [(123456, 'sent', None),
+                                        (347698, 'failed', 'blocked')])
+        self.assertEqual(self.data.get_broadcast(broadcast_id)['cursor'],
+                         347698)
+        self.assertIn(broadcast_id, self.data.get_unfinished_broadcasts())
+        self.data.finish_broadcast(broadcast_id, ts=2.0)
+        self.assertNotIn(broadcast_id, self.data.get_unfinished_broadcasts())
+        self.assertEqual(self.data.get_broadcast_stats(broadcast_id),
+                         {'sent': 1, 'failed': 1})
+        for table in ('broadcasts', 'broadcast_deliveries'):
+            self.data.curs.execute("delete from {}".format(table))
+        self.data.conn.commit()
+
     def test_get_schedule_by_uid(self):
         uid1 = 123456
         uid2 = 654321
@@ -68,7 +105,9 @@ class DBManagerTester(unittest.TestCase):
     def test_register(self):
         new_id = 999999
         q = "select user_id from user_ids where user_id=?"
-        self.data.register(new_id)
+        self.assertTrue(self.data.register(new_id))
+        # repeated (i.e. concurrent) registration is ignored
+        self.assertFalse(self.data.register(new_id))
 
         # it would be more convenient to use is_registered method of db manager
         # but i'd like to keep test cases isolated from each other
@@ -76,7 +115,7 @@ class DBManagerTester(unittest.TestCase):
         # to test totally different method)
         self.data.curs.execute(q, (new_id,))
         res = self.data.curs.fetchall()
-        self.assertTrue(res)
+        self.assertEqual(len(res), 1)
         q = "delete from user_ids where user_id=?"
         self.data.curs.execute(q, (new_id,))
         self.data.conn.commit()
@@ -107,9 +146,739 @@ class DBManagerTester(unittest.TestCase):
         self.data.curs.execute(q)
         self.data.conn.commit()
 
+    def test_count_scheduled_fires(self):
+        day = datetime.datetime(2020, 1, 1)
+        count = lambda since, until: self.data.count_scheduled_fires(
+            schedule.day_segments(since, until))
+        self.assertEqual(count(day.replace(hour=12),
+                               day.replace(hour=13, minute=22)),
+                         {123456: 2})
+        self.assertEqual(count(day.replace(hour=23),
+                               day + datetime.timedelta(days=1, minutes=1)),
+                         {654321: 2})
+        self.assertEqual(count(day.replace(hour=12),
+                               day.replace(hour=12) +
+                               datetime.timedelta(days=2)),
+                         {123456: 6, 654321: 4})
+        self.assertEqual(count(day, day), {})
+
+    def test_schedule_rules(self):
+        rule = schedule.make_rule('08:00', '22:00', 30, 0b11111)
+        rule_id = self.data.add_schedule_rule(123456, rule)
+        self.assertEqual(self.data.get_schedule_rules_by_uid(123456),
+                         [(rule_id, rule)])
+        self.assertEqual(self.data.get_schedule_rules(), {123456: [rule]})
+        # rules of unregistered users are not dispatched
+        self.data.add_schedule_rule(1, rule)
+        self.assertEqual(self.data.get_schedule_rules(), {123456: [rule]})
+        self.assertEqual(self.data.delete_schedule_rule(654321, rule_id), 0)
+        self.assertEqual(self.data.delete_schedule_rule(123456, rule_id), 1)
+        self.assertEqual(self.data.get_schedule_rules(), {})
+
+    def test_answer_statistics(self):
+        uid = 999999
+        word = ('__w1f__', '__w1t__')
+        self.data.record_questions({uid: [word]}, ts=100.0)
+        self.assertIsNone(self.data.record_answer(uid, ('__x__', '__y__'),
+                                                  False, ts=105.0))
+        self.assertEqual(self.data.record_answer(uid, word, False, ts=110.0),
+                         10.0)
+        self.data.record_answer(uid, word, True, ts=120.0)
+        self.data.record_answer(uid, word, True, ts=130.0)
+        stats = self.data.get_stats_by_uid(uid)
+        self.assertEqual(stats['questions'], 1)
+        self.assertEqual(stats['answers'], 4)
+        self.assertEqual(stats['correct_answers'], 2)
+        self.assertEqual(stats['learned_words'], 1)
+        word_stats = self.data.get_word_stats_by_uid(uid, word)
+        self.assertEqual(word_stats['attempts_to_learn'], 2)
+        self.assertEqual(word_stats['total_answer_time'], 10.0 + 20.0 + 30.0)
+
+        # compaction must not affect rollups
+        self.assertEqual(self.data.compact_answer_events(125.0), 4)
+        self.assertEqual(self.data.get_stats_by_uid(uid), stats)
+        for table in ('answer_events', 'user_stats', 'word_stats'):
+            q = "delete from {} where user_id=?".format(table)
+            self.data.curs.execute(q, (uid,))
+        self.data.conn.commit()
+
+    def test_search_words(self):
+        uid = 999999
+        words = [('__café crème__', '__кофе со сливками__'),
+                 ('__preliminary__', '__предварительный__')]
+        self.data.add_words(uid, words)
+        self.assertEqual(self.data.search_words(uid, 'cafe'), words[:1])
+        self.assertEqual(self.data.search_words(uid, 'ПРЕДВАР'), words[1:])
+        self.assertEqual(self.data.search_words(123456, 'preliminary'), [])
+        self.assertEqual(self.data.search_words(uid, '?!'), [])
+        # group chat with the same id digits
+        self.data.add_words(-uid, [('__cafeteria__', '__столовая__')])
+        self.assertEqual(self.data.search_words(uid, 'cafe'), words[:1])
+        self.assertEqual(self.data.search_words(-uid, 'cafe'),
+                         [('__cafeteria__', '__столовая__')])
+        q = """delete from word_src where user_id in (999999, -999999)"""
+        self.data.curs.execute(q)
+        self.data.conn.commit()
+        self.assertEqual(self.data.search_words(uid, 'cafe'), [])
+
+    def test_export_import(self):
+        uid = 999999
+        words = [('__w{}f__'.format(i), '__w{}t, "x"__'.format(i))
+                 for i in range(2500)]
+        self.data.add_words(uid, words)
+        for fmt in transfer.FORMATS:
+            exported = io.StringIO()
+            self.assertEqual(transfer.export_words(self.data, uid,
+                                                   exported, fmt), 2500)
+            exported.write('\n' if fmt == transfer.JSONL else 'broken\n')
+            exported.seek(0)
+            self.assertEqual(transfer.import_words(self.data, uid + 1,
+                                                   exported, fmt),
+                             (2500, 0 if fmt == transfer.JSONL else 1))
+            self.assertEqual(self.data.get_all_words_by_uid(uid + 1), words)
+            q = """delete from word_src where user_id=1000000"""
+            self.data.curs.execute(q)
+            self.data.conn.commit()
+        q = """delete from word_src where user_id=999999"""
+        self.data.curs.execute(q)
+        self.data.conn.commit()
+
+    def test_connection_pool(self):
+        path = self.data.path
+        pool = language_bot_core.dbmanager.ConnectionPool(1)
+        conn = pool.acquire(path)
+        conn.execute("create temp table pool_test (x)")
+        conn.execute("insert into pool_test values (1)")
+        self.assertTrue(conn.in_transaction)
+        pool.release(path, conn)
+        # unfinished transaction is rolled back, connection is reused
+        self.assertFalse(conn.in_transaction)
+        self.assertIs(pool.acquire(path), conn)
+        extra = pool.acquire(path)
+        self.assertIsNot(extra, conn)
+        pool.release(path, conn)
+        pool.release(path, extra)   # pool is full
+        with self.assertRaises(sqlite3.ProgrammingError):
+            extra.execute("select 1")
+        pool.clear(path)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("select 1")
+
+    def test_add_words_invalidates_cache(self):
+        uid = 999999
+        cache = language_bot_core.vocabulary_cache
+        self.assertEqual(len(cache.load(self.data, uid)), 0)
+        self.data.add_words(uid, [('__w1f__', '__w1t__')])
+        self.assertNotIn((self.data.path, uid), cache)
+        self.assertEqual(list(cache.load(self.data, uid)),
+                         [('__w1f__', '__w1t__')])
+        q = """delete from word_src where user_id=999999"""
+        self.data.curs.execute(q)
+        self.data.conn.commit()
+        cache.invalidate((self.data.path, uid))
+
+    def test_lexicon_migration(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'lexicon.db')
+            shutil.copy(self.data.path, path)
+            db = language_bot_core.DBManager(path)
+            db.connect()
+            words = {uid: db.get_all_words_by_uid(uid)
+                     for uid in db.get_uids()}
+            self.assertFalse(db.is_lexicon_storage())
+            self.assertTrue(db.migrate_to_lexicon())
+            self.assertFalse(db.migrate_to_lexicon())
+            self.assertTrue(db.is_lexicon_storage())
+            for uid, pairs in words.items():
+                self.assertEqual(db.get_all_words_by_uid(uid), pairs)
+            shared = [('__shared__', '__общее__')]
+            db.add_words(1, shared)
+            db.add_words(2, shared)
+            q = "select count(*) from lexicon where word_from='__shared__'"
+            self.assertEqual(db.curs.execute(q).fetchone()[0], 1)
+            self.assertEqual(db.search_words(2, 'share'), shared)
+            db.curs.execute("delete from word_src where user_id=2")
+            db.conn.commit()
+            self.assertEqual(db.search_words(2, 'share'), [])
+            self.assertEqual(db.get_all_words_by_uid(1), shared)
+            db.disconnect()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_duplicate_users_migration(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'users.db')
+            conn = sqlite3.connect(path)
+            # registered twice before user ids became unique
+            conn.executescript("create table user_ids(user_id integer);"
+                               "insert into user_ids values (1), (2), (1);")
+            conn.close()
+            db = language_bot_core.DBManager(path)
+            db.connect()
+            self.assertEqual(sorted(db.get_uids()), [1, 2])
+            self.assertFalse(db.register(2))
+            self.assertEqual(sorted(db.get_uids()), [1, 2])
+            db.disconnect()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_archive_learned_words(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'archive.db')
+            shutil.copy(self.data.path, path)
+            db = language_bot_core.DBManager(path)
+            db.connect()
+            for lexicon in (False, True):
+                if lexicon:
+                    db.migrate_to_lexicon()
+                uid = 10 + lexicon
+                words = [('aptly', 'метко'), ('to shiver', 'трястись')]
+                db.add_words(uid, words)
+                for correct in (True, True, False, True):
+                    db.record_answer(uid, words[0], correct)
+                self.assertEqual(db.archive_learned_words(), {})
+                db.record_answer(uid, words[0], True)
+                self.assertEqual(db.archive_learned_words(), {uid: 1})
+                self.assertEqual(db.get_all_words_by_uid(uid), words[1:])
+                self.assertEqual(list(db.iter_words_by_uid(uid)),
+                                 words[1:] + words[:1])
+                timeout = db.conn.execute("pragma busy_timeout").fetchone()
+                db.compact()
+                # pooled connection gets its own busy timeout back
+                self.assertEqual(db.conn.execute(
+                    "pragma busy_timeout").fetchone(), timeout)
+                self.assertEqual(db.search_words(uid, 'shiver'), words[1:])
+            db.disconnect()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class MemoryBackendTester(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'memory.json')
+
+    def tearDown(self):
+        language_bot_core.memory_backend.MemoryStore._stores.clear()
+        shutil.rmtree(self.dir)
+
+    def _reopen(self):
+        language_bot_core.memory_backend.MemoryStore._stores.clear()
+        db = language_bot_core.DBManager(self.path, backend='memory')
+        db.connect()
+        return db
+
+    def test_operations(self):
+        db = language_bot_core.DBManager(':memory:', backend='memory')
+        db.connect()
+        self.assertIs(db._state,
+                      language_bot_core.memory_backend.ConnectedMemoryDB)
+        self.assertTrue(db.register(1))
+        self.assertFalse(db.register(1))
+        self.assertEqual(db.get_uids(), [1])
+        db.add_scheduled_time_by_uid(1, '13:00:00')
+        db.add_scheduled_time_by_uid(1, '12:00:00')
+        self.assertEqual(db.get_next_time_by_uid('12:30:00', 1), '13:00:00')
+        self.assertEqual(db.delete_scheduled_time_by_uid(1, '13:00:00'), 1)
+        self.assertEqual(db.get_schedule_by_uid(1), ['12:00:00'])
+        self.assertEqual(db.count_scheduled_fires(schedule.day_segments(
+            datetime.datetime(2020, 1, 1, 11),
+            datetime.datetime(2020, 1, 2, 12))), {1: 2})
+        rule = schedule.make_rule('08:00', '09:00', 15)
+        rule_id = db.add_schedule_rule(1, rule)
+        db.add_schedule_rule(2, rule)
+        self.assertEqual(db.get_schedule_rules(), {1: [rule]})
+        self.assertEqual(db.delete_schedule_rule(2, rule_id), 0)
+        self.assertEqual(db.delete_schedule_rule(1, rule_id), 1)
+        self.assertEqual(db.get_schedule_rules_by_uid(1), [])
+        words = [('café crème', 'кофе'), ('aptly', 'метко')]
+        db.add_words(1, words)
+        self.assertEqual(db.get_all_words_by_uid(1), words)
+        self.assertIn(db.get_random_word_by_uid(1), words)
+        self.assertEqual(db.search_words(1, 'CAFE', 10), words[:1])
+        self.assertEqual(db.search_words(1, 'мет', 10), words[1:])
+        db.disconnect()
+        with self.assertRaises(language_bot_core.dbmanager.
+                               DisconnectedDatabaseError):
+            db.get_uids()
+
+    def test_unknown_backend(self):
+        db = language_bot_core.DBManager(self.path, backend='unknown')
+        with self.assertRaises(language_bot_core.dbmanager.
+                               UnknownBackendError):
+            db.connect()
+
+    def test_cache_keyed_by_database(self):
+        cache = language_bot_core.vocabulary_cache
+        dbs = []
+        for name in ('first.json', 'second.json'):
+            db = language_bot_core.DBManager(os.path.join(self.dir, name),
+                                             backend='memory')
+            db.connect()
+            db.add_words(1, [(name, 'слово')])
+            dbs.append(db)
+        first, second = dbs
+        self.assertEqual(list(cache.load(first, 1)), [('first.json', 'слово')])
+        self.assertEqual(list(cache.load(second, 1)),
+                         [('second.json', 'слово')])
+        second.add_words(1, [('aptly', 'метко')])
+        self.assertIn((first.path, 1), cache)
+        self.assertNotIn((second.path, 1), cache)
+        for db in dbs:
+            cache.invalidate((db.path, 1))
+            db.disconnect()
+
+    def test_persistence(self):
+        db = self._reopen()
+        db.register(1)
+        db.add_words(1, [('aptly', 'метко')])
+        db.set_meta('key', 'value')
+        db.record_questions({1: [('aptly', 'метко')]}, ts=10.0)
+        # restored from journal
+        db = self._reopen()
+        self.assertEqual(db.get_uids(), [1])
+        self.assertEqual(db.get_meta('key'), 'value')
+        self.assertEqual(db.record_answer(1, ('aptly', 'метко'), True,
+                                          ts=15.0), 5.0)
+        rule = schedule.make_rule('08:00', '09:00', 15)
+        db.add_schedule_rule(1, rule)
+        db.store.snapshot()
+        db.add_scheduled_time_by_uid(1, '12:00:00')
+        # restored from snapshot and journal
+        db = self._reopen()
+        self.assertEqual(db.get_all_words_by_uid(1), [('aptly', 'метко')])
+        self.assertEqual(db.get_schedule_by_uid(1), ['12:00:00'])
+        self.assertEqual(db.get_schedule_rules(), {1: [rule]})
+        self.assertEqual(db.get_stats_by_uid(1)['learned_words'], 1)
+        self.assertEqual(db.get_word_stats_by_uid(1, ('aptly', 'метко'))
+                         ['attempts_to_learn'], 1)
+
+    def test_archive_learned_words(self):
+        db = self._reopen()
+        words = [('aptly', 'метко'), ('to shiver', 'трястись')]
+        db.add_words(1, words)
+        for i in range(3):
+            db.record_answer(1, words[1], True)
+        self.assertEqual(db.archive_learned_words(), {1: 1})
+        db = self._reopen()
+        self.assertEqual(db.get_all_words_by_uid(1), words[:1])
+        self.assertEqual(list(db.iter_words_by_uid(1)), words)
+        db.compact()
+        self.assertFalse(os.path.getsize(db.store.journal_path))
+
+
+class VocabularyCacheTester(unittest.TestCase):
+
+    pairs = [('to shiver', 'трястись'), ('aptly', 'метко'),
+             ('fraudulent', 'мошеннический')]
+
+    def test_packed_words(self):
+        words = PackedWords(self.pairs)
+        self.assertEqual(len(words), 3)
+        self.assertEqual(list(words), self.pairs)
+        self.assertEqual(words[-1], self.pairs[-1])
+        self.assertIn(words.random_pair(), self.pairs)
+        self.assertIsNone(PackedWords([]).random_pair())
+
+    def test_packed_words_size(self):
+        pairs = [('word{}'.format(i), 'слово{}'.format(i))
+                 for i in range(1000)]
+        plain_size = sys.getsizeof(pairs) + \
+            sum(sys.getsizeof(p) + sum(map(sys.getsizeof, p)) for p in pairs)
+        self.assertLess(PackedWords(pairs).nbytes, plain_size / 3)
+
+    def test_lru_eviction(self):
+        words = PackedWords(self.pairs)
+        cache = VocabularyCache(budget=2 * words.nbytes)
+        cache.put(1, words)
+        cache.put(2, words)
+        cache.get(1)
+        cache.put(3, words)
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertIn(3, cache)
+        self.assertLessEqual(cache.size, cache.budget)
+
+    def test_load_invalidated_while_reading(self):
+        cache = VocabularyCache(budget=1 << 20)
+        reading, invalidated = threading.Event(), threading.Event()
+
+        def get_all_words_by_uid(uid):
+            reading.set()
+            invalidated.wait(5)
+            return self.pairs
+
+        db = types.SimpleNamespace(path='db',
+                                   get_all_words_by_uid=get_all_words_by_uid)
+        loader = threading.Thread(target=cache.load, args=(db, 1))
+        loader.start()
+        reading.wait(5)
+        cache.invalidate(('db', 1))
+        invalidated.set()
+        loader.join()
+        # words read before invalidation are not cached
+        self.assertNotIn(('db', 1), cache)
+        db.get_all_words_by_uid = lambda uid: self.pairs[:1]
+        self.assertEqual(list(cache.load(db, 1)), self.pairs[:1])
+        self.assertIn(('db', 1), cache)
+
 
 class DispatcherTester(unittest.TestCase):
-    pass
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'memory.json')
+
+    def tearDown(self):
+        language_bot_core.memory_backend.MemoryStore._stores.clear()
+        shutil.rmtree(self.dir)
+
+    def test_seconds_until(self):
+        now = datetime.datetime(2020, 1, 1, 5)
+        self.assertEqual(maintenance.seconds_until('06:00:00', now), 3600)
+        self.assertEqual(maintenance.seconds_until('04:00:00', now),
+                         23 * 3600)
+
+    def test_dispatch_tick(self):
+        dispatcher = language_bot_core.dispatcher
+        db = language_bot_core.DBManager(self.path, backend='memory')
+        db.connect()
+        db.register(1)
+        db.add_words(1, [('aptly', 'метко')])
+        db.add_scheduled_time_by_uid(1, '12:00:00')
+        db.disconnect()
+        since = datetime.datetime.now() - datetime.timedelta(days=1)
+        sent = []
+        callback = lambda uids, words: sent.append(words)
+        # database is maintained: tick is skipped
+        with maintenance.maintenance_lock(self.path):
+            self.assertEqual(dispatcher.dispatch_tick(db, since, callback),
+                             since)
+        self.assertFalse(sent)
+
+        def locked(db, counts):
+            raise sqlite3.OperationalError('database is locked')
+
+        with self.assertLogs('language_bot.dispatcher', logging.ERROR):
+            self.assertEqual(dispatcher.dispatch_tick(db, since, callback,
+                                                      locked), since)
+        self.assertFalse(sent)
+        # skipped fires are caught up
+        watermark = dispatcher.dispatch_tick(db, since, callback)
+        self.assertGreater(watermark, since)
+        self.assertEqual(sent, [{1: [('aptly', 'метко')]}])
+        self.assertEqual(dispatcher._load_watermark(db).timestamp(),
+                         watermark.timestamp())
+
+    def test_next_deadline(self):
+        next_deadline = language_bot_core.dispatcher.next_deadline
+        self.assertEqual(next_deadline(1000, 10, 1005.5), 1010)
+        self.assertEqual(next_deadline(1000, 10, 1010), 1010)
+        # overrun tick: next one runs at once, still aligned to boundary
+        self.assertEqual(next_deadline(1000, 10, 1034.5), 1030)
+        self.assertEqual(next_deadline(1030, 10, 1034.5), 1040)
+        self.assertEqual(next_deadline(1000, 0, 1005.5), 1005.5)
+
+    def test_count_fires(self):
+        count_fires = language_bot_core.dispatcher.count_fires
+        times = ['08:00:00', '12:00:00', '23:30:00']
+        day = datetime.datetime(2020, 1, 1)
+        self.assertEqual(count_fires(times, day.replace(hour=7),
+                                     day.replace(hour=8)), 1)
+        self.assertEqual(count_fires(times, day.replace(hour=8),
+                                     day.replace(hour=11)), 0)
+        self.assertEqual(count_fires(times, day.replace(hour=7),
+                                     day.replace(hour=13)), 2)
+        # across midnight
+        self.assertEqual(count_fires(times, day.replace(hour=23),
+                                     day.replace(hour=23) +
+                                     datetime.timedelta(hours=10)), 2)
+        # long downtime is caught up only for MAX_CATCH_UP
+        self.assertEqual(count_fires(times, day,
+                                     day + datetime.timedelta(days=10)), 3)
+        rules = [schedule.make_rule('08:00', '09:00', 30)]
+        self.assertEqual(count_fires(times, day.replace(hour=7),
+                                     day.replace(hour=9), rules), 4)
+
+
+class LogsTester(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.listener = logs.setup_logging(
+            sampling={'sampled': 0}, rate_limits={'limited': 2},
+            stream=self.stream)
+        self.logger = logs.get_logger('test')
+
+    def tearDown(self):
+        logger = logging.getLogger(logs.LOGGER_NAME)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+
+    def events(self):
+        self.listener.stop()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_structured_events(self):
+        logs.log_event(self.logger, logs.TICK, users=2, text='слово')
+        try:
+            raise ValueError('boom')
+        except ValueError as e:
+            logs.log_event(self.logger, logs.DB_ERROR, logging.ERROR,
+                           exc_info=e)
+        tick, error = self.events()
+        self.assertEqual((tick['category'], tick['users'], tick['text']),
+                         (logs.TICK, 2, 'слово'))
+        self.assertEqual(tick['logger'], 'language_bot.test')
+        self.assertEqual(error['level'], 'ERROR')
+        self.assertIn('ValueError: boom', error['exc'])
+
+    def test_sampling_and_rate_limits(self):
+        for i in range(5):
+            logs.log_event(self.logger, 'sampled', i=i)
+            logs.log_event(self.logger, 'limited', i=i)
+        # warnings are never sampled out
+        logs.log_event(self.logger, 'sampled', logging.WARNING, i=5)
+        events = self.events()
+        self.assertEqual([(e['category'], e['i']) for e in events],
+                         [('limited', 0), ('limited', 1), ('sampled', 5)])
+
+
+class BackupTester(unittest.TestCase):
+
+    def __init__(self, db_path, method_name='runTest'):
+        self.db_path = db_path
+        super().__init__(method_name)
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'source.db')
+        shutil.copy(self.db_path, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_backup_and_restore(self):
+        backups = os.path.join(self.dir, 'backups')
+        made = [backup.backup_database(self.path, backups, retention=2)
+                for _ in range(3)]
+        self.assertEqual(backup.list_backups(self.path, backups), made[1:])
+        db = language_bot_core.DBManager(self.path)
+        db.connect()
+        db.register(1)
+        db.disconnect()
+        backup.restore_database(made[-1], self.path)
+        db.connect()
+        self.assertNotIn(1, db.get_uids())
+        db.disconnect()
+
+    def test_backup_under_writes(self):
+        backups = os.path.join(self.dir, 'backups')
+        stop = threading.Event()
+
+        def write():
+            conn = sqlite3.connect(self.path)
+            uid = 0
+            while not stop.is_set():
+                uid += 1
+                conn.execute("insert into user_ids values (?)", (-uid,))
+                conn.commit()
+            conn.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            # snapshot is not restarted by concurrent commits
+            target = backup.backup_database(self.path, backups)
+        finally:
+            stop.set()
+            writer.join()
+        self.assertEqual(backup.list_backups(self.path, backups), [target])
+        # snapshot taking too long is aborted without partial files
+        conn = sqlite3.connect(self.path)
+        conn.executemany("insert into user_ids values (?)",
+                         ((uid,) for uid in range(10 ** 6, 10 ** 6 + 20000)))
+        conn.commit()
+        conn.close()
+        with self.assertRaises(backup.BackupError):
+            backup.backup_database(self.path, backups, timeout=0)
+        self.assertEqual(os.listdir(backups), [os.path.basename(target)])
+
+    def test_corrupted_backup(self):
+        broken = os.path.join(self.dir, 'broken.db.gz')
+        with gzip.open(broken, 'wb') as f:
+            f.write(b'not a database' * 100)
+        for path in (broken, self.path):    # not compressed
+            with self.assertRaises(backup.BackupError):
+                backup.restore_database(path, self.path)
+        backup.verify_database(self.path)
+        self.assertFalse(os.path.exists(self.path + '.restore'))
+
+    def test_failed_backup(self):
+        backups = os.path.join(self.dir, 'backups')
+        broken = os.path.join(self.dir, 'broken.db')
+        os.mkdir(broken)    # can not be opened as database
+        stop = threading.Event()
+        thread = threading.Thread(target=backup.backup_mainloop,
+                                  args=([broken, self.path], backups, 60,
+                                        stop))
+        with self.assertLogs('language_bot.backup', logging.ERROR) as logs:
+            thread.start()
+            # failure of one database does not stop backups of others
+            deadline = time.monotonic() + 5
+            while not backup.list_backups(self.path, backups) and \
+                    time.monotonic() < deadline:
+                time.sleep(0.01)
+            stop.set()
+            thread.join()
+        self.assertEqual(len(backup.list_backups(self.path, backups)), 1)
+        # failed backup is retried after interval, not in busy loop
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(os.listdir(backups), [os.path.basename(
+            backup.list_backups(self.path, backups)[0])])
+
+
+class DictionaryTester(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'dictionary.lbd')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lookup(self):
+        pairs = [('Dean', 'декан'), ('smart', 'болеть'), ('smart', 'умный'),
+                 ('incredulously', 'недоверчиво')] + \
+                [('word{}'.format(i), 'слово{}'.format(i))
+                 for i in range(1000)]
+        self.assertEqual(dictionary.compile_dictionary(pairs, self.path,
+                                                       reverse=True), 2007)
+        words = dictionary.Dictionary(self.path)
+        self.assertEqual(len(words), 2007)
+        self.assertEqual(words.lookup('  DEAN '), 'декан')
+        self.assertEqual(words.lookup('Декан'), 'Dean')
+        self.assertEqual(words.lookup('smart'), 'болеть, умный')
+        self.assertEqual(words.lookup('word999'), 'слово999')
+        self.assertIsNone(words.lookup('dea'))
+        self.assertIsNone(words.lookup('zzz'))
+        self.assertEqual(dictionary.suggest_translations(
+            words, ['to smart', 'inane', 'incredulously']),
+            [('to smart', 'болеть, умный'),
+             ('incredulously', 'недоверчиво')])
+        words.close()
+
+    def test_not_a_dictionary(self):
+        for content in (b'', b'garbage' * 10):
+            with open(self.path, 'wb') as f:
+                f.write(content)
+            with self.assertRaises(dictionary.DictionaryError):
+                dictionary.Dictionary(self.path)
+
+
+class QuizTester(unittest.TestCase):
+
+    def test_choices(self):
+        words = PackedWords([('dean', 'декан'), ('aptly', 'метко'),
+                             ('deftly', 'ловко'), ('dean', 'старшина'),
+                             ('smart', 'умный'), ('fraudulent',
+                                                  'мошеннический')])
+        index = quiz.distractor_index(words)
+        self.assertIs(index, quiz.distractor_index(words))
+        # bucket of question is used first
+        for _ in range(10):
+            self.assertEqual(index.distractors(words, ('x', 'мелко'), 1),
+                             [('aptly', 'метко')])
+        choices = quiz.build_choices(words, ('aptly', 'метко'), 4)
+        self.assertEqual(len(choices), 4)
+        self.assertIn(('aptly', 'метко'), choices)
+        self.assertEqual(len({pair[1] for pair in choices}), 4)
+        # pairs of the same word are never distractors
+        for _ in range(10):
+            self.assertEqual([pair[0] for pair in quiz.build_choices(
+                words, ('dean', 'декан'), 6)].count('dean'), 1)
+        self.assertEqual(quiz.build_choices(PackedWords([('a', '1')]),
+                                            ('a', '1'), 4), [('a', '1')])
+
+
+class ScheduleTester(unittest.TestCase):
+
+    # 2020-01-06 is Monday
+    monday = datetime.datetime(2020, 1, 6)
+
+    def test_make_rule(self):
+        rule = schedule.make_rule('08:00', '22:00:30', 30,
+                                  schedule.parse_weekdays('mon-fri'))
+        self.assertEqual(rule, (8 * 3600, 22 * 3600 + 30, 1800, 0b11111))
+        self.assertEqual(schedule.parse_weekdays('sat, sun'), 0b1100000)
+        self.assertEqual(schedule.parse_weekdays('sun-tue'), 0b1000011)
+        for args in (('08:00', '07:00', 30), ('08:00', '09:00', 0),
+                     ('8 am', '09:00', 30), ('08:00', '09:00', 30, 0)):
+            with self.assertRaises(schedule.ScheduleRuleError):
+                schedule.make_rule(*args)
+        with self.assertRaises(schedule.ScheduleRuleError):
+            schedule.parse_weekdays('mon-someday')
+
+    def test_day_segments(self):
+        hour = datetime.timedelta(hours=1)
+        self.assertEqual(schedule.day_segments(self.monday + 8 * hour,
+                                               self.monday + 9.5 * hour),
+                         [('08:00:00', '09:30:00', 1)])
+        self.assertEqual(schedule.day_segments(self.monday + 23 * hour,
+                                               self.monday + 73 * hour),
+                         [('23:00:00', '23:59:59', 1),
+                          ('', '01:00:00', 1), ('', '23:59:59', 2)])
+        self.assertEqual(schedule.day_segments(self.monday, self.monday),
+                         [])
+        segments = schedule.day_segments(self.monday + 23 * hour,
+                                         self.monday + 25 * hour)
+        self.assertEqual(schedule.count_time_fires(
+            ['23:00:00', '23:30:00', '00:00:00', '1:00:00'], segments), 2)
+
+    def test_next_fire(self):
+        rule = schedule.make_rule('08:00', '22:00', 45, 0b11111)
+        hour = datetime.timedelta(hours=1)
+        self.assertEqual(schedule.next_fire(rule, self.monday),
+                         self.monday + 8 * hour)
+        self.assertEqual(schedule.next_fire(rule, self.monday + 8 * hour),
+                         self.monday + 8.75 * hour)
+        # last fire of a day is 21:30
+        self.assertEqual(schedule.next_fire(rule, self.monday + 21.5 * hour),
+                         self.monday + 32 * hour)
+        # friday evening -> monday morning
+        friday = self.monday + datetime.timedelta(days=4)
+        self.assertEqual(schedule.next_fire(rule, friday + 23 * hour),
+                         self.monday + datetime.timedelta(days=7) + 8 * hour)
+
+    def test_count_rule_fires(self):
+        rule = schedule.make_rule('08:00', '22:00', 45, 0b11111)
+        day = datetime.timedelta(days=1)
+        hour = datetime.timedelta(hours=1)
+        # 08:00, 08:45, ..., 21:30 -- 19 fires a day
+        self.assertEqual(schedule.count_rule_fires(rule, self.monday,
+                                                   self.monday + day), 19)
+        self.assertEqual(schedule.count_rule_fires(
+            rule, self.monday + 8 * hour, self.monday + 9 * hour), 1)
+        self.assertEqual(schedule.count_rule_fires(
+            rule, self.monday + 7 * hour, self.monday + 8 * hour), 1)
+        self.assertEqual(schedule.count_rule_fires(
+            rule, self.monday + 22 * hour, self.monday + 31 * hour), 0)
+        self.assertEqual(schedule.count_rule_fires(rule, self.monday,
+                                                   self.monday + 7 * day),
+                         5 * 19)
+        # matches fires found one by one
+        moment, fires = self.monday + 3 * hour, 0
+        while True:
+            moment = schedule.next_fire(rule, moment)
+            if moment > self.monday + 3 * day:
+                break
+            fires += 1
+        self.assertEqual(schedule.count_rule_fires(
+            rule, self.monday + 3 * hour, self.monday + 3 * day), fires)
 
 
 class ParserTester(unittest.TestCase):
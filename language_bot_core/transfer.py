@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Streaming export/import of users vocabularies as CSV or JSONL documents.
+Neither direction materializes the whole vocabulary in memory: rows are
+fetched from cursor and inserted into database by chunks.
+"""
+
+
+import csv
+import itertools
+import json
+
+from .constants import TRANSFER_CHUNK_SIZE
+from .dbmanager import DBManager
+
+
+CSV = 'csv'
+JSONL = 'jsonl'
+FORMATS = (CSV, JSONL)
+
+CSV_HEADER = ['word_from', 'word_to']
+
+
+class TransferException(Exception):
+    pass
+
+
+class UnsupportedFormatError(TransferException):
+    pass
+
+
+def format_by_filename(filename: str):
+    """
+    :param filename: document name
+    :return: CSV, JSONL or None if extension is not supported
+    """
+    ext = filename.rsplit('.', 1)[-1].lower() if filename else ''
+    if ext == 'json':
+        ext = JSONL
+    return ext if ext in FORMATS else None
+
+
+def export_words(db: DBManager, uid: int, fileobj, fmt: str = CSV) -> int:
+    """
+    Writes all user's words into text file object
+
+    :param db: DBManager instance (already connected!)
+    :param uid: user id
+    :param fileobj: writable text file object
+    :param fmt: CSV or JSONL
+    :return: number of exported words
+    """
+    count = 0
+    rows = db.iter_words_by_uid(uid, TRANSFER_CHUNK_SIZE)
+    if fmt == CSV:
+        writer = csv.writer(fileobj)
+        writer.writerow(CSV_HEADER)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    elif fmt == JSONL:
+        for word_from, word_to in rows:
+            fileobj.write(json.dumps({'word_from': word_from,
+                                      'word_to': word_to},
+                                     ensure_ascii=False) + '\n')
+            count += 1
+    else:
+        raise UnsupportedFormatError('Unsupported format: {}'.format(fmt))
+    return count
+
+
+def _normalize(word_from, word_to):
+    if not isinstance(word_from, str) or not isinstance(word_to, str):
+        return None
+    word_from, word_to = word_from.strip().lower(), word_to.strip().lower()
+    if not word_from or not word_to:
+        return None
+    return word_from, word_to
+
+
+def _read_csv(fileobj):
+    for row in csv.reader(fileobj):
+        if row == CSV_HEADER:
+            continue
+        yield _normalize(*row[:2]) if len(row) >= 2 else None
+
+
+def _read_jsonl(fileobj):
+    for line in fileobj:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        if isinstance(row, dict):
+            yield _normalize(row.get('word_from'), row.get('word_to'))
+        elif isinstance(row, list) and len(row) >= 2:
+            yield _normalize(*row[:2])
+        else:
+            yield None
+
+
+def import_words(db: DBManager, uid: int, fileobj, fmt: str = CSV):
+    """
+    Reads words from text file object and adds them to user's vocabulary
+    by chunks of TRANSFER_CHUNK_SIZE rows
+
+    :param db: DBManager instance (already connected!)
+    :param uid: user id
+    :param fileobj: readable text file object
+    :param fmt: CSV or JSONL
+    :return: (number of imported words, number of skipped malformed rows)
+    """
+    if fmt == CSV:
+        rows = _read_csv(fileobj)
+    elif fmt == JSONL:
+        rows = _read_jsonl(fileobj)
+    else:
+        raise UnsupportedFormatError('Unsupported format: {}'.format(fmt))
+    imported = skipped = 0
+    while True:
+        chunk = list(itertools.islice(rows, TRANSFER_CHUNK_SIZE))
+        if not chunk:
+            break
+        words = [pair for pair in chunk if pair is not None]
+        skipped += len(chunk) - len(words)
+        if words:
+            db.add_words(uid, words)
+            imported += len(words)
+    return imported, skipped
@@ -2,7 +2,14 @@
 # -*-encoding: utf-8-*-
 
 
-from telegram_language_bot import run_bot
+import sys
 
+from telegram_language_bot import run_bot, run_tenants
 
-run_bot(10)
\ No newline at end of file
+
+# python main.py [tenants.json] -- several bots are hosted by one process
+# if tenants config is given
+if len(sys.argv) > 1:
+    run_tenants(sys.argv[1], 10)
+else:
+    run_bot(10)
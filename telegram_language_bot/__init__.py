@@ -2,7 +2,7 @@
 # -*-encoding: utf-8-*-
 
 
-from .bot import run_bot
+from .bot import run_bot, run_tenants
 
 
-__all__ = ['run_bot']
+__all__ = ['run_bot', 'run_tenants']
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Inbound admission control.
+
+    Every incoming message and callback query (button press) is checked
+here in polling thread before any handler is scheduled: per-user token
+bucket limits message rate (long texts cost more), repeated identical
+commands are coalesced and oversized messages are rejected (after their
+tokens are charged, so flooding with them is throttled as well).
+"""
+
+
+import time
+from collections import OrderedDict
+from threading import RLock
+
+from telegram_language_bot.utils import TokenBucket
+
+
+ADMITTED = 0
+THROTTLED = 1
+COALESCED = 2
+TOO_LARGE = 3
+
+
+class AdmissionController:
+    """Per-user flood control state"""
+
+    # number of users which state is kept, least recently seen are dropped
+    max_users = 100000
+
+    def __init__(self, rate: float, burst: float, chars_per_token: int,
+                 coalesce_window: float, max_text_length: int):
+        self.rate = rate
+        self.burst = burst
+        self.chars_per_token = chars_per_token
+        self.coalesce_window = coalesce_window
+        self.max_text_length = max_text_length
+        self.rejected = {THROTTLED: 0, COALESCED: 0, TOO_LARGE: 0}
+
+        # uid: [bucket, last command, last command time]
+        self._users = OrderedDict()
+        self._lock = RLock()
+
+    def _user(self, uid):
+        state = self._users.get(uid, None)
+        if state is None:
+            state = [TokenBucket(self.rate, self.burst), None, 0]
+            self._users[uid] = state
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(uid)
+        return state
+
+    def check(self, uid: int, text: str) -> int:
+        """
+        Decides whether message should be processed
+
+        :param uid: sender id
+        :param text: message text ('' for non-text messages)
+        :return: ADMITTED, THROTTLED, COALESCED or TOO_LARGE
+        """
+        text = text or ''
+        with self._lock:
+            state = self._user(uid)
+            now = time.monotonic()
+            command = text.strip() if text.startswith('/') else None
+            if command is not None and command == state[1] \
+                    and now - state[2] < self.coalesce_window:
+                status = COALESCED
+            elif not state[0].consume(1 + len(text) //
+                                      self.chars_per_token):
+                status = THROTTLED
+            elif len(text) > self.max_text_length:
+                status = TOO_LARGE
+            else:
+                state[1], state[2] = command, now
+                status = ADMITTED
+            if status != ADMITTED:
+                self.rejected[status] += 1
+            return status
@@ -5,7 +5,6 @@
 """ TODO: TEST FOR CONCURRENCY ERRORS
      - work on handlers placement (probably should be moved to another module)
      - add verification for /add_time
-     - add schedule presets (every hour, every half an hour etc.)
      - update handlers to use Keyboard Markups for more convenient user exp
      - multiple notes management:
         Addition of new words when previous are studied (maybe send some
@@ -16,46 +15,269 @@
 """
 
 
+import datetime
+import functools
+import io
+import logging
+import os
+import signal
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 
-import telebot as tb
+from telegram_language_bot.sessions import ANSWER, UPLOAD, GUEST
+from telegram_language_bot.tenants import current_tenant, default_tenant, \
+                            load_tenants
+from telegram_language_bot.router import Router
+from telegram_language_bot.workers import UpdateRouter, MESSAGE, \
+                            CALLBACK_QUERY, FIRES, INVALIDATE
+from telegram_language_bot.outbound import OutboundScheduler, INTERACTIVE, \
+                            SCHEDULED, BULK
+from telegram_language_bot.delivery import merge_questions, question_key, \
+                            build_questions_message, build_quiz_message, \
+                            parse_quiz_answer, REVEAL_PREFIX, QUIZ_PREFIX
+from telegram_language_bot.broadcast import broadcast_job
+from telegram_language_bot.updates import polling_mainloop
+from telegram_language_bot.profiler import SamplingProfiler, \
+                            ProfilerException
+from telegram_language_bot.admission import ADMITTED, THROTTLED, TOO_LARGE
+from language_bot_core import dispatch_mainloop, DBManager, parse, \
+                            vocabulary_cache, multi_dispatch_mainloop, \
+                            build_random_word_lists_by_uids
+from language_bot_core.dbmanager import BaseDatabaseException
+from language_bot_core.maintenance import maintenance_mainloop
+from language_bot_core.backup import backup_mainloop
+from language_bot_core.constants import DB_BACKEND
+from language_bot_core.dictionary import Dictionary, suggest_translations
+from language_bot_core.quiz import build_choices
+from language_bot_core.schedule import make_rule, parse_weekdays, \
+                            format_rule, next_fire, ScheduleRuleError, \
+                            EVERY_DAY
+from language_bot_core.logs import get_logger, log_event, setup_logging, \
+                            HANDLER, DB_ERROR
+from language_bot_core.transfer import export_words, import_words, \
+                            format_by_filename, FORMATS, CSV
+from telegram_language_bot.constants import GREETING_MSG, \
+                            WORDS_UPLOAD_MSG, COMMANDS, OUTBOUND_LANES, \
+                            OUTBOUND_GLOBAL_RATE, OUTBOUND_WORKERS, \
+                            OUTBOUND_MAX_ATTEMPTS, \
+                            MAX_PENDING_QUESTIONS, \
+                            FIND_RESULTS_LIMIT, IMPORT_MAX_FILE_SIZE, \
+                            IMPORT_DOWNLOAD_TIMEOUT, \
+                            PROFILER_INTERVAL, PROFILER_DIR, \
+                            PROFILER_TOP_N, LOG_PATH, LOG_LEVEL, \
+                            LOG_SAMPLING, LOG_RATE_LIMITS, \
+                            UPDATE_WORKERS, BROADCAST_CHUNK_SIZE, \
+                            DICTIONARY_PATH, QUIZ_CHOICES, \
+                            TENANT_HANDLER_THREADS, UPDATE_HANDLER_THREADS
 
-from telegram_language_bot.utils import ThreadedDict, Scheduler
-from language_bot_core import dispatch_mainloop, DBManager, \
-                            build_random_words_by_uids, parse
-from telegram_language_bot.constants import TOKEN, DB_PATH, GREETING_MSG,\
-                            WORDS_UPLOAD_MSG, COMMANDS
 
+logger = get_logger('bot')
 
-# global storage for all currently asked words {uid: (asked word: answer)}
-# designed to be thread-sustainable
-words_buffer = ThreadedDict()
 
-# to allow users answer questions and upload new words we store
-# id's of currently answering/uploading users
+# all per-bot state (conversation state, registered users, flood control,
+# telegram client) belongs to tenant, see telegram_language_bot.tenants
 
-# TODO: strange approach, REVISE!
-permitted_for_answer = {}
-permitted_for_update = {}
-registered_users_buffer = set()
 
+def on_admission(msg, status):
+    """
+    Notifies user about rejected messages (flooding users, including ones
+    sending oversized messages, are warned only once until their next
+    admitted message)
+
+    :param msg: message
+    :param status: admission status
+    :return: None
+    """
+    throttled_users = current_tenant().throttled_users
+    if status == ADMITTED:
+        throttled_users.discard(msg.chat.id)
+    elif status in (THROTTLED, TOO_LARGE) \
+            and msg.chat.id not in throttled_users:
+        throttled_users.add(msg.chat.id)
+        if status == TOO_LARGE:
+            send_message(msg.chat.id, "Message is too large, split it "
+                                      "into several smaller ones or "
+                                      "/import words from document")
+        else:
+            send_message(msg.chat.id, "Too many requests, slow down")
+
+
+# callback query handlers table: filled by decorator below, handlers are
+# registered on bot in declaration order when bot is created (messages
+# are routed by message_router)
+callback_query_handlers = []
 
-bot = tb.TeleBot(TOKEN)
+
+def logged(handler):
+    """
+    Wraps handler to log every invocation (and its failure) as structured
+    event, events are written by background thread
+
+    :param handler: handler, receives message or callback query
+    :return: wrapped handler
+    """
+    @functools.wraps(handler)
+    def wrapper(update):
+        chat = getattr(update, 'chat', None) or update.message.chat
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            return handler(update)
+        except (sqlite3.Error, BaseDatabaseException) as e:
+            status = 'db_error'
+            log_event(logger, DB_ERROR, logging.ERROR, exc_info=e,
+                      where=handler.__name__, chat_id=chat.id,
+                      error=repr(e))
+            raise
+        except Exception as e:
+            # exceptions of handlers run by executor are never retrieved
+            status = 'error'
+            log_event(logger, HANDLER, logging.ERROR, exc_info=e,
+                      where=handler.__name__, chat_id=chat.id,
+                      error=repr(e))
+            raise
+        finally:
+            log_event(logger, HANDLER,
+                      logging.INFO if status == 'ok' else logging.WARNING,
+                      handler=handler.__name__, chat_id=chat.id,
+                      status=status,
+                      duration_ms=round((time.perf_counter() - started)
+                                        * 1000, 3))
+    return wrapper
+
+
+def callback_query_handler(**filters):
+    def decorator(handler):
+        handler = logged(handler)
+        callback_query_handlers.append((handler, filters))
+        return handler
+    return decorator
+
+
+def get_bot(router=None, executor=None):
+    """
+    Lazily creates bot of current tenant (telebot and its dependencies are
+    imported only here)
+
+    :param router: UpdateRouter, if updates are handled by worker processes
+                   (used only when bot is created)
+    :param executor: callable(handler, *args), runs handlers instead of
+                     bot's own threads (used only when bot is created)
+    :return: bot instance
+    """
+    tenant = current_tenant()
+    if tenant.bot is None:
+        with tenant.lock:
+            if tenant.bot is None:
+                from telegram_language_bot.client import create_bot
+                tenant.bot = create_bot(tenant.token, tenant.admission,
+                                        on_admission,
+                                        telebot_message_handlers(),
+                                        callback_query_handlers, router,
+                                        executor)
+    return tenant.bot
+
+
+def telebot_message_handlers():
+    """
+    :return: [(handler, filters)] -- all messages go to the router
+    """
+    return [(message_router.dispatch,
+             {'content_types': message_router.content_types})]
+
+
+def _call(method, *args, **kwargs):
+    return method(*args, **kwargs)
+
+
+# all outgoing messages are sent through priority lanes, so replies to
+# active users are not stuck behind scheduled broadcast; every tenant
+# (bot token) has own lanes and limits
+outbound = OutboundScheduler(_call, OUTBOUND_LANES,
+                             OUTBOUND_GLOBAL_RATE, OUTBOUND_WORKERS,
+                             OUTBOUND_MAX_ATTEMPTS,
+                             channel_key=lambda: current_tenant().token)
+
+
+def send_message(chat_id, text, lane=INTERACTIVE, **kwargs):
+    """
+    Enqueues message into given outbound lane
+
+    :param chat_id: receiver
+    :param text: message text
+    :param lane: INTERACTIVE, SCHEDULED or BULK
+    :return: None
+    """
+    outbound.submit(lane, get_bot().send_message, chat_id, text, **kwargs)
+
+
+profiler = SamplingProfiler(PROFILER_INTERVAL)
+
+
+def toggle_profiler():
+    """
+    Starts profiler if it is not running, otherwise stops it and dumps
+    reports into PROFILER_DIR
+
+    :return: status description
+    """
+    if not profiler.running:
+        profiler.start()
+        return "Profiler started"
+    profiler.stop()
+    paths = profiler.dump(PROFILER_DIR, PROFILER_TOP_N)
+    return "Profiler stopped, reports: " + ", ".join(paths)
+
+
+def is_admin(msg):
+    return msg.chat.id in current_tenant().admin_ids
 
 
 def is_registered(msg):
     """
     Helper validation function to prevent any actions from unregistered users
+    (until users buffer is warmed up, unknown users are looked up in
+    database)
 
     :param msg:
     :return: is allowed to use command
     """
-    if msg.chat.id in registered_users_buffer:
+    tenant = current_tenant()
+    if msg.chat.id in tenant.registered_users:
         return True
-    return False
+    if tenant.warmed_up.is_set():
+        return False
+    db = DBManager(tenant.db_path)
+    db.connect()
+    registered = db.is_registered(msg.chat.id)
+    db.disconnect()
+    if registered:
+        tenant.registered_users.add(msg.chat.id)
+    return registered
+
+
+def user_mode(msg):
+    """
+    :param msg: message
+    :return: GUEST for unregistered users, otherwise session mode
+    """
+    if not is_registered(msg):
+        return GUEST
+    return current_tenant().sessions.get_mode(msg.chat.id) or ANSWER
 
 
-@bot.message_handler(commands=['start'])
+# modes in which handlers are available
+REGISTERED = (ANSWER, UPLOAD)
+ALL_MODES = (GUEST, ANSWER, UPLOAD)
+
+message_router = Router(user_mode)
+message_router.use(logged)
+
+
+@message_router.route(ALL_MODES, commands=['start'])
 def start_handler(msg):
     """
     /start command handler
@@ -63,57 +285,157 @@ def start_handler(msg):
     :param msg: message
     :return: None
     """
-    db = DBManager(DB_PATH)
+    db = DBManager(current_tenant().db_path)
     db.connect()
-    if not db.is_registered(msg.chat.id):
-        db.register(msg.chat.id)
-        bot.send_message(msg.chat.id, GREETING_MSG)
-        permitted_for_answer[msg.chat.id] = True
-        permitted_for_update[msg.chat.id] = False
-        registered_users_buffer.update([msg.chat.id])
+    # registration is atomic: concurrent /start greets user only once
+    if db.register(msg.chat.id):
+        send_message(msg.chat.id, GREETING_MSG)
+        current_tenant().sessions.set_mode(msg.chat.id, ANSWER)
+        current_tenant().registered_users.update([msg.chat.id])
     else:
-        bot.send_message(msg.chat.id, "I know you.")
+        send_message(msg.chat.id, "I know you.")
+    db.disconnect()
+
+
+@message_router.route(ALL_MODES, commands=['profile'])
+def profile_handler(msg):
+    """
+    /profile [start|stop] -- admin only, toggles sampling profiler if
+    no argument given
+
+    :param msg: message
+    :return: None
+    """
+    if not is_admin(msg):
+        return
+    raw_data = msg.text.split()
+    action = raw_data[1].lower() if len(raw_data) > 1 else None
+    try:
+        if action == 'start' and profiler.running or \
+                action == 'stop' and not profiler.running:
+            raise ProfilerException("Profiler is already {}".format(
+                'running' if profiler.running else 'stopped'))
+        resp = toggle_profiler()
+    except ProfilerException as e:
+        resp = str(e)
+    send_message(msg.chat.id, resp)
+
+
+def start_broadcast(broadcast_id, notify_chat=None):
+    """
+    Starts (or resumes) broadcast job in background, messages are sent
+    through BULK lane
+
+    :param broadcast_id: broadcast id
+    :param notify_chat: chat which is notified when broadcast is finished
+    :return: None
+    """
+    def on_finish(broadcast_id, stats):
+        send_message(notify_chat, "Broadcast {} finished: {}".format(
+            broadcast_id, ", ".join("{} {}".format(count, status)
+                                    for status, count in stats.items())))
+
+    tenant = current_tenant()
+    submit = lambda func, *args: outbound.submit(BULK, func, *args)
+    # messages are sent by outbound threads, so bot is resolved here
+    send = get_bot().send_message
+    Thread(target=tenant.bind(broadcast_job),
+           name='Broadcast{}'.format(broadcast_id),
+           args=(tenant.db_path, broadcast_id, submit, send,
+                 BROADCAST_CHUNK_SIZE,
+                 on_finish if notify_chat is not None else None),
+           daemon=True).start()
+
+
+@message_router.route(ALL_MODES, commands=['broadcast'])
+def broadcast_handler(msg):
+    """
+    /broadcast <text> -- admin only, sends text to all registered users
+
+    :param msg: message
+    :return: None
+    """
+    if not is_admin(msg):
+        return
+    raw_data = msg.text.split(' ', 1)
+    if len(raw_data) != 2 or not raw_data[1].strip():
+        send_message(msg.chat.id, "Type a message: /broadcast <text>")
+        return
+    db = DBManager(current_tenant().db_path)
+    db.connect()
+    broadcast_id = db.create_broadcast(raw_data[1].strip())
     db.disconnect()
+    start_broadcast(broadcast_id, msg.chat.id)
+    send_message(msg.chat.id, "Broadcast {} started".format(broadcast_id))
+
+
+@message_router.route(ALL_MODES, commands=['broadcast_status'])
+def broadcast_status_handler(msg):
+    """
+    /broadcast_status <id> -- admin only, delivery statistics of broadcast
+
+    :param msg: message
+    :return: None
+    """
+    if not is_admin(msg):
+        return
+    raw_data = msg.text.split()
+    if len(raw_data) != 2 or not raw_data[1].isdigit():
+        send_message(msg.chat.id, "Usage: /broadcast_status <id>")
+        return
+    db = DBManager(current_tenant().db_path)
+    db.connect()
+    broadcast = db.get_broadcast(int(raw_data[1]))
+    stats = db.get_broadcast_stats(int(raw_data[1]))
+    db.disconnect()
+    if broadcast is None:
+        send_message(msg.chat.id, "Unknown broadcast")
+        return
+    resp = "Finished" if broadcast['finished'] is not None else "In progress"
+    for status, count in stats.items():
+        resp += "\n{}: {}".format(status, count)
+    send_message(msg.chat.id, resp)
 
 
-@bot.message_handler(commands=['info'], func=is_registered)
+@message_router.route(REGISTERED, commands=['info'])
 def info_handler(msg):
     reply = ""
     for command, desc in COMMANDS.items():
         reply += "/{} - {}\n".format(command, desc)
-    bot.send_message(msg.chat.id, reply)
+    send_message(msg.chat.id, reply)
 
 
-@bot.message_handler(commands=['upload_info'], func=is_registered)
+@message_router.route(REGISTERED, commands=['upload_info'])
 def upload_info_handler(msg):
-    bot.send_message(msg.chat.id, WORDS_UPLOAD_MSG)
+    send_message(msg.chat.id, WORDS_UPLOAD_MSG)
 
 
-@bot.message_handler(commands=['next_word'], func=is_registered)
+@message_router.route(REGISTERED, commands=['next_word'])
 def next_word_handler(msg):
     """
     "I dont want wait, or I can not answer given word - give me a new one"
-    (Implicitly modifies global words buffer)
+    (previous pending questions are dropped)
 
     :param msg: message
     :return: None
     """
-    global words_buffer
-    db = DBManager(DB_PATH)
-    db.connect()
-    new_pair = build_random_words_by_uids(db, [msg.chat.id])
-    db.disconnect()
-    if not new_pair:
-        bot.send_message(msg.chat.id, "You haven't added any words yet")
+    words = vocabulary_cache.get((current_tenant().db_path, msg.chat.id))
+    if words is None:
+        db = DBManager(current_tenant().db_path)
+        db.connect()
+        words = vocabulary_cache.load(db, msg.chat.id)
+        db.disconnect()
+    new_pair = words.random_pair()
+    if new_pair is None:
+        send_message(msg.chat.id, "You haven't added any words yet")
         return
-    if msg.chat.id in words_buffer:
-        words_buffer.pop(msg.chat.id)   # ensure absence of previous word
-    callback([msg.chat.id], new_pair)
-    permitted_for_answer[msg.chat.id] = True
-    permitted_for_update[msg.chat.id] = False
+    with current_tenant().sessions.session(msg.chat.id) as session:
+        session.pending = []    # ensure absence of previous words
+        session.mode = ANSWER
+    callback([msg.chat.id], {msg.chat.id: [new_pair]}, INTERACTIVE)
 
 
-@bot.message_handler(commands=['reveal_last'], func=is_registered)
+@message_router.route(REGISTERED, commands=['reveal_last'])
 def reveal_word_handler(msg):
     """
     "I forgot translation - give it to me!"
@@ -121,27 +443,244 @@ def reveal_word_handler(msg):
     :param msg: message
     :return: None
     """
-    global words_buffer
-    resp = words_buffer.get(msg.chat.id, None)
-    if resp is None:
+    with current_tenant().sessions.session(msg.chat.id) as session:
+        pair = session.pending.pop() if session.pending else None
+    if pair is None:
         resp = "Looks like there is no scheduled words for you yet, " \
                "or you already answered one."
     else:
-        resp = resp[1]
-    bot.send_message(msg.chat.id, resp)
+        resp = pair[1]
+    send_message(msg.chat.id, resp)
 
 
-@bot.message_handler(commands=['show_words'], func=is_registered)
-def show_words_helper(msg):
-    db = DBManager(DB_PATH)
+@callback_query_handler(func=lambda call:
+                        call.data.startswith(REVEAL_PREFIX))
+def reveal_button_handler(call):
+    """
+    "Reveal" inline button of questions message
+
+    :param call: callback query
+    :return: None
+    """
+    uid = call.message.chat.id
+    key = call.data[len(REVEAL_PREFIX):]
+    with current_tenant().sessions.session(uid) as session:
+        pair = next((p for p in session.pending if question_key(p) == key),
+                    None)
+        if pair is not None:
+            session.pending.remove(pair)
+    get_bot().answer_callback_query(call.id)
+    if pair is None:
+        send_message(uid, "This question is already answered")
+    else:
+        send_message(uid, " - ".join(pair))
+
+
+@callback_query_handler(func=lambda call:
+                        call.data.startswith(QUIZ_PREFIX))
+def quiz_button_handler(call):
+    """
+    Choice of quiz question: answer is correct if key of chosen pair is
+    the key of question
+
+    :param call: callback query
+    :return: None
+    """
+    uid = call.message.chat.id
+    key, chosen = parse_quiz_answer(call.data)
+    with current_tenant().sessions.session(uid) as session:
+        pair = next((p for p in session.pending if question_key(p) == key),
+                    None)
+        if pair is not None:
+            session.pending.remove(pair)
+    get_bot().answer_callback_query(call.id)
+    if pair is None:
+        send_message(uid, "This question is already answered")
+        return
+    correct = chosen == key
+    db = DBManager(current_tenant().db_path)
     db.connect()
-    resp_data = db.get_all_words_by_uid(msg.chat.id)
+    db.record_answer(uid, pair, correct)
+    db.disconnect()
+    if correct:
+        send_message(uid, "Correct!")
+    else:
+        send_message(uid, "Incorrect: " + " - ".join(pair))
+
+
+@message_router.route(REGISTERED, commands=['quiz'])
+def quiz_handler(msg):
+    """
+    /quiz [on|off] -- switches between multiple-choice and free-text
+    questions, toggles if no argument given
+
+    :param msg: message
+    :return: None
+    """
+    raw_data = msg.text.split()
+    action = raw_data[1].lower() if len(raw_data) > 1 else None
+    if action not in (None, 'on', 'off'):
+        send_message(msg.chat.id, "Usage: /quiz [on|off]")
+        return
+    with current_tenant().sessions.session(msg.chat.id) as session:
+        session.quiz = not session.quiz if action is None else action == 'on'
+        quiz = session.quiz
+    send_message(msg.chat.id, "Questions will be asked as quiz" if quiz
+                 else "Questions will be asked as free text")
+
+
+@message_router.route(REGISTERED, commands=['show_words'])
+def show_words_helper(msg):
+    resp_data = vocabulary_cache.get((current_tenant().db_path, msg.chat.id))
+    if resp_data is None:
+        db = DBManager(current_tenant().db_path)
+        db.connect()
+        resp_data = vocabulary_cache.load(db, msg.chat.id)
+        db.disconnect()
     if not resp_data:
         resp = "No words uploaded yet"
     else:
         resp = " ".join(map(lambda s: " - ".join(s) + '\n', resp_data)) + ' '
-    bot.send_message(msg.chat.id, resp)
+    send_message(msg.chat.id, resp, BULK)
+
+
+@message_router.route(REGISTERED, commands=['find'])
+def find_handler(msg):
+    """
+    "Have I already added this word?" -- full-text search in user's words
+
+    :param msg: message
+    :return: None
+    """
+    raw_data = msg.text.split(' ', 1)
+    if len(raw_data) != 2 or not raw_data[1].strip():
+        send_message(msg.chat.id, "Type a word to search for: /find <word>")
+        return
+    db = DBManager(current_tenant().db_path)
+    db.connect()
+    found = db.search_words(msg.chat.id, raw_data[1], FIND_RESULTS_LIMIT)
     db.disconnect()
+    if not found:
+        resp = "Nothing found"
+    else:
+        resp = "\n".join(map(lambda s: " - ".join(s), found))
+    send_message(msg.chat.id, resp)
+
+
+@message_router.route(REGISTERED, commands=['export'])
+def export_handler(msg):
+    """
+    "Give me all my words as a file" -- words are streamed from database
+    cursor straight into temporary file, its content is sent as document
+    (requests builds multipart body in memory anyway, and outbound may
+    send it several times)
+
+    :param msg: message
+    :return: None
+    """
+    raw_data = msg.text.split()
+    fmt = raw_data[1].lower() if len(raw_data) > 1 else CSV
+    if fmt not in FORMATS:
+        send_message(msg.chat.id, "Supported formats: " + ", ".join(FORMATS))
+        return
+    name = 'words.' + fmt
+    db = DBManager(current_tenant().db_path)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, name)
+        db.connect()
+        try:
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                count = export_words(db, msg.chat.id, f, fmt)
+        finally:
+            db.disconnect()
+        with open(path, 'rb') as f:
+            content = f.read()
+    if not count:
+        send_message(msg.chat.id, "No words uploaded yet")
+        return
+    outbound.submit(BULK, get_bot().send_document, msg.chat.id,
+                    (name, content))
+
+
+@message_router.route(REGISTERED, commands=['import'])
+def import_info_handler(msg):
+    send_message(msg.chat.id, "Send me .csv (word_from,word_to rows) or "
+                              ".jsonl ({\"word_from\": ..., \"word_to\": ...} "
+                              "lines) document with your words")
+
+
+@message_router.route(REGISTERED, content_type='document')
+def import_handler(msg):
+    """
+    Document upload handler: file is streamed from telegram servers and
+    inserted into database by chunks
+
+    :param msg: message
+    :return: None
+    """
+    doc = msg.document
+    fmt = format_by_filename(doc.file_name)
+    if fmt is None:
+        send_message(msg.chat.id, "Only .csv and .jsonl documents "
+                                  "can be imported")
+        return
+    if doc.file_size and doc.file_size > IMPORT_MAX_FILE_SIZE:
+        send_message(msg.chat.id, "Document is too large")
+        return
+    import requests
+    import telebot as tb
+    db = DBManager(current_tenant().db_path)
+    db.connect()
+    try:
+        url = get_bot().get_file_url(doc.file_id)
+        with requests.get(url, stream=True,
+                          timeout=IMPORT_DOWNLOAD_TIMEOUT) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            f = io.TextIOWrapper(resp.raw, encoding='utf-8', newline='')
+            imported, skipped = import_words(db, msg.chat.id, f, fmt)
+    except UnicodeDecodeError:
+        send_message(msg.chat.id, "Document has to be utf-8 encoded")
+    except (requests.RequestException, tb.apihelper.ApiException):
+        send_message(msg.chat.id, "Failed to download document, "
+                                  "try again later")
+    else:
+        send_message(msg.chat.id, "Imported words: {}\nSkipped rows: {}"
+                                  .format(imported, skipped))
+    finally:
+        db.disconnect()
+
+
+@message_router.route(REGISTERED, commands=['stats'])
+def stats_handler(msg):
+    """
+    "How good am I?" -- reads only precomputed rollups, so response time
+    does not depend on history length
+
+    :param msg: message
+    :return: None
+    """
+    db = DBManager(current_tenant().db_path)
+    db.connect()
+    stats = db.get_stats_by_uid(msg.chat.id)
+    db.disconnect()
+    if stats is None:
+        send_message(msg.chat.id, "No statistics collected yet")
+        return
+    answers = stats['answers']
+    correct = stats['correct_answers']
+    accuracy = 100 * correct / answers if answers else 0
+    avg_time = stats['total_answer_time'] / answers if answers else 0
+    resp = "Questions asked: {}\n" \
+           "Answers given: {}\n" \
+           "Correct answers: {} ({:.0f}%)\n" \
+           "Words learned: {}\n" \
+           "Average answer time: {:.0f} sec".format(stats['questions'],
+                                                     answers, correct,
+                                                     accuracy,
+                                                     stats['learned_words'],
+                                                     avg_time)
+    send_message(msg.chat.id, resp)
 
 
 def is_valid_time_string(time_str: str) -> bool:
@@ -155,7 +694,7 @@ def is_valid_time_string(time_str: str) -> bool:
     return True
 
 
-@bot.message_handler(commands=['add_time'], func=is_registered)
+@message_router.route(REGISTERED, commands=['add_time'])
 def add_time_handler(msg):
     """
     "Send me message ALSO at this time"
@@ -165,40 +704,89 @@ def add_time_handler(msg):
     """
     raw_data = msg.text.split(' ')
     if len(raw_data) != 2 or not is_valid_time_string(raw_data[1]):
-        bot.send_message(msg.chat.id,
+        send_message(msg.chat.id,
                          "Inconsistent time format, try to stick with hh:mm:ss")
     else:
         time_string = raw_data[1]
-        db = DBManager(DB_PATH)
+        db = DBManager(current_tenant().db_path)
         db.connect()
         db.add_scheduled_time_by_uid(msg.chat.id, time_string)
-        bot.send_message(msg.chat.id,
+        send_message(msg.chat.id,
                          f"Time {time_string} added in schedule")
 
 
-@bot.message_handler(commands=['add_words'], func=is_registered)
+@message_router.route(REGISTERED, commands=['add_every'])
+def add_every_handler(msg):
+    """
+    "Send me message every N minutes from .. to .. [on these days]"
+
+    :param msg: message
+    :return: None
+    """
+    raw_data = msg.text.split()
+    if not 4 <= len(raw_data) <= 5 or not raw_data[1].isdigit():
+        send_message(msg.chat.id, "Try /add_every <minutes> <hh:mm> <hh:mm> "
+                                  "[mon-fri]")
+        return
+    try:
+        weekdays = parse_weekdays(raw_data[4]) if len(raw_data) == 5 \
+            else EVERY_DAY
+        rule = make_rule(raw_data[2], raw_data[3], int(raw_data[1]),
+                         weekdays)
+    except ScheduleRuleError as e:
+        send_message(msg.chat.id, str(e))
+        return
+    db = DBManager(current_tenant().db_path)
+    db.connect()
+    rule_id = db.add_schedule_rule(msg.chat.id, rule)
+    db.disconnect()
+    send_message(msg.chat.id, f"Rule #{rule_id} added in schedule: "
+                              f"{format_rule(rule)}")
+
+
+@message_router.route(REGISTERED, commands=['remove_rule'])
+def remove_rule_handler(msg):
+    raw_data = msg.text.split()
+    rule_id = raw_data[1].lstrip('#') if len(raw_data) == 2 else ''
+    if not rule_id.isdigit():
+        send_message(msg.chat.id, "Try /remove_rule <id>")
+        return
+    db = DBManager(current_tenant().db_path)
+    db.connect()
+    removed = db.delete_schedule_rule(msg.chat.id, int(rule_id))
+    db.disconnect()
+    send_message(msg.chat.id, "Rule removed" if removed else "No such rule")
+
+
+@message_router.route(REGISTERED, commands=['add_words'])
 def add_words_handler(msg):
-    bot.send_message(msg.chat.id,
+    send_message(msg.chat.id,
                      "Send me your notes in next message\n "
                      "(Type BREAK to abandon)")
-    permitted_for_answer[msg.chat.id] = False
-    permitted_for_update[msg.chat.id] = True
+    current_tenant().sessions.set_mode(msg.chat.id, UPLOAD)
 
 
-@bot.message_handler(commands=['schedule'], func=is_registered)
+@message_router.route(REGISTERED, commands=['schedule'])
 def schedule_helper(msg):
-    db = DBManager(DB_PATH)
+    db = DBManager(current_tenant().db_path)
     db.connect()
     schedule = db.get_schedule_by_uid(msg.chat.id)
-    if not schedule:
+    rules = db.get_schedule_rules_by_uid(msg.chat.id)
+    db.disconnect()
+    if not schedule and not rules:
         resp = "You haven't schedule any questions yet"
     else:
-        resp = "\n".join(schedule)
-    bot.send_message(msg.chat.id, resp)
+        now = datetime.datetime.now()
+        lines = list(schedule)
+        for rule_id, rule in rules:
+            fire = next_fire(rule, now)
+            lines.append(f"#{rule_id} {format_rule(rule)}" +
+                         (f" (next at {fire:%a %H:%M})" if fire else ""))
+        resp = "\n".join(lines)
+    send_message(msg.chat.id, resp)
 
 
-@bot.message_handler(func=lambda msg:
-                     permitted_for_answer.get(msg.chat.id, False))
+@message_router.route([ANSWER])
 def answer_handler(msg):
     """
     Translation attempt handler
@@ -206,96 +794,294 @@ def answer_handler(msg):
     :param msg:
     :return:
     """
-    global words_buffer
-    if msg.chat.id in words_buffer \
-       and msg.text.lower().strip() in words_buffer[msg.chat.id][1].lower():
-        words_buffer.pop(msg.chat.id)
-        bot.send_message(msg.chat.id, "Correct!")
-    else:
-        if is_registered(msg):
-            bot.send_message(msg.chat.id, "Incorrect, try again.")
+    if msg.text.startswith('/'):
+        # unknown commands (and mistyped ones) are routed here as text,
+        # they are not answers
+        send_message(msg.chat.id, "Unknown command, see /info")
+        return
+    answer = msg.text.lower().strip()
+    with current_tenant().sessions.session(msg.chat.id) as session:
+        pending = session.pending
+        # answer is matched against all pending questions, incorrect answer
+        # is attributed to the oldest one
+        word = next((pair for pair in pending
+                     if answer in pair[1].lower()), None)
+        correct = word is not None
+        if correct:
+            pending.remove(word)
+        elif pending:
+            word = pending[0]
+        left = len(pending)
+    if word is not None:
+        db = DBManager(current_tenant().db_path)
+        db.connect()
+        db.record_answer(msg.chat.id, word, correct)
+        db.disconnect()
+    if correct:
+        if left:
+            send_message(msg.chat.id,
+                         "Correct! {} more to answer.".format(left))
         else:
-            bot.send_message(msg.chat.id, "You are not registered"
-                                          "Type /start to begin")
+            send_message(msg.chat.id, "Correct!")
+    else:
+        send_message(msg.chat.id, "Incorrect, try again.")
+
+
+_dictionary = None
+
 
+def get_dictionary():
+    """
+    :return: offline dictionary (memory-mapped once per process) or None,
+             if it is not compiled
+    """
+    global _dictionary
+    if _dictionary is None and os.path.exists(DICTIONARY_PATH):
+        _dictionary = Dictionary(DICTIONARY_PATH)
+    return _dictionary
 
-@bot.message_handler(func=lambda msg:
-                     permitted_for_update.get(msg.chat.id, False))
+
+@message_router.route([UPLOAD])
 def upload_handler(msg):
-    permitted_for_update[msg.chat.id] = False
-    permitted_for_answer[msg.chat.id] = True
+    current_tenant().sessions.set_mode(msg.chat.id, ANSWER)
     plain_text = msg.text
     if plain_text.strip().lower() == 'break':
-        bot.send_message(msg.chat.id, "Upload abandoned")
+        send_message(msg.chat.id, "Upload abandoned")
         return
     processed, unprocessed = parse(plain_text)
-    db = DBManager(DB_PATH)
+    db = DBManager(current_tenant().db_path)
     db.connect()
     db.add_words(msg.chat.id, processed)
     resp1 = "Processed words:" + \
             " ".join(map(lambda s: " ".join(s) + '\n', processed)) + "\n"
     resp2 = "Unprocessed words:" + \
             " ".join(map(lambda s: " ".join(s) + '\n', unprocessed))
-    bot.send_message(msg.chat.id, resp1 + resp2)
+    dictionary = get_dictionary()
+    if dictionary is not None:
+        suggested = suggest_translations(dictionary,
+                                         (left for left, _ in unprocessed
+                                          if left))
+        if suggested:
+            resp2 += "\nSuggested translations (edit and send them with " \
+                     "/add_words):\n" + \
+                     "\n".join(map(lambda s: " ".join(s), suggested))
+    send_message(msg.chat.id, resp1 + resp2)
 
 
-def update_words_buffer_with(data: dict):
+def update_pending_questions(data: dict) -> dict:
     """
-    Modified behavior of dictionary updating: new records do not rewrite
-    already present ones -- such behaviour required because
-    word buffer contains all users's last words, and given function
-    is called whenever a new user needs to be notified, hence
-    data, which is already present in dict is supposed to be unharmed.
+    New words do not rewrite already pending ones, but are merged with
+    them -- session contains all users's unanswered words, which are
+    supposed to be asked again along with new ones.
 
-    :param data:
-    :return:
+    :param data: dict({uid: [(word_from, word_to), ...]})
+    :return: dict({uid: Session}) -- updated sessions
     """
-    global words_buffer
-    for k, v in data.items():
-        # assure that word was answered correctly
-        if k not in words_buffer.keys():
-            words_buffer[k] = v
+    with current_tenant().sessions.transaction() as trans:
+        for uid, words in data.items():
+            session = trans.get(uid)
+            session.pending = merge_questions(session.pending, words,
+                                              MAX_PENDING_QUESTIONS)
+    return {uid: trans.get(uid) for uid in data}
 
 
-def callback(uids: list, words: dict):
+def send_quiz(uid, questions: list, lane):
+    """
+    Sends every question as separate multiple-choice message, distractors
+    are picked from user's vocabulary
+
+    :param uid: user id
+    :param questions: [(word_from, word_to), ...]
+    :param lane: outbound lane
+    :return: None
+    """
+    words = vocabulary_cache.get((current_tenant().db_path, uid))
+    if words is None:
+        db = DBManager(current_tenant().db_path)
+        db.connect()
+        words = vocabulary_cache.load(db, uid)
+        db.disconnect()
+    for pair in questions:
+        text, markup = build_quiz_message(
+            pair, build_choices(words, pair, QUIZ_CHOICES))
+        send_message(uid, text, lane, reply_markup=markup)
+
+
+def callback(uids: list, words: dict, lane=SCHEDULED):
     """
     Callback function. Awaits for two provided arguments
-    (uid: list, new_words: list)
+    (uid: list, new_words: dict)
 
     uid -           list of user id's, which needs to be traversed and each user
-                    supposed to be notified with new (or probably old, but
-                    incorrectly answered word)
-    new_words -     dictionary (uid: (word_from, word_to)) new words for each
-                    user in case old one was answered correct
+                    supposed to be notified with new (and probably old, but
+                    not answered yet words)
+    new_words -     dictionary (uid: [(word_from, word_to), ...]) new words
+                    for each user, they are merged with pending ones and all
+                    of them are sent in one message
     :param uids:
     :param words:
+    :param lane: outbound lane for questions (forced words are interactive)
     :return:
     """
-    update_words_buffer_with(words)
+    updated = update_pending_questions(words)
+    asked = {}
     for id in uids:
-        if id in words_buffer.keys():
-            bot.send_message(id, "Translation for: " + words_buffer[id][0])
+        session = updated.get(id, None)
+        if session is None:
+            session = current_tenant().sessions.get(id)
+        if not session.pending:
+            continue
+        asked[id] = session.pending
+        if session.quiz:
+            send_quiz(id, session.pending, lane)
+        else:
+            text, markup = build_questions_message(session.pending)
+            send_message(id, text, lane, reply_markup=markup)
+    if asked:
+        db = DBManager(current_tenant().db_path)
+        db.connect()
+        db.record_questions(asked)
+        db.disconnect()
 
 
 def _initialize_variables():
-    db = DBManager(DB_PATH)
+    """
+    Loads all registered users of current tenant into buffer, runs in
+    background while bot is already serving updates
+
+    :return: None
+    """
+    tenant = current_tenant()
+    db = DBManager(tenant.db_path)
     db.connect()
     uids = db.get_uids()
+    tenant.registered_users.update(uids)
+    db.disconnect()
+    tenant.warmed_up.set()
 
-    for uid in uids:
-        permitted_for_answer[uid] = True
-        permitted_for_update[uid] = False
-    registered_users_buffer.update(uids)
+
+def _resume_broadcasts():
+    """
+    Broadcasts of current tenant interrupted by restart are resumed from
+    their checkpoints
+
+    :return: None
+    """
+    db = DBManager(current_tenant().db_path)
+    db.connect()
+    for broadcast_id in db.get_unfinished_broadcasts():
+        start_broadcast(broadcast_id)
     db.disconnect()
 
 
-def run_bot(polling_delay):
-    _initialize_variables()
+def send_fired_words(counts: dict):
+    """
+    Picks words for scheduled fires and sends them (in worker process,
+    which owns users, so its vocabulary cache is up to date)
+
+    :param counts: dict({uid: number of words})
+    :return: None
+    """
+    db = DBManager(current_tenant().db_path)
+    db.connect()
+    words = build_random_word_lists_by_uids(db, counts)
+    db.disconnect()
+    if words:
+        callback(list(words), words)
+
+
+def worker_main(index, updates, acks):
+    """
+    Worker process: handles updates and scheduled fires routed by chat id
+    (target of UpdateRouter)
+
+    :param index: worker index
+    :param updates: multiprocessing queue of (kind, payload, ticket) items
+    :param acks: multiprocessing queue of tickets of handled items
+    :return: None
+    """
+    from telegram_language_bot.client import create_bot
+    setup_logging(LOG_PATH, LOG_LEVEL, LOG_SAMPLING, LOG_RATE_LIMITS)
+    # admission is checked by polling process, updates of one user are
+    # handled in order of arrival, item is acknowledged once it is handled
+    bot = default_tenant.bot = create_bot(default_tenant.token, None, None,
+                                          telebot_message_handlers(),
+                                          callback_query_handlers,
+                                          threaded=False)
+    Thread(target=_initialize_variables, name='WarmUp', daemon=True).start()
+    outbound.start()
+    while True:
+        item = updates.get()
+        if item is None:
+            break
+        kind, payload, ticket = item
+        try:
+            if kind == MESSAGE:
+                bot.process_new_messages([payload])
+            elif kind == CALLBACK_QUERY:
+                bot.process_new_callback_query([payload])
+            elif kind == FIRES:
+                send_fired_words(payload)
+            elif kind == INVALIDATE:
+                for uid in payload:
+                    vocabulary_cache.invalidate((default_tenant.db_path,
+                                                 uid))
+        finally:
+            # polling process saves offset once routed updates are handled
+            if ticket is not None:
+                acks.put(ticket)
+    outbound.stop()
+
+
+def _toggle_profiler_on_signal():
+    # SIGUSR1 toggles profiler (kill -USR1 <pid>)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: toggle_profiler())
 
-    t1 = Thread(target=bot.polling,
-                kwargs={"none_stop": True, 'interval': 1})
-    t2 = Thread(target=dispatch_mainloop,
-                args=(DB_PATH, polling_delay, callback))
+
+def run_bot(polling_delay, workers=UPDATE_WORKERS):
+    """
+    :param polling_delay: dispatcher delay
+    :param workers: number of worker processes handling updates
+                    (0 - updates are handled by polling process)
+    :return: None
+    """
+    router = None
+    executor = None
+    select = build_random_word_lists_by_uids
+    # archived words are removed from caches of workers
+    on_archive = None
+    if workers:
+        # workers have to be forked before any thread is started
+        router = UpdateRouter(workers, worker_main)
+        router.start()
+        select = lambda db, counts: counts
+        dispatch = lambda uids, counts: router.route_fires(counts)
+        on_archive = router.route_invalidations
+    else:
+        dispatch = callback
+        # handlers are awaited by polling before offset is saved
+        handlers = ThreadPoolExecutor(UPDATE_HANDLER_THREADS,
+                                      thread_name_prefix='Handler')
+        executor = handlers.submit
+    setup_logging(LOG_PATH, LOG_LEVEL, LOG_SAMPLING, LOG_RATE_LIMITS)
+    db_path = default_tenant.db_path
+    bot = get_bot(router, executor)
+    Thread(target=_initialize_variables, name='WarmUp', daemon=True).start()
+    outbound.start()
+    _resume_broadcasts()
+    _toggle_profiler_on_signal()
+
+    t1 = Thread(target=polling_mainloop, name='Polling',
+                args=(bot, db_path))
+    t2 = Thread(target=dispatch_mainloop, name='Dispatcher',
+                args=(db_path, polling_delay, dispatch, select))
+
+    Thread(target=maintenance_mainloop, name='Maintenance', daemon=True,
+           args=(db_path, on_archive)).start()
+    if DB_BACKEND == 'sqlite':
+        Thread(target=backup_mainloop, name='Backup', daemon=True,
+               args=(db_path, )).start()
 
     t1.start()
     t2.start()
@@ -304,6 +1090,50 @@ def run_bot(polling_delay):
     t2.join()
 
 
+def run_tenants(config_path, polling_delay):
+    """
+    Hosts all bots listed in tenants config in one process: outbound
+    workers, handler threads, database connections, dispatcher,
+    maintenance and backup threads are shared, every tenant adds only its
+    own state and polling thread
+
+    :param config_path: tenants config (see telegram_language_bot.tenants)
+    :param polling_delay: dispatcher delay
+    :return: None
+    """
+    tenants = load_tenants(config_path)
+    setup_logging(LOG_PATH, LOG_LEVEL, LOG_SAMPLING, LOG_RATE_LIMITS)
+    handlers = ThreadPoolExecutor(TENANT_HANDLER_THREADS,
+                                  thread_name_prefix='Handler')
+    outbound.start()
+    pollers = []
+    for tenant in tenants:
+        executor = functools.partial(handlers.submit, tenant.run)
+        bot = tenant.run(get_bot, executor=executor)
+        Thread(target=tenant.bind(_initialize_variables),
+               name='WarmUp-' + tenant.name, daemon=True).start()
+        tenant.run(_resume_broadcasts)
+        pollers.append(Thread(target=tenant.bind(polling_mainloop),
+                              name='Polling-' + tenant.name,
+                              args=(bot, tenant.db_path)))
+    _toggle_profiler_on_signal()
+
+    paths = [tenant.db_path for tenant in tenants]
+    dispatcher = Thread(target=multi_dispatch_mainloop, name='Dispatcher',
+                        args=({tenant.db_path: tenant.bind(callback)
+                               for tenant in tenants}, polling_delay))
+    Thread(target=maintenance_mainloop, name='Maintenance', daemon=True,
+           args=(paths, )).start()
+    if DB_BACKEND == 'sqlite':
+        Thread(target=backup_mainloop, name='Backup', daemon=True,
+               args=(paths, )).start()
+
+    for thread in pollers + [dispatcher]:
+        thread.start()
+    for thread in pollers + [dispatcher]:
+        thread.join()
+
+
 if __name__ == '__main__':
     pass
 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Broadcast jobs: message to every registered user.
+
+    Users are iterated by keyset cursor in chunks, so memory usage does not
+depend on number of users. Chunk is sent through rate-limited outbound
+workers, then delivery statuses and cursor are saved in one transaction.
+Interrupted job resumes from the last saved cursor, so only the last
+(unsaved) chunk may be delivered twice. Database connection is held only
+while chunk is read and saved, not while it is sent.
+"""
+
+
+import queue
+import time
+from contextlib import contextmanager
+
+from language_bot_core import DBManager
+from language_bot_core.logs import get_logger, log_event
+from telegram_language_bot.constants import BROADCAST_CHUNK_TIMEOUT
+from telegram_language_bot.outbound import retry_after
+
+
+logger = get_logger('broadcast')
+
+# log event category
+BROADCAST = 'broadcast'
+
+# delivery statuses
+SENT = 'sent'
+FAILED = 'failed'
+
+
+@contextmanager
+def _connected(db: DBManager):
+    db.connect()
+    try:
+        yield db
+    finally:
+        db.disconnect()
+
+
+def _collect(results: queue.Queue, uids: list, timeout: float) -> list:
+    """
+    :param results: queue of reported deliveries
+    :param uids: users of chunk
+    :param timeout: max seconds to wait for all deliveries
+    :return: [(uid, status, error), ...] deliveries of all users in
+             order of uids, not reported ones are failed
+    """
+    deadline = time.monotonic() + timeout
+    reported = {}
+    while len(reported) < len(uids):
+        try:
+            delivery = results.get(
+                timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            break
+        reported[delivery[0]] = delivery
+    return [reported.get(uid, (uid, FAILED, 'timeout')) for uid in uids]
+
+
+def run_broadcast(db: DBManager, broadcast_id: int, submit, send,
+                  chunk_size: int,
+                  timeout: float = BROADCAST_CHUNK_TIMEOUT) -> dict:
+    """
+    Sends broadcast to all users starting after its cursor
+
+    :param db: DBManager instance (disconnected, it is connected only to
+               read and save chunks)
+    :param broadcast_id: broadcast id
+    :param submit: callable(func, *args), schedules func(*args) call
+                   (i.e. enqueues it into outbound lane)
+    :param send: callable(uid, text), delivers message to user
+    :param chunk_size: number of users processed between checkpoints
+    :param timeout: max seconds to wait for deliveries of one chunk,
+                    messages not delivered by then (i.e. dropped after
+                    too many retries) are saved as failed
+    :return: dict({delivery status: number of users})
+    """
+    with _connected(db):
+        broadcast = db.get_broadcast(broadcast_id)
+    text, cursor = broadcast['text'], broadcast['cursor']
+
+    def deliver(results, uid):
+        try:
+            send(uid, text)
+        except Exception as e:
+            # message rejected with 429 is retried by outbound
+            if retry_after(e) is None:
+                results.put((uid, FAILED, repr(e)))
+            raise
+        results.put((uid, SENT, None))
+
+    while broadcast['finished'] is None:
+        with _connected(db):
+            uids = db.get_uids_after(cursor, chunk_size)
+            if not uids:
+                db.finish_broadcast(broadcast_id)
+        if not uids:
+            break
+        # late deliveries of previous chunk do not get into this one
+        results = queue.Queue()
+        for uid in uids:
+            submit(deliver, results, uid)
+        deliveries = _collect(results, uids, timeout)
+        cursor = uids[-1]
+        with _connected(db):
+            db.checkpoint_broadcast(broadcast_id, cursor, deliveries)
+        log_event(logger, BROADCAST, broadcast_id=broadcast_id,
+                  cursor=cursor, sent=len(uids))
+    with _connected(db):
+        return db.get_broadcast_stats(broadcast_id)
+
+
+def broadcast_job(path: str, broadcast_id: int, submit, send,
+                  chunk_size: int, on_finish=None):
+    """
+    run_broadcast with own database connection, intended to be target
+    of Thread
+
+    :param on_finish: callable(broadcast_id, stats), invoked when all
+                      users are processed
+    :return: None
+    """
+    stats = run_broadcast(DBManager(path), broadcast_id, submit, send,
+                          chunk_size)
+    log_event(logger, BROADCAST, broadcast_id=broadcast_id, finished=True,
+              **stats)
+    if on_finish is not None:
+        on_finish(broadcast_id, stats)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Telegram client construction. This module pulls in telebot (and requests)
+and is imported only when bot is actually created (see bot.get_bot).
+"""
+
+
+import telebot as tb
+
+from telegram_language_bot.admission import ADMITTED
+from telegram_language_bot.workers import MESSAGE, CALLBACK_QUERY
+
+
+class AdmittingTeleBot(tb.TeleBot):
+    """TeleBot which passes to handlers only messages and callback queries
+    admitted by admission controller (checked in polling thread, rejected
+    callback queries are dropped silently). If router is given,
+    updates are handed over to worker processes instead of handlers. If
+    executor is given, handlers are run by it instead of bot's own thread
+    pool. Futures of handlers (or of handling by workers) are collected by
+    take_pending.
+    """
+
+    def __init__(self, token, admission, on_reject, router=None,
+                 executor=None, **kwargs):
+        if executor is not None:
+            kwargs['threaded'] = False
+        super().__init__(token, **kwargs)
+        self.admission = admission
+        self.on_reject = on_reject
+        self.router = router
+        self.executor = executor
+        self._pending = []
+
+    def _exec_task(self, task, *args, **kwargs):
+        if self.executor is None:
+            super()._exec_task(task, *args, **kwargs)
+        else:
+            self._pending.append(self.executor(task, *args, **kwargs))
+
+    def take_pending(self) -> list:
+        """
+        :return: futures of handlers of updates processed since previous
+                 call (handlers run by bot's own threads are not tracked)
+        """
+        pending, self._pending = self._pending, []
+        return pending
+
+    def process_new_messages(self, new_messages):
+        admitted = []
+        for msg in new_messages:
+            if self.admission is None:
+                admitted.append(msg)
+                continue
+            status = self.admission.check(msg.chat.id, msg.text)
+            if status == ADMITTED:
+                admitted.append(msg)
+            self.on_reject(msg, status)
+        if not admitted:
+            return
+        if self.router is None:
+            super().process_new_messages(admitted)
+        else:
+            for msg in admitted:
+                self._pending.append(
+                    self.router.route(msg.chat.id, MESSAGE, msg))
+
+    def process_new_callback_query(self, new_callback_queries):
+        if self.admission is not None:
+            # button presses share token bucket with messages of chat
+            # (handlers key sessions by chat id as well)
+            new_callback_queries = [
+                call for call in new_callback_queries
+                if self.admission.check(call.message.chat.id, '') ==
+                ADMITTED]
+        if not new_callback_queries:
+            return
+        if self.router is None:
+            super().process_new_callback_query(new_callback_queries)
+        else:
+            for call in new_callback_queries:
+                self._pending.append(self.router.route(
+                    call.message.chat.id, CALLBACK_QUERY, call))
+
+
+def create_bot(token, admission, on_reject, message_handlers,
+               callback_query_handlers, router=None, executor=None,
+               threaded=True):
+    """
+    Builds bot and registers handlers in given order
+
+    :param token: bot API token
+    :param admission: AdmissionController instance (None to admit all
+                      messages)
+    :param on_reject: callable(msg, admission status), invoked for
+                      every incoming message
+    :param message_handlers: [(handler, filters dict), ...]
+    :param callback_query_handlers: [(handler, filters dict), ...]
+    :param router: UpdateRouter instance, if updates are handled by
+                   worker processes
+    :param executor: callable(handler, *args) -> Future, runs handler
+                     (i.e. in thread pool shared by several bots)
+    :param threaded: False to run handlers in the calling thread
+    :return: AdmittingTeleBot instance
+    """
+    bot = AdmittingTeleBot(token, admission, on_reject, router, executor,
+                           threaded=threaded)
+    for handler, filters in message_handlers:
+        bot.message_handler(**filters)(handler)
+    for handler, filters in callback_query_handlers:
+        bot.callback_query_handler(**filters)(handler)
+    return bot
@@ -37,6 +37,114 @@ COMMANDS = {
             'reveal_last': 'show translation for last word and skip it',
             'show_words': 'show full list of uploaded words',
             'add_time': 'add time to schedule 00:00:00 - 23:59:59',
+            'add_every': 'add periodic schedule: '
+                         '/add_every <minutes> <hh:mm> <hh:mm> [mon-fri]',
+            'remove_rule': 'remove periodic schedule: /remove_rule <id>',
             'add_words': 'add words',
-            'schedule': 'list your timetable for questions'
+            'schedule': 'list your timetable for questions',
+            'stats': 'show your learning statistics',
+            'find': 'search in your words: /find <word>',
+            'export': 'get your words as document: /export [csv|jsonl]',
+            'import': 'import words from .csv/.jsonl document',
+            'quiz': 'multiple-choice questions: /quiz [on|off]'
             }
+
+# outbound messages rate limits (messages per second), telegram allows
+# about 30 messages per second in total for one bot
+OUTBOUND_GLOBAL_RATE = 30
+OUTBOUND_WORKERS = 4
+# message rejected with 429 Too Many Requests is retried (after retry_after
+# seconds given by telegram) until it is sent this many times
+OUTBOUND_MAX_ATTEMPTS = 3
+
+# lane: (rate, burst capacity), lanes are listed in order of priority
+OUTBOUND_LANES = (
+    ('interactive', 30, 30),
+    ('scheduled', 20, 20),
+    ('bulk', 5, 5),
+)
+
+# inbound flood control: each user may send INBOUND_RATE messages per second
+# with bursts up to INBOUND_BURST, every INBOUND_CHARS_PER_TOKEN characters
+# of message text cost one more token
+INBOUND_RATE = 1
+INBOUND_BURST = 5
+INBOUND_CHARS_PER_TOKEN = 1000
+# identical commands from one user within this window (seconds) are coalesced
+INBOUND_COALESCE_WINDOW = 3
+# longer messages are rejected before any handler is invoked, their tokens
+# are charged anyway (INBOUND_CHARS_PER_TOKEN), so flooding with long
+# texts is throttled; long word lists are expected as /import documents
+INBOUND_MAX_TEXT_LENGTH = 4096
+
+# max number of unanswered questions kept (and sent in one message) per user
+MAX_PENDING_QUESTIONS = 5
+
+# number of translation choices (including correct one) of quiz question
+QUIZ_CHOICES = 4
+
+# max number of words returned by /find
+FIND_RESULTS_LIMIT = 20
+
+# max size (in bytes) of document with words to import (telegram does not
+# allow bots to download files larger than 20MB)
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024
+# seconds to wait for connection to telegram file server and between bytes
+# of downloaded document
+IMPORT_DOWNLOAD_TIMEOUT = 30
+
+# telegram ids of users allowed to use admin commands (e.g. /profile)
+ADMIN_IDS = ()
+
+# compiled offline dictionary (see language_bot_core.dictionary), used to
+# suggest translations for uploaded words without them, optional
+DICTIONARY_PATH = "dictionary.lbd"
+
+# admin broadcast: number of users processed between checkpoints
+BROADCAST_CHUNK_SIZE = 500
+# max seconds to wait for deliveries of one chunk (bulk lane sends
+# 500 messages in 100 seconds), undelivered messages are saved as failed
+BROADCAST_CHUNK_TIMEOUT = 600
+
+# sampling profiler: interval between stack samples (seconds), directory
+# for reports and number of functions in top report
+PROFILER_INTERVAL = 0.005
+PROFILER_DIR = 'profiles'
+PROFILER_TOP_N = 30
+
+# structured logging: events are written as JSON lines to LOG_PATH (stderr
+# if None). LOG_SAMPLING is share of events kept per category, LOG_RATE_LIMITS
+# is max number of events per second per category
+LOG_PATH = None
+LOG_LEVEL = 'INFO'
+LOG_SAMPLING = {
+    'handler': 1.0,
+    'tick': 1.0,
+}
+LOG_RATE_LIMITS = {
+    'handler': 50,
+    'tick': 1,
+    'db_error': 10,
+}
+
+# conversation state shared by update workers (SQLite database in WAL mode)
+SESSIONS_PATH = "sessions.db"
+# number of worker processes handling updates (routed by chat id),
+# 0 - updates are handled by polling process itself
+UPDATE_WORKERS = 0
+# threads running handlers, if updates are handled by polling process
+UPDATE_HANDLER_THREADS = 2
+
+# multi-tenant runtime (see telegram_language_bot.tenants): number of
+# threads running handlers of all hosted bots
+TENANT_HANDLER_THREADS = 8
+
+# updates polling: long polling timeout (seconds) and number of recent
+# update ids remembered to drop duplicates (see telegram_language_bot.updates)
+UPDATES_TIMEOUT = 20
+UPDATES_DEDUPE_WINDOW = 1000
+# number of received updates, still being handled, that are requested again
+# (not confirmed to telegram), and pause (seconds) between requests that
+# return nothing but such updates
+UPDATES_REPLAY_LIMIT = 50
+UPDATES_REPLAY_WAIT = 0.5
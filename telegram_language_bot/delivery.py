@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Per-user questions aggregation: all pending (unanswered) and newly due
+questions are merged and delivered as one message with inline buttons.
+In quiz mode every question is delivered as separate message with
+translation choices, chosen one is sent back as callback_data.
+"""
+
+
+import hashlib
+
+
+REVEAL_PREFIX = 'reveal:'
+QUIZ_PREFIX = 'quiz:'
+
+
+def question_key(pair: tuple) -> str:
+    """
+    Short stable key of question, fits into callback_data limits (two
+    keys of quiz button take 38 of 64 bytes). Both words are hashed, so
+    questions with the same word_from (i.e. homonyms) have distinct keys.
+
+    :param pair: (word_from, word_to)
+    :return: key string
+    """
+    data = '\0'.join(pair).encode('utf-8')
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def merge_questions(pending: list, due: list, limit: int) -> list:
+    """
+    Merges newly due questions into pending ones: duplicates are skipped,
+    oldest questions are dropped if there are more than `limit` of them
+
+    :param pending: [(word_from, word_to), ...] unanswered questions
+    :param due: [(word_from, word_to), ...] new questions
+    :param limit: max number of questions
+    :return: merged list
+    """
+    merged = list(pending)
+    for pair in due:
+        if pair not in merged:
+            merged.append(pair)
+    return merged[-limit:]
+
+
+def build_questions_message(questions: list):
+    """
+    Builds one message asking for all given questions
+
+    :param questions: [(word_from, word_to), ...]
+    :return: (text, inline keyboard markup)
+    """
+    import telebot as tb    # deferred: heavy import, not needed at startup
+
+    if len(questions) == 1:
+        text = "Translation for: " + questions[0][0]
+    else:
+        text = "Translations for:\n" + \
+               "\n".join("{}. {}".format(i, pair[0])
+                         for i, pair in enumerate(questions, 1))
+    markup = tb.types.InlineKeyboardMarkup()
+    buttons = [tb.types.InlineKeyboardButton(
+                   "Reveal" if len(questions) == 1
+                   else "Reveal {}".format(i),
+                   callback_data=REVEAL_PREFIX + question_key(pair))
+               for i, pair in enumerate(questions, 1)]
+    markup.row(*buttons)
+    return text, markup
+
+
+def build_quiz_message(pair: tuple, choices: list):
+    """
+    Builds multiple-choice question, each button carries keys of question
+    and of chosen pair, so answer is checked by comparison of keys
+
+    :param pair: question (word_from, word_to)
+    :param choices: [(word_from, word_to), ...] including pair itself
+    :return: (text, inline keyboard markup)
+    """
+    import telebot as tb    # deferred: heavy import, not needed at startup
+
+    markup = tb.types.InlineKeyboardMarkup()
+    key = question_key(pair)
+    for choice in choices:
+        markup.row(tb.types.InlineKeyboardButton(
+            choice[1], callback_data='{}{}:{}'.format(
+                QUIZ_PREFIX, key, question_key(choice))))
+    return "Choose translation for: " + pair[0], markup
+
+
+def parse_quiz_answer(data: str) -> tuple:
+    """
+    :param data: callback_data of quiz button
+    :return: (question key, chosen key)
+    """
+    key, _, chosen = data[len(QUIZ_PREFIX):].partition(':')
+    return key, chosen
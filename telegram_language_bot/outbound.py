@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Outbound messages scheduling.
+
+    Every message sent by bot is put into one of priority lanes
+(interactive replies, scheduled questions, bulk listings). Sender workers
+always take a message from the most prioritized lane which is not empty
+and did not exhaust its own quota, so thousands of scheduled questions
+never delay replies to users which are chatting with bot right now.
+Message rejected by telegram with "too many requests" is put back to the
+head of its lane and its channel is paused for retry_after seconds.
+
+    Telegram limits are per bot, so when several bots are hosted in one
+process, every bot sends through its own channel (lanes, global rate
+limit and pause deadline), and only worker threads are shared.
+"""
+
+
+import logging
+import time
+from collections import deque
+from threading import Condition, Thread
+
+from language_bot_core.logs import get_logger, log_event
+from telegram_language_bot.utils import TokenBucket
+
+
+logger = get_logger('outbound')
+
+# log event category
+OUTBOUND = 'outbound'
+
+INTERACTIVE = 'interactive'
+SCHEDULED = 'scheduled'
+BULK = 'bulk'
+
+
+def retry_after(error: Exception):
+    """
+    :param error: exception raised by send (telebot ApiException keeps
+                  http response in its result attribute)
+    :return: seconds to wait before retry if telegram rejected request
+             with 429 Too Many Requests, None otherwise
+    """
+    result = getattr(error, 'result', None)
+    if getattr(result, 'status_code', None) != 429:
+        return None
+    try:
+        return float(result.json()['parameters']['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class Lane:
+    """Queue of outgoing messages with own quota and metrics"""
+
+    # number of last latencies kept for percentiles computation
+    latency_window = 1000
+
+    def __init__(self, name: str, rate: float, capacity: float):
+        self.name = name
+        self.queue = deque()
+        self.bucket = TokenBucket(rate, capacity)
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.latencies = deque(maxlen=self.latency_window)
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def latency_percentile(self, percent: float) -> float:
+        if not self.latencies:
+            return 0
+        ordered = sorted(self.latencies)
+        idx = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[idx]
+
+    def metrics(self) -> dict:
+        return {'depth': self.depth,
+                'max_depth': self.max_depth,
+                'enqueued': self.enqueued,
+                'sent': self.sent,
+                'failed': self.failed,
+                'p50': self.latency_percentile(50),
+                'p99': self.latency_percentile(99)}
+
+
+class Channel:
+    """Lanes of one bot with its global rate limit"""
+
+    def __init__(self, lanes, global_rate: float):
+        self.lanes = [Lane(*params) for params in lanes]
+        self.lanes_by_name = {lane.name: lane for lane in self.lanes}
+        self.bucket = TokenBucket(global_rate, global_rate)
+        # monotonic time until which telegram asked not to send anything
+        self.paused_until = 0
+
+    def take(self):
+        """
+        :return: (lane, message) or (None, seconds to wait)
+        """
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            return None, pause
+        delay = None
+        for lane in self.lanes:
+            if not lane.queue:
+                continue
+            lane_delay = lane.bucket.wait_time()
+            if lane_delay:
+                delay = lane_delay if delay is None else min(delay, lane_delay)
+                continue
+            global_delay = self.bucket.wait_time()
+            if global_delay:
+                return None, global_delay
+            lane.bucket.consume()
+            self.bucket.consume()
+            return lane, lane.queue.popleft()
+        return None, delay
+
+
+class OutboundScheduler:
+    """
+    Priority scheduler of outgoing messages.
+
+        `send` is called by worker threads as send(*args, **kwargs) for
+    every submitted message. Lanes are given as (name, rate, capacity)
+    tuples in order of priority. Message is sent at most `max_attempts`
+    times (it is retried only after 429 Too Many Requests), failures are
+    logged. If `channel_key` is given, it is called by submit and returns
+    key of channel of the message (i.e. token of bot which sends it), every
+    channel has own lanes and limits.
+    """
+
+    def __init__(self, send, lanes, global_rate: float, workers: int = 1,
+                 max_attempts: int = 3, channel_key=None):
+        self.send = send
+        self.max_attempts = max_attempts
+        self.lanes = lanes
+        self.global_rate = global_rate
+        self.channel_key = channel_key or (lambda: None)
+        # channel key: Channel, created on first message
+        self.channels = {}
+        self.workers = workers
+        self.cond = Condition()
+        self._threads = []
+        self._running = False
+        # channels are served in turn
+        self._turn = 0
+
+    def submit(self, lane_name: str, *args, **kwargs) -> None:
+        key = self.channel_key()
+        with self.cond:
+            channel = self.channels.get(key)
+            if channel is None:
+                channel = self.channels[key] = Channel(self.lanes,
+                                                       self.global_rate)
+            lane = channel.lanes_by_name[lane_name]
+            lane.queue.append((time.monotonic(), 1, args, kwargs))
+            lane.enqueued += 1
+            lane.max_depth = max(lane.max_depth, lane.depth)
+            self.cond.notify()
+
+    def _take(self):
+        """
+        Picks next message (must be called with acquired condition)
+
+        :return: (channel, lane, message) or (None, None, seconds to wait)
+        """
+        channels = list(self.channels.values())
+        delay = None
+        for i in range(len(channels)):
+            channel = channels[(self._turn + i) % len(channels)]
+            lane, item = channel.take()
+            if lane is not None:
+                self._turn = (self._turn + i + 1) % len(channels)
+                return channel, lane, item
+            if item is not None:
+                delay = item if delay is None else min(delay, item)
+        return None, None, delay
+
+    def process_one(self, timeout: float = None) -> bool:
+        """
+        Sends one message from the most prioritized available lane
+
+        :param timeout: max seconds to wait for a message
+        :return: whether message was processed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                channel, lane, item = self._take()
+                if lane is not None:
+                    break
+                if not self._running and timeout is None:
+                    return False
+                wait = item
+                if deadline is not None:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        return False
+                    wait = left if wait is None else min(wait, left)
+                self.cond.wait(wait)
+        enqueued_at, attempt, args, kwargs = item
+        try:
+            self.send(*args, **kwargs)
+            error = None
+        except Exception as e:
+            error = e
+        wait = None if error is None else retry_after(error)
+        retry = wait is not None and attempt < self.max_attempts
+        with self.cond:
+            if retry:
+                # retried before anything else, once telegram allows it
+                channel.paused_until = max(channel.paused_until,
+                                           time.monotonic() + wait)
+                lane.queue.appendleft((enqueued_at, attempt + 1, args,
+                                       kwargs))
+                self.cond.notify_all()
+            else:
+                if error is None:
+                    lane.sent += 1
+                else:
+                    lane.failed += 1
+                lane.latencies.append(time.monotonic() - enqueued_at)
+        if error is not None:
+            log_event(logger, OUTBOUND, logging.WARNING, lane=lane.name,
+                      attempt=attempt, retry_after=wait, error=repr(error))
+        return True
+
+    def _worker(self):
+        while self._running:
+            self.process_one(timeout=1)
+
+    def start(self) -> None:
+        self._running = True
+        for i in range(self.workers):
+            t = Thread(target=self._worker, name='OutboundWorker{}'.format(i),
+                       daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self) -> None:
+        self._running = False
+        with self.cond:
+            self.cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def metrics(self, key=None) -> dict:
+        """
+        :param key: channel key
+        :return: {lane name: metrics} of the channel
+        """
+        with self.cond:
+            channel = self.channels.get(key)
+            if channel is None:
+                return {}
+            return {lane.name: lane.metrics() for lane in channel.lanes}
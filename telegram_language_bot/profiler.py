@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Low-overhead sampling profiler for running bot.
+
+    Background thread periodically takes stacks of all other threads
+(sys._current_frames) and counts identical stacks. Nothing is hooked into
+profiled code, so overhead is defined only by sampling interval.
+Results are dumped as collapsed stacks (input format of flamegraph.pl,
+speedscope etc.) and top-N hot functions report.
+"""
+
+
+import os
+import sys
+import time
+from collections import Counter
+from threading import Thread, Event, RLock, enumerate as enumerate_threads
+
+
+class ProfilerException(Exception):
+    pass
+
+
+class SamplingProfiler:
+    """Samples stacks of all threads (except own one) every `interval` sec"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self._stop = Event()
+        self._thread = None
+        self._lock = RLock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return "{}:{}".format(os.path.basename(code.co_filename),
+                              code.co_name)
+
+    def _sample(self):
+        own = self._thread.ident
+        names = {t.ident: t.name for t in enumerate_threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-{}'.format(ident)))
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                self._sample()
+
+    def start(self) -> None:
+        with self._lock:
+            if self.running:
+                raise ProfilerException('Profiler is already running')
+            self.stacks = Counter()
+            self.samples = 0
+            self.started = time.time()
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name='SamplingProfiler',
+                                  daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._lock:
+            if not self.running:
+                raise ProfilerException('Profiler is not running')
+            thread = self._thread
+            self._stop.set()
+        thread.join()
+        self._thread = None
+
+    def top(self, n: int) -> list:
+        """
+        :param n: number of functions
+        :return: [(function, self samples, total samples), ...] sorted by
+                 self samples
+        """
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]   # thread name is not a function
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return [(func, samples, total[func])
+                for func, samples in own.most_common(n)]
+
+    def dump(self, directory: str, top_n: int):
+        """
+        Writes collapsed stacks and top-N report into given directory
+
+        :param directory: reports directory (created if absent)
+        :param top_n: number of functions in top report
+        :return: (collapsed stacks path, top report path)
+        """
+        os.makedirs(directory, exist_ok=True)
+        prefix = os.path.join(directory, time.strftime(
+            'profile-%Y%m%d-%H%M%S', time.localtime(self.started)))
+        collapsed_path = prefix + '.collapsed'
+        top_path = prefix + '.top.txt'
+        with open(collapsed_path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        with open(top_path, 'w', encoding='utf-8') as f:
+            f.write("samples: {}, interval: {} sec\n".format(self.samples,
+                                                             self.interval))
+            f.write("{:>8} {:>8}  function\n".format('self%', 'total%'))
+            for func, own, total in self.top(top_n):
+                f.write("{:>8.2f} {:>8.2f}  {}\n".format(
+                    100 * own / max(self.samples, 1),
+                    100 * total / max(self.samples, 1), func))
+        return collapsed_path, top_path
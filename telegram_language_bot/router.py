@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Messages routing.
+
+    Handler is chosen by (content type, command, user mode) key with
+single dict lookup, so routing cost does not depend on number of
+handlers, and which handler receives plain text (answer or upload) is
+decided by user mode only, not by handlers declaration order.
+"""
+
+
+# command of non-command messages
+NO_COMMAND = None
+
+
+def extract_command(text: str):
+    """
+    :param text: message text
+    :return: command without leading '/' and bot name, or NO_COMMAND
+    """
+    if not text or not text.startswith('/'):
+        return NO_COMMAND
+    return text.split(None, 1)[0][1:].split('@', 1)[0]
+
+
+class Router:
+    """
+    Handlers table keyed by (content type, command, mode).
+
+        get_mode(msg) returns current mode of message sender. Middleware
+    is a callable(handler) -> handler, it wraps every routed handler
+    (first added middleware is the outermost one). Unknown commands are
+    routed as plain text.
+    """
+
+    def __init__(self, get_mode):
+        self.get_mode = get_mode
+        self.routes = {}        # key: handler
+        self.middleware = []
+        self._wrapped = {}      # key: handler wrapped with middleware
+
+    @property
+    def content_types(self) -> list:
+        return sorted({content_type for content_type, _, _ in self.routes})
+
+    def _wrap(self, handler):
+        for middleware in reversed(self.middleware):
+            handler = middleware(handler)
+        return handler
+
+    def use(self, middleware) -> None:
+        self.middleware.append(middleware)
+        self._wrapped = {key: self._wrap(handler)
+                         for key, handler in self.routes.items()}
+
+    def add(self, handler, modes, commands=(NO_COMMAND, ),
+            content_type='text') -> None:
+        """
+        :param handler: callable(msg)
+        :param modes: modes in which handler is available
+        :param commands: commands handled, NO_COMMAND for plain messages
+        :param content_type: message content type
+        :return: None
+        """
+        for command in commands:
+            for mode in modes:
+                key = (content_type, command, mode)
+                if key in self.routes:
+                    raise ValueError("Route {} is already taken by {}".format(
+                        key, self.routes[key].__name__))
+                self.routes[key] = handler
+                self._wrapped[key] = self._wrap(handler)
+
+    def route(self, modes, commands=(NO_COMMAND, ), content_type='text'):
+        """Decorator version of add"""
+        def decorator(handler):
+            self.add(handler, modes, commands, content_type)
+            return handler
+        return decorator
+
+    def resolve(self, msg, wrapped: bool = False):
+        """
+        :param msg: message
+        :param wrapped: return handler wrapped with middleware
+        :return: handler or None
+        """
+        table = self._wrapped if wrapped else self.routes
+        command = extract_command(msg.text) \
+            if msg.content_type == 'text' else NO_COMMAND
+        mode = self.get_mode(msg)
+        handler = table.get((msg.content_type, command, mode), None)
+        if handler is None and command is not NO_COMMAND:
+            handler = table.get((msg.content_type, NO_COMMAND, mode), None)
+        return handler
+
+    def dispatch(self, msg) -> None:
+        handler = self.resolve(msg, wrapped=True)
+        if handler is not None:
+            handler(msg)
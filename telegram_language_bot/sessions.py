@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Conversation state shared between worker processes.
+
+    For every user we keep current mode (answering questions or uploading
+words), whether questions are asked as multiple-choice quiz and list of
+pending (asked, but not answered yet) questions. State
+is stored in SQLite database in WAL mode, so any number of processes can
+read it concurrently, and every read-modify-write is performed in
+immediate transaction, so concurrent updates of one user are never lost.
+"""
+
+
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+ANSWER = 'answer'
+UPLOAD = 'upload'
+# mode of unregistered users (never stored)
+GUEST = 'guest'
+
+SCHEMA = """
+    create table if not exists sessions (
+        user_id integer primary key,
+        mode text,
+        pending text,
+        quiz integer not null default 0
+    );
+"""
+
+
+class Session:
+    """State of one user, modifications are saved on transaction commit"""
+
+    def __init__(self, uid: int, mode: str = None, pending: list = None,
+                 quiz: bool = False):
+        self.uid = uid
+        self.mode = mode
+        self.pending = pending if pending is not None else []
+        self.quiz = quiz
+
+    def _row(self):
+        return (self.uid, self.mode,
+                json.dumps(self.pending, ensure_ascii=False), int(self.quiz))
+
+
+class Transaction:
+    """Sessions loaded within one database transaction"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.sessions = {}
+
+    def get(self, uid: int) -> Session:
+        session = self.sessions.get(uid, None)
+        if session is None:
+            session = self.sessions[uid] = _load(self.conn, uid)
+        return session
+
+
+def _load(conn, uid: int) -> Session:
+    row = conn.execute("select mode, pending, quiz from sessions "
+                       "where user_id=?", (uid,)).fetchone()
+    if row is None:
+        return Session(uid)
+    mode, pending, quiz = row
+    return Session(uid, mode, [tuple(p) for p in json.loads(pending)],
+                   bool(quiz))
+
+
+def _migrate(conn) -> None:
+    columns = {row[1] for row in conn.execute("pragma table_info(sessions)")}
+    if 'quiz' not in columns:
+        try:
+            conn.execute("alter table sessions add column "
+                         "quiz integer not null default 0")
+        except sqlite3.OperationalError:    # added by another process
+            pass
+
+
+class SessionStore:
+    """
+    Process and thread safe storage of sessions. Connections are opened
+    lazily, one per thread of each process.
+    """
+
+    def __init__(self, path: str, timeout: float = 30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        pid, conn = getattr(self._local, 'conn', (None, None))
+        # connection must never be shared with forked process
+        if pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=normal")
+            conn.executescript(SCHEMA)
+            _migrate(conn)
+            self._local.conn = (os.getpid(), conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Exclusive (for writers) transaction, all sessions obtained through
+        it are saved on successful exit
+
+        :return: Transaction
+        """
+        conn = self._connection()
+        conn.execute("begin immediate")
+        try:
+            trans = Transaction(conn)
+            yield trans
+            conn.executemany("insert or replace into sessions "
+                             "(user_id, mode, pending, quiz) "
+                             "values (?, ?, ?, ?)",
+                             [s._row() for s in trans.sessions.values()])
+        except BaseException:
+            conn.execute("rollback")
+            raise
+        conn.execute("commit")
+
+    @contextmanager
+    def session(self, uid: int):
+        """
+        Shortcut for transaction with single user session
+
+        :param uid: user id
+        :return: Session
+        """
+        with self.transaction() as trans:
+            yield trans.get(uid)
+
+    def get(self, uid: int) -> Session:
+        """
+        :param uid: user id
+        :return: read-only snapshot of user session
+        """
+        return _load(self._connection(), uid)
+
+    def get_mode(self, uid: int):
+        """
+        :param uid: user id
+        :return: user mode or None, if it was never set
+        """
+        row = self._connection().execute(
+            "select mode from sessions where user_id=?", (uid,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_mode(self, uid: int, mode: str) -> None:
+        with self.session(uid) as session:
+            session.mode = mode
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Multi-tenant runtime: one process hosts several bots (tenants), each with
+its own token, database and conversation state.
+
+    Tenant holds only per-bot state (telegram client, sessions store,
+registered users buffer, flood control), while outbound workers, handler
+threads, database connection pool and dispatcher timer are shared by all
+tenants of process. Handlers find their tenant through context variable,
+which is set by Tenant.run around every call made on tenant's behalf.
+Single-bot mode is the default tenant built from constants.
+
+Tenants are listed in JSON config file:
+
+    {"tenants": [{"name": "english", "token": "...",
+                  "db_path": "english.db",
+                  "sessions_path": "english-sessions.db",
+                  "admin_ids": [123]}, ...]}
+"""
+
+
+import contextvars
+import functools
+import json
+import os
+from threading import Event, RLock
+
+from telegram_language_bot.admission import AdmissionController
+from telegram_language_bot.sessions import SessionStore
+from telegram_language_bot.constants import TOKEN, DB_PATH, SESSIONS_PATH, \
+    ADMIN_IDS, INBOUND_RATE, INBOUND_BURST, INBOUND_CHARS_PER_TOKEN, \
+    INBOUND_COALESCE_WINDOW, INBOUND_MAX_TEXT_LENGTH
+
+
+class TenantConfigError(Exception):
+    pass
+
+
+class Tenant:
+    """State of one hosted bot"""
+
+    __slots__ = ('name', 'token', 'db_path', 'admin_ids', 'sessions',
+                 'registered_users', 'warmed_up', 'admission',
+                 'throttled_users', 'bot', 'lock')
+
+    def __init__(self, name: str, token: str, db_path: str,
+                 sessions_path: str, admin_ids=()):
+        self.name = name
+        self.token = token
+        self.db_path = db_path
+        self.admin_ids = frozenset(admin_ids)
+        # pending questions and answering/uploading mode of each user
+        self.sessions = SessionStore(sessions_path)
+        # cache of registered users (users are never unregistered)
+        self.registered_users = set()
+        # set when all registered users are loaded into buffer
+        self.warmed_up = Event()
+        self.admission = AdmissionController(INBOUND_RATE, INBOUND_BURST,
+                                             INBOUND_CHARS_PER_TOKEN,
+                                             INBOUND_COALESCE_WINDOW,
+                                             INBOUND_MAX_TEXT_LENGTH)
+        # users which were already warned about flooding
+        self.throttled_users = set()
+        # telegram client, created lazily
+        self.bot = None
+        self.lock = RLock()
+
+    def __repr__(self):
+        return 'Tenant({!r})'.format(self.name)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Calls func on behalf of tenant (current_tenant() returns self
+        within the call)
+        """
+        token = _current.set(self)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    def bind(self, func):
+        """
+        :param func: callable
+        :return: callable, which always runs func on behalf of tenant
+                 (i.e. thread target or callback invoked by shared thread)
+        """
+        return functools.partial(self.run, func)
+
+
+default_tenant = Tenant('default', TOKEN, DB_PATH, SESSIONS_PATH, ADMIN_IDS)
+
+_current = contextvars.ContextVar('tenant', default=default_tenant)
+
+
+def current_tenant() -> Tenant:
+    """
+    :return: tenant, on behalf of which current code runs (default tenant
+             outside of Tenant.run)
+    """
+    return _current.get()
+
+
+def load_tenants(path: str) -> list:
+    """
+    :param path: JSON config file
+    :return: [Tenant, ...]
+    :raise TenantConfigError: if config is invalid
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+        entries = config['tenants']
+        tenants = [Tenant(entry['name'], entry['token'], entry['db_path'],
+                          entry['sessions_path'],
+                          entry.get('admin_ids', ()))
+                   for entry in entries]
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        raise TenantConfigError("Invalid tenants config {}: {!r}".format(
+            path, e))
+    if not tenants:
+        raise TenantConfigError("No tenants in {}".format(path))
+    unique = {
+        'name': [tenant.name for tenant in tenants],
+        'token': [tenant.token for tenant in tenants],
+        'sessions_path': [tenant.sessions.path for tenant in tenants],
+        # backups of all tenants are stored in one directory by file name
+        'database file name': [os.path.basename(tenant.db_path)
+                               for tenant in tenants],
+    }
+    for attr, values in unique.items():
+        if len(set(values)) != len(values):
+            raise TenantConfigError("Tenants must have unique "
+                                    "{}".format(attr))
+    return tenants
@@ -4,11 +4,29 @@
 
 import unittest
 
-from .tests import BotTester, UtilsTester
+from .tests import BotTester, UtilsTester, DeliveryTester, OutboundTester, \
+    AdmissionTester, ProfilerTester, SessionsTester, RouterTester, \
+    MessageRouterTester, BroadcastTester, TenantsTester, UpdatesTester
 
 
 def test_bot_front():
-    pass
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(BotTester))
+    suite.addTest(loader.loadTestsFromTestCase(UtilsTester))
+    suite.addTest(loader.loadTestsFromTestCase(DeliveryTester))
+    suite.addTest(loader.loadTestsFromTestCase(OutboundTester))
+    suite.addTest(loader.loadTestsFromTestCase(AdmissionTester))
+    suite.addTest(loader.loadTestsFromTestCase(ProfilerTester))
+    suite.addTest(loader.loadTestsFromTestCase(SessionsTester))
+    suite.addTest(loader.loadTestsFromTestCase(RouterTester))
+    suite.addTest(loader.loadTestsFromTestCase(MessageRouterTester))
+    suite.addTest(loader.loadTestsFromTestCase(BroadcastTester))
+    suite.addTest(loader.loadTestsFromTestCase(TenantsTester))
+    suite.addTest(loader.loadTestsFromTestCase(UpdatesTester))
 
+    test_runner = unittest.TextTestRunner(verbosity=2)
+    test_runner.run(suite)
 
-__all__ = ['test_bot_front']
\ No newline at end of file
+
+__all__ = ['test_bot_front']
@@ -2,14 +2,662 @@
 # -*-encoding: utf-8-*-
 
 
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
+from concurrent.futures import Future
+
+from telegram_language_bot.outbound import OutboundScheduler, INTERACTIVE, \
+    SCHEDULED, BULK
+from telegram_language_bot.utils import TokenBucket, Scheduler, \
+    SchedulerException
+from telegram_language_bot.profiler import SamplingProfiler
+from telegram_language_bot.delivery import merge_questions, \
+    build_questions_message, question_key, REVEAL_PREFIX, \
+    build_quiz_message, parse_quiz_answer
+from telegram_language_bot.admission import AdmissionController, ADMITTED, \
+    THROTTLED, COALESCED, TOO_LARGE
+from telegram_language_bot.sessions import SessionStore, ANSWER, UPLOAD, \
+    GUEST
+from telegram_language_bot.router import Router, extract_command
+from telegram_language_bot.broadcast import run_broadcast, SENT, FAILED
+from language_bot_core import DBManager
+from language_bot_core.memory_backend import MemoryStore
+from telegram_language_bot.workers import UpdateRouter, MESSAGE, FIRES
+from telegram_language_bot.tenants import load_tenants, current_tenant, \
+    default_tenant, TenantConfigError
+from telegram_language_bot.updates import UpdateDeduplicator, \
+    polling_mainloop, OFFSET_KEY
 
 
 class BotTester(unittest.TestCase):
 
-    pass
+    def test_lazy_import(self):
+        script = "import sys, telegram_language_bot; " \
+                 "print('telebot' in sys.modules)"
+        out = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual(out.decode().strip(), 'False')
+
+    def test_handlers_registration(self):
+        from telegram_language_bot import bot as bot_module
+        bot = bot_module.get_bot()
+        self.assertIs(bot, bot_module.get_bot())
+        registered = [h['function'] for h in bot.message_handlers]
+        # all messages are dispatched by router
+        self.assertEqual(registered, [bot_module.message_router.dispatch])
+        routes = bot_module.message_router.routes
+        self.assertIs(routes['text', None, ANSWER], bot_module.answer_handler)
+        self.assertIs(routes['text', None, UPLOAD], bot_module.upload_handler)
+        self.assertNotIn(('text', None, GUEST), routes)
+        self.assertIs(routes['text', 'start', GUEST],
+                      bot_module.start_handler)
+        self.assertIs(routes['document', None, UPLOAD],
+                      bot_module.import_handler)
 
 
 class UtilsTester(unittest.TestCase):
 
-    pass
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1, capacity=2)
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        self.assertGreater(bucket.wait_time(), 0)
+
+    def test_scheduler_presets(self):
+        db = DBManager(':memory:', backend='memory')
+        scheduler = Scheduler(db, 1)
+        scheduler.add_time('12:00:00')
+        scheduler.add_time_from_preset(1, '08:00:00', '22:00:00')
+        rule_id = scheduler.add_time_from_preset(2, '09:00:00', '10:00:00')
+        # preset replaces previous one and is stored as single rule
+        self.assertEqual([rid for rid, _ in scheduler.get_rules()],
+                         [rule_id])
+        self.assertEqual(scheduler.get_rules()[0][1].interval, 3600)
+        self.assertEqual(scheduler.get_schedule(), ['12:00:00'])
+        with self.assertRaises(SchedulerException):
+            scheduler.add_time_from_preset(1, '10:00:00', '09:00:00')
+        with self.assertRaises(SchedulerException):
+            scheduler.add_time_from_preset(0, '08:00:00', '22:00:00')
+        db.disconnect()
+
+
+class DeliveryTester(unittest.TestCase):
+
+    def test_merge_questions(self):
+        pending = [('a', '1'), ('b', '2')]
+        merged = merge_questions(pending, [('b', '2'), ('c', '3')], limit=5)
+        self.assertEqual(merged, [('a', '1'), ('b', '2'), ('c', '3')])
+        merged = merge_questions(pending, [('c', '3'), ('d', '4')], limit=3)
+        self.assertEqual(merged, [('b', '2'), ('c', '3'), ('d', '4')])
+
+    def test_build_questions_message(self):
+        questions = [('a', '1'), ('b', '2')]
+        text, markup = build_questions_message(questions)
+        self.assertIn('1. a', text)
+        self.assertIn('2. b', text)
+        buttons = markup.keyboard[0]
+        self.assertEqual(len(buttons), 2)
+        self.assertEqual(buttons[1]['callback_data'],
+                         REVEAL_PREFIX + question_key(('b', '2')))
+
+    def test_question_key(self):
+        homonyms = [('bank', 'берег'), ('bank', 'банк')]
+        self.assertNotEqual(question_key(homonyms[0]),
+                            question_key(homonyms[1]))
+        self.assertEqual(question_key(homonyms[0]),
+                         question_key(('bank', 'берег')))
+        text, markup = build_quiz_message(homonyms[0], homonyms)
+        right, wrong = [parse_quiz_answer(row[0]['callback_data'])
+                        for row in markup.keyboard]
+        self.assertNotEqual(*wrong)
+        self.assertEqual(*right)
+        self.assertLessEqual(
+            max(len(row[0]['callback_data'].encode('utf-8'))
+                for row in markup.keyboard), 64)
+
+    def test_build_quiz_message(self):
+        text, markup = build_quiz_message(('a', '1'), [('b', '2'), ('a', '1')])
+        self.assertIn('a', text)
+        self.assertEqual([row[0]['text'] for row in markup.keyboard],
+                         ['2', '1'])
+        wrong, right = [parse_quiz_answer(row[0]['callback_data'])
+                        for row in markup.keyboard]
+        self.assertEqual(right, (question_key(('a', '1')), ) * 2)
+        self.assertEqual(wrong, (question_key(('a', '1')),
+                                 question_key(('b', '2'))))
+
+
+class OutboundTester(unittest.TestCase):
+
+    lanes = ((INTERACTIVE, 1000, 1000),
+             (SCHEDULED, 1000, 1000),
+             (BULK, 1000, 1000))
+
+    def test_lanes_priority(self):
+        sent = []
+        outbound = OutboundScheduler(lambda uid, text: sent.append(text),
+                                     self.lanes, global_rate=1000)
+        outbound.submit(BULK, 1, 'bulk')
+        for i in range(3):
+            outbound.submit(SCHEDULED, 1, 'scheduled')
+        outbound.submit(INTERACTIVE, 1, 'interactive')
+        while outbound.process_one(timeout=0):
+            pass
+        self.assertEqual(sent, ['interactive'] + ['scheduled'] * 3 + ['bulk'])
+        metrics = outbound.metrics()
+        self.assertEqual(metrics[SCHEDULED]['sent'], 3)
+        self.assertEqual(metrics[SCHEDULED]['max_depth'], 3)
+        self.assertEqual(metrics[BULK]['depth'], 0)
+
+    def test_lane_quota(self):
+        sent = []
+        lanes = ((INTERACTIVE, 1000, 1000), (SCHEDULED, 1, 1))
+        outbound = OutboundScheduler(lambda uid, text: sent.append(text),
+                                     lanes, global_rate=1000)
+        outbound.submit(SCHEDULED, 1, 'scheduled')
+        outbound.submit(SCHEDULED, 1, 'scheduled')
+        outbound.process_one(timeout=0)
+        # scheduled lane has exhausted its quota, interactive must not wait
+        outbound.submit(INTERACTIVE, 1, 'interactive')
+        start = time.monotonic()
+        outbound.process_one(timeout=0.5)
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(sent, ['scheduled', 'interactive'])
+        self.assertEqual(outbound.metrics()[SCHEDULED]['depth'], 1)
+
+    def test_retry_after(self):
+        limited = Exception('Too Many Requests')
+        limited.result = types.SimpleNamespace(
+            status_code=429,
+            json=lambda: {'parameters': {'retry_after': 0.1}})
+        errors = [limited, None, ValueError('bad request'), limited, limited]
+        sent = []
+
+        def send(uid, text):
+            error = errors.pop(0)
+            if error is not None:
+                raise error
+            sent.append(text)
+
+        outbound = OutboundScheduler(send, self.lanes, global_rate=1000,
+                                     max_attempts=2)
+        outbound.submit(SCHEDULED, 1, 'limited')
+        with self.assertLogs('language_bot.outbound', logging.WARNING):
+            outbound.process_one(timeout=0)
+        # requeued to head of lane, nothing is sent until retry_after passes
+        outbound.submit(SCHEDULED, 1, 'next')
+        self.assertFalse(outbound.process_one(timeout=0))
+        start = time.monotonic()
+        outbound.process_one(timeout=1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual(sent, ['limited'])
+        # other errors are not retried, 429 is retried max_attempts times
+        outbound.submit(BULK, 1, 'bulk')
+        with self.assertLogs('language_bot.outbound', logging.WARNING):
+            for i in range(3):
+                outbound.process_one(timeout=1)
+        metrics = outbound.metrics()
+        self.assertEqual(metrics[SCHEDULED]['sent'], 1)
+        self.assertEqual(metrics[SCHEDULED]['failed'], 1)
+        self.assertEqual(metrics[BULK]['failed'], 1)
+        self.assertEqual(metrics[BULK]['depth'], 0)
+
+    def test_channels(self):
+        limited = Exception('Too Many Requests')
+        limited.result = types.SimpleNamespace(
+            status_code=429,
+            json=lambda: {'parameters': {'retry_after': 10}})
+        sent = []
+
+        def send(token, text):
+            if token == 'a' and not sent:
+                raise limited
+            sent.append(text)
+
+        key = threading.local()
+        lanes = ((INTERACTIVE, 1000, 1000),)
+        outbound = OutboundScheduler(send, lanes, global_rate=1,
+                                     channel_key=lambda: key.token)
+        for token in ('a', 'a', 'b'):
+            key.token = token
+            outbound.submit(INTERACTIVE, token, token)
+        with self.assertLogs('language_bot.outbound', logging.WARNING):
+            outbound.process_one(timeout=0)
+        # channel paused by telegram and channel with exhausted global
+        # rate do not delay each other
+        self.assertTrue(outbound.process_one(timeout=0))
+        self.assertFalse(outbound.process_one(timeout=0))
+        self.assertEqual(sent, ['b'])
+        self.assertEqual(outbound.metrics('a')[INTERACTIVE]['depth'], 2)
+        self.assertEqual(outbound.metrics('b')[INTERACTIVE]['sent'], 1)
+
+
+class AdmissionTester(unittest.TestCase):
+
+    def setUp(self):
+        self.admission = AdmissionController(rate=0.001, burst=3,
+                                             chars_per_token=100,
+                                             coalesce_window=60,
+                                             max_text_length=200)
+
+    def test_coalescing(self):
+        self.assertEqual(self.admission.check(1, '/next_word'), ADMITTED)
+        self.assertEqual(self.admission.check(1, '/next_word'), COALESCED)
+        self.assertEqual(self.admission.check(2, '/next_word'), ADMITTED)
+        self.assertEqual(self.admission.check(1, '/reveal_last'), ADMITTED)
+
+    def test_throttling(self):
+        for i in range(3):
+            self.assertEqual(self.admission.check(1, 'answer'), ADMITTED)
+        self.assertEqual(self.admission.check(1, 'answer'), THROTTLED)
+        self.assertEqual(self.admission.check(2, 'answer'), ADMITTED)
+        # long texts cost more tokens
+        self.assertEqual(self.admission.check(3, 'a' * 200), ADMITTED)
+        self.assertEqual(self.admission.check(3, 'answer'), THROTTLED)
+
+    def test_too_large(self):
+        self.assertEqual(self.admission.check(1, 'a' * 201), TOO_LARGE)
+        self.assertEqual(self.admission.rejected[TOO_LARGE], 1)
+        # oversized messages are charged as well
+        self.assertEqual(self.admission.check(1, 'a' * 201), THROTTLED)
+
+    def test_callback_queries(self):
+        from telegram_language_bot.client import AdmittingTeleBot
+        bot = AdmittingTeleBot('1:token', self.admission, None,
+                               threaded=False)
+        handled = []
+        bot.callback_query_handler(func=lambda call: True)(handled.append)
+        chat = types.SimpleNamespace(id=1)
+        call = types.SimpleNamespace(from_user=types.SimpleNamespace(id=2),
+                                     message=types.SimpleNamespace(chat=chat),
+                                     data='reveal:key')
+        bot.process_new_callback_query([call] * 5)
+        self.assertEqual(len(handled), 3)
+        self.assertEqual(self.admission.check(1, 'answer'), THROTTLED)
+
+
+class ProfilerTester(unittest.TestCase):
+
+    @staticmethod
+    def _busy_loop(stop):
+        while not stop.is_set():
+            sum(range(1000))
+
+    def test_profiler(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=self._busy_loop, args=(stop,),
+                                  name='BusyWorker')
+        worker.start()
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        time.sleep(0.2)
+        profiler.stop()
+        stop.set()
+        worker.join()
+        self.assertFalse(profiler.running)
+        self.assertGreater(profiler.samples, 0)
+        self.assertTrue(any(stack.startswith('BusyWorker;')
+                            for stack in profiler.stacks))
+        top_functions = [func for func, _, _ in profiler.top(5)]
+        self.assertTrue(any('_busy_loop' in func for func in top_functions))
+
+        directory = tempfile.mkdtemp()
+        try:
+            collapsed, top = profiler.dump(directory, 5)
+            with open(collapsed, encoding='utf-8') as f:
+                line = f.readline()
+            self.assertRegex(line, r'^\S.* \d+$')
+            self.assertTrue(os.path.exists(top))
+        finally:
+            shutil.rmtree(directory)
+
+
+def _append_pending(path, worker, count):
+    store = SessionStore(path)
+    for i in range(count):
+        with store.session(1) as session:
+            session.pending.append((str(worker), str(i)))
+
+
+class SessionsTester(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sessions.db')
+        self.store = SessionStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_session(self):
+        self.assertIsNone(self.store.get_mode(1))
+        self.store.set_mode(1, UPLOAD)
+        with self.store.session(1) as session:
+            session.pending.append(('aptly', 'метко'))
+        with self.assertRaises(ValueError):
+            with self.store.session(1) as session:
+                session.pending = []
+                raise ValueError
+        other = SessionStore(self.path).get(1)
+        self.assertEqual(other.mode, UPLOAD)
+        self.assertEqual(other.pending, [('aptly', 'метко')])
+        self.assertFalse(other.quiz)
+
+    def test_quiz_column_migration(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("create table sessions (user_id integer primary key, "
+                     "mode text, pending text)")
+        conn.execute("insert into sessions values (1, 'answer', '[]')")
+        conn.commit()
+        conn.close()
+        self.assertFalse(self.store.get(1).quiz)
+        with self.store.session(1) as session:
+            session.quiz = True
+        self.assertTrue(self.store.get(1).quiz)
+        self.assertEqual(self.store.get_mode(1), ANSWER)
+
+    def test_concurrent_processes(self):
+        processes = [multiprocessing.Process(target=_append_pending,
+                                             args=(self.path, i, 25))
+                     for i in range(4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual(len(self.store.get(1).pending), 100)
+
+
+class RouterTester(unittest.TestCase):
+
+    def test_routing(self):
+        router = UpdateRouter(3, target=None)
+        handled = router.route(4, MESSAGE, 'update')
+        router.route_fires({1: 1, 4: 2, 2: 1})
+        kind, payload, ticket = router.queues[1].get(timeout=1)
+        self.assertEqual((kind, payload), (MESSAGE, 'update'))
+        self.assertEqual(router.queues[1].get(timeout=1),
+                         (FIRES, {1: 1, 4: 2}, None))
+        self.assertEqual(router.queues[2].get(timeout=1),
+                         (FIRES, {2: 1}, None))
+        self.assertTrue(router.queues[0].empty())
+        # worker acknowledges handled update
+        router._collector = threading.Thread(target=router._collect_acks)
+        router._collector.start()
+        self.assertFalse(handled.done())
+        router.acks.put(ticket)
+        handled.result(timeout=1)
+        router.acks.put(None)
+        router._collector.join()
+
+
+class MessageRouterTester(unittest.TestCase):
+
+    @staticmethod
+    def message(text, mode=ANSWER, content_type='text'):
+        return types.SimpleNamespace(text=text, mode=mode,
+                                     content_type=content_type)
+
+    def test_extract_command(self):
+        self.assertEqual(extract_command('/find word'), 'find')
+        self.assertEqual(extract_command('/find@some_bot word'), 'find')
+        self.assertIsNone(extract_command('word /find'))
+        self.assertIsNone(extract_command(None))
+
+    def test_routing(self):
+        calls = []
+        router = Router(lambda msg: msg.mode)
+        router.use(lambda handler: lambda msg: calls.append('outer') or
+                   handler(msg))
+        router.route([ANSWER, UPLOAD], commands=['info'])(
+            lambda msg: calls.append('info'))
+        router.route([ANSWER])(lambda msg: calls.append('answer'))
+        router.route([UPLOAD])(lambda msg: calls.append('upload'))
+        router.use(lambda handler: lambda msg: calls.append('inner') or
+                   handler(msg))
+        router.dispatch(self.message('/info', UPLOAD))
+        router.dispatch(self.message('/unknown', UPLOAD))
+        router.dispatch(self.message('word'))
+        router.dispatch(self.message('word', GUEST))
+        router.dispatch(self.message(None, content_type='photo'))
+        self.assertEqual(calls, ['outer', 'inner', 'info',
+                                 'outer', 'inner', 'upload',
+                                 'outer', 'inner', 'answer'])
+        with self.assertRaises(ValueError):
+            router.add(len, [ANSWER])
+        self.assertEqual(router.content_types, ['text'])
+
+
+class BroadcastTester(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'bot.json')
+
+    def tearDown(self):
+        MemoryStore._stores.clear()
+        shutil.rmtree(self.dir)
+
+    def test_resumable_broadcast(self):
+        db = DBManager(self.path, backend='memory')
+        db.connect()
+        for uid in range(10, 0, -1):
+            db.register(uid)
+        self.assertEqual(db.get_uids_after(None, 3), [1, 2, 3])
+        self.assertEqual(db.get_uids_after(9, 3), [10])
+        broadcast_id = db.create_broadcast('news')
+        db.disconnect()
+        sent = []
+
+        def send(uid, text, crash_at=None):
+            if uid == crash_at:
+                raise SystemExit    # process is killed
+            if uid == 3:
+                raise ValueError('blocked by user')
+            sent.append((uid, text))
+
+        def submit(func, *args):
+            try:
+                func(*args)
+            except ValueError:
+                pass
+
+        with self.assertRaises(SystemExit):
+            run_broadcast(db, broadcast_id, submit,
+                          lambda uid, text: send(uid, text, crash_at=8), 3)
+        # connection is not held between chunks
+        db.connect()
+        self.assertEqual(db.get_broadcast(broadcast_id)['cursor'], 6)
+        self.assertEqual(db.get_unfinished_broadcasts(), [broadcast_id])
+        db.disconnect()
+        del sent[:]
+        stats = run_broadcast(db, broadcast_id, submit, send, 3)
+        self.assertEqual([uid for uid, _ in sent], [7, 8, 9, 10])
+        self.assertEqual(stats, {SENT: 9, FAILED: 1})
+        db.connect()
+        self.assertEqual(db.get_unfinished_broadcasts(), [])
+        db.disconnect()
+
+    def test_lost_deliveries(self):
+        db = DBManager(self.path, backend='memory')
+        db.connect()
+        for uid in (1, 2, 3):
+            db.register(uid)
+        broadcast_id = db.create_broadcast('news')
+        db.disconnect()
+
+        def submit(func, *args):
+            if args[-1] != 2:   # dropped by outbound
+                func(*args)
+
+        stats = run_broadcast(db, broadcast_id, submit,
+                              lambda uid, text: None, 2, timeout=0.1)
+        self.assertEqual(stats, {SENT: 2, FAILED: 1})
+
+
+class TenantsTester(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = os.path.join(self.dir, 'tenants.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_config(self, *names):
+        tenants = [{'name': name, 'token': 'token-' + name,
+                    'db_path': os.path.join(self.dir, name + '.db'),
+                    'sessions_path': os.path.join(self.dir,
+                                                  name + '-sessions.db'),
+                    'admin_ids': [1]}
+                   for name in names]
+        with open(self.config, 'w') as f:
+            json.dump({'tenants': tenants}, f)
+
+    def test_load_tenants(self):
+        self.write_config('en', 'de')
+        en, de = load_tenants(self.config)
+        self.assertEqual((en.name, en.token), ('en', 'token-en'))
+        self.assertIn(1, de.admin_ids)
+        self.write_config('en', 'en')
+        with self.assertRaises(TenantConfigError):
+            load_tenants(self.config)
+        with open(self.config, 'w') as f:
+            f.write('{"tenants": [{"name": "en"}]}')
+        with self.assertRaises(TenantConfigError):
+            load_tenants(self.config)
+
+    def test_current_tenant(self):
+        from telegram_language_bot import bot as bot_module
+        self.write_config('en', 'de')
+        en, de = load_tenants(self.config)
+        self.assertIs(current_tenant(), default_tenant)
+        self.assertIs(en.run(current_tenant), en)
+        seen = []
+        thread = threading.Thread(
+            target=de.bind(lambda: seen.append(current_tenant())))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [de])
+        self.assertIs(current_tenant(), default_tenant)
+        # handlers see state of their own tenant
+        msg = types.SimpleNamespace(chat=types.SimpleNamespace(id=1))
+        self.assertTrue(en.run(bot_module.is_admin, msg))
+        self.assertFalse(bot_module.is_admin(msg))
+        # handlers of tenant bot are run by shared executor
+        calls = []
+        bot = en.run(bot_module.get_bot,
+                     executor=lambda task, *args: calls.append(task))
+        self.assertIs(en.bot, bot)
+        self.assertEqual(bot.token, 'token-en')
+        bot._exec_task(len, 'x')
+        self.assertEqual(calls, [len])
+
+
+class FakePollingBot:
+    """
+    Returns scripted batches of update ids, stops polling at the end.
+    Handlers finish at once, or, if `release` is given, handlers of updates
+    listed in its i-th item finish on i-th request
+    """
+
+    def __init__(self, batches, stop, release=None):
+        self.batches = list(batches)
+        self.stop = stop
+        self.release = release
+        self.offsets = []
+        self.processed = []
+        self.handled = []
+        self.path = None
+        self.futures = {}
+        self.pending = []
+
+    def get_updates(self, offset, timeout):
+        self.offsets.append(offset)
+        if self.path is not None:
+            db = DBManager(self.path)
+            db.connect()
+            self.handled.append(db.get_meta(OFFSET_KEY))
+            db.disconnect()
+        if self.release:
+            for update_id in self.release.pop(0):
+                self.futures[update_id].set_result(None)
+        if not self.batches:
+            self.stop.set()
+            return []
+        batch = self.batches.pop(0)
+        if isinstance(batch, Exception):
+            raise batch
+        return [types.SimpleNamespace(update_id=i) for i in batch]
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            self.processed.append(update.update_id)
+            future = self.futures[update.update_id] = Future()
+            if self.release is None:
+                future.set_result(None)
+            self.pending.append(future)
+
+    def take_pending(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+
+class UpdatesTester(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'bot.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_deduplicator(self):
+        dedupe = UpdateDeduplicator(3)
+        self.assertEqual([dedupe.add(i) for i in (1, 2, 3, 2, 5, 4, 1)],
+                         [True, True, True, False, True, True, False])
+        self.assertEqual(dedupe.high_water, 5)
+        # everything up to persisted mark is handled before restart
+        dedupe = UpdateDeduplicator(3, high_water=5)
+        self.assertEqual([dedupe.add(i) for i in (4, 5, 6, 6)],
+                         [False, False, True, False])
+
+    def test_resumed_polling(self):
+        stop = threading.Event()
+        # response of the second request is lost, so it is repeated
+        bot = FakePollingBot([[1, 2], ConnectionError(), [3], [3, 4]], stop)
+        bot.path = self.path
+        with self.assertLogs('language_bot.updates', logging.WARNING):
+            polling_mainloop(bot, self.path, stop=stop)
+        self.assertEqual(bot.processed, [1, 2, 3, 4])
+        self.assertEqual(bot.offsets, [1, 3, 3, 4, 5])
+        self.assertEqual(bot.handled, [None, '2', '2', '3', '4'])
+        # restart: telegram sends unconfirmed update again
+        stop.clear()
+        bot = FakePollingBot([[4, 5]], stop)
+        with self.assertLogs('language_bot.updates', logging.WARNING):
+            polling_mainloop(bot, self.path, stop=stop)
+        self.assertEqual(bot.processed, [5])
+        self.assertEqual(bot.offsets, [5, 6])
+
+    def test_polling_with_slow_handlers(self):
+        stop = threading.Event()
+        # updates being handled are requested again, up to replay limit
+        bot = FakePollingBot([[1, 2], [2, 3], [3, 4], [5]], stop,
+                             release=[[], [], [1, 2], [3, 4], []])
+        bot.path = self.path
+        polling_mainloop(bot, self.path, replay=1, stop=stop)
+        self.assertEqual(bot.processed, [1, 2, 3, 4, 5])
+        self.assertEqual(bot.offsets, [1, 2, 3, 4, 5])
+        # offset is saved once all updates up to it are handled
+        self.assertEqual(bot.handled, [None, None, None, '2', '4'])
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Idempotent updates polling.
+
+    Every update is checked against deduplication window before it is
+routed to handlers: ids of recently accepted updates are kept in ring
+buffer, ids below the window (or below the mark loaded on startup) are
+rejected. Polling does not wait for handlers: completion of every batch
+(in handler threads or worker processes) is tracked, and the highest id
+up to which all updates are handled is persisted in bot database as soon
+as it advances. Polling is resumed from it on startup, so updates handled
+before restart are not handled again, and updates received while bot was
+down are not skipped. Updates still being handled are not confirmed to
+telegram (up to a limit): they are requested again and dropped by the
+window, so telegram keeps them if process dies before they are handled.
+"""
+
+
+import logging
+import time
+from collections import deque
+from threading import Condition, Event
+
+from language_bot_core import DBManager
+from language_bot_core.logs import get_logger, log_event
+from telegram_language_bot.constants import UPDATES_TIMEOUT, \
+    UPDATES_DEDUPE_WINDOW, UPDATES_REPLAY_LIMIT, UPDATES_REPLAY_WAIT
+
+
+logger = get_logger('updates')
+
+# log event category
+POLLING = 'polling'
+
+# meta key of the highest id of accepted update
+OFFSET_KEY = 'update_offset'
+
+
+class UpdateDeduplicator:
+    """Sliding window of accepted update ids"""
+
+    def __init__(self, window: int, high_water: int = 0):
+        """
+        :param window: number of recent ids remembered
+        :param high_water: highest id accepted before restart, all updates
+                           up to it are treated as handled
+        """
+        self.window = window
+        self.high_water = high_water
+        self._floor = high_water
+        self._ring = deque(maxlen=window)
+        self._ids = set()
+
+    def __contains__(self, update_id):
+        return update_id in self._ids or \
+            update_id <= max(self._floor, self.high_water - self.window)
+
+    def add(self, update_id: int) -> bool:
+        """
+        :param update_id: id of received update
+        :return: True if update is new (and is accepted now), False if it
+                 is a duplicate
+        """
+        if update_id in self:
+            return False
+        if len(self._ring) == self.window:
+            self._ids.discard(self._ring[0])
+        self._ring.append(update_id)
+        self._ids.add(update_id)
+        self.high_water = max(self.high_water, update_id)
+        return True
+
+
+class HandledTracker:
+    """Highest update id up to which all routed batches are handled"""
+
+    def __init__(self, offset: int = 0):
+        """
+        :param offset: id up to which updates are handled before restart
+        """
+        self.offset = offset
+        # [highest update id, number of unfinished handlers] of batches
+        self._batches = deque()
+        self._changed = Condition()
+
+    def add(self, last_id: int, futures: list) -> None:
+        """
+        :param last_id: highest id of update in routed batch
+        :param futures: futures of handlers of the batch
+        """
+        batch = [last_id, len(futures)]
+        with self._changed:
+            self._batches.append(batch)
+            self._advance()
+        for future in futures:
+            future.add_done_callback(lambda _: self._done(batch))
+
+    def _done(self, batch):
+        with self._changed:
+            batch[1] -= 1
+            self._advance()
+
+    def _advance(self):
+        while self._batches and self._batches[0][1] == 0:
+            self.offset = self._batches.popleft()[0]
+            self._changed.notify_all()
+
+    def wait(self, timeout: float) -> None:
+        """Blocks until offset advances or timeout expires"""
+        with self._changed:
+            self._changed.wait(timeout)
+
+
+def _load_offset(db: DBManager) -> int:
+    db.connect()
+    offset = db.get_meta(OFFSET_KEY)
+    db.disconnect()
+    return 0 if offset is None else int(offset)
+
+
+def _save_offset(db: DBManager, offset: int):
+    db.connect()
+    db.set_meta(OFFSET_KEY, str(offset))
+    db.disconnect()
+
+
+def polling_mainloop(bot, path: str, timeout: int = UPDATES_TIMEOUT,
+                     window: int = UPDATES_DEDUPE_WINDOW,
+                     replay: int = UPDATES_REPLAY_LIMIT,
+                     stop: Event = None):
+    """
+    Long polling of updates, intended to be target of Thread (replaces
+    bot.polling, which keeps offset only in memory)
+
+    :param bot: AdmittingTeleBot instance (or anything with get_updates,
+                process_new_updates and take_pending methods)
+    :param path: bot database path, offset is stored in its meta table
+    :param timeout: long polling timeout (seconds)
+    :param window: size of deduplication window
+    :param replay: max number of updates being handled that are requested
+                   again
+    :param stop: polling is stopped once event is set
+    :return:
+    """
+    stop = stop or Event()
+    db = DBManager(path)
+    saved = _load_offset(db)
+    dedupe = UpdateDeduplicator(window, saved)
+    handled = HandledTracker(saved)
+    error_interval = 0.25
+    while not stop.is_set():
+        offset = max(handled.offset, dedupe.high_water - replay)
+        try:
+            updates = bot.get_updates(offset=offset + 1, timeout=timeout)
+        except Exception as e:  # network and API errors are retried
+            log_event(logger, POLLING, logging.WARNING, error=repr(e),
+                      retry_in=error_interval)
+            stop.wait(error_interval)
+            error_interval = min(error_interval * 2, 60)
+            continue
+        error_interval = 0.25
+        fresh = [update for update in updates if dedupe.add(update.update_id)]
+        # updates still being handled are expected to be sent again
+        duplicates = sum(1 for update in updates
+                         if update.update_id <= handled.offset)
+        if duplicates:
+            log_event(logger, POLLING, logging.WARNING, duplicates=duplicates)
+        if fresh:
+            started = time.perf_counter()
+            bot.process_new_updates(fresh)
+            handled.add(max(update.update_id for update in fresh),
+                        bot.take_pending())
+            log_event(logger, POLLING, updates=len(fresh),
+                      offset=dedupe.high_water,
+                      duration_ms=round(
+                          (time.perf_counter() - started) * 1000, 3))
+        elif updates:
+            handled.wait(UPDATES_REPLAY_WAIT)
+        if handled.offset > saved:
+            saved = handled.offset
+            _save_offset(db, saved)
+    if handled.offset > saved:
+        _save_offset(db, handled.offset)
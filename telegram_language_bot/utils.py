@@ -4,7 +4,9 @@
 
 from threading import RLock
 from language_bot_core import DBManager
+from language_bot_core.schedule import make_rule, ScheduleRuleError
 import datetime
+import time as _time
 
 
 class SchedulerException(Exception):
@@ -68,6 +70,50 @@ class ThreadedDict:
         return self._wrap(cur)
 
 
+class TokenBucket:
+    """
+    Token bucket rate limiter: holds up to `capacity` tokens, refilled
+    with `rate` tokens per second
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = _time.monotonic()
+        self.lock = RLock()
+
+    def _refill(self):
+        now = _time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def consume(self, amount: float = 1) -> bool:
+        """
+        Takes `amount` tokens if available
+
+        :param amount: tokens required
+        :return: True if tokens were taken
+        """
+        with self.lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return True
+            return False
+
+    def wait_time(self, amount: float = 1) -> float:
+        """
+        :param amount: tokens required
+        :return: seconds until `amount` tokens are available
+        """
+        with self.lock:
+            self._refill()
+            if self.tokens >= amount:
+                return 0
+            return (amount - self.tokens) / self.rate
+
+
 class ArithmeticTime(datetime.time):
     """time class intended to support arithmetic operations and to
     utilize already implemented datetime.time class functionality
@@ -173,81 +219,41 @@ class SchedulerBase:
 
 class Scheduler(SchedulerBase):
 
-    allowed_preset_types = (1, 2, 3)
+    # preset type: interval (minutes)
+    preset_intervals = {
+        1: 30,      # every half an hour
+        2: 60,      # every hour
+        3: 120,     # every two hours
+    }
 
     def add_time_from_preset(self, preset_type, min_time_str, max_time_str):
         """
-        Rebuilds user time schedule according to given preset type and time
-        range.
+        Replaces user's periodic schedule with rule of given preset type in
+        given time range (one-off times are kept). Preset is stored as one
+        rule, not expanded into times.
 
         :param preset_type: preset_types = {
-                                0: 'Every half an hour',
-                                1: 'Every hour',
-                                2: 'Every two hours',
+                                1: 'Every half an hour',
+                                2: 'Every hour',
+                                3: 'Every two hours',
                             }
-        :param min_time_str:
-        :param max_time_str:
-        :return:
+        :param min_time_str: first fire 'hh:mm:ss'
+        :param max_time_str: last possible fire 'hh:mm:ss'
+        :return: id of added rule
         """
-        self.clear_schedule()
-        if preset_type not in self.allowed_preset_types:
+        if preset_type not in self.preset_intervals:
             raise SchedulerException('Incorrect preset type.')
-        else:
-            attr_name = "_handle_type{}_preset".format(preset_type)
-            schedule_gen_method = getattr(self, attr_name, lambda *x: None)
-            schedule = schedule_gen_method(min_time_str, max_time_str)
-            if schedule is None:
-                raise SchedulerPresetTypeHelperError('An error occurred while'
-                                                     'handling preset type')
-        self.clear_schedule()
-        self.add_times(schedule)
-
-    def _handle_type1_preset(self, min_time_str, max_time_str) -> list:
-        """
-        Build type one (one msg per half an hour) time schedule preset
-        in given time range
-
-        :param min_time_str:
-        :param max_time_str:
-        :return:
-        """
-        delta_time_str = "00:30:00"
-        return self.base_preset_handler(min_time_str,
-                                        max_time_str,
-                                        delta_time_str)
-
-    def _handle_type2_preset(self, min_time_str, max_time_str) -> list:
-        """
-        Build type two (one msg per hour) time schedule preset
-        in given time range
-
-        :param min_time_str:
-        :param max_time_str:
-        :return:
-        """
-        delta_time_str = "01:00:00"
-        return self.base_preset_handler(min_time_str,
-                                        max_time_str,
-                                        delta_time_str)
-
-    def _handle_type3_preset(self, min_time_str, max_time_str) -> list:
-        """
-        Build type one (one msg per two hours) time schedule preset
-        in given time range
-
-        :param min_time_str:
-        :param max_time_str:
-        :return:
-        """
-        delta_time_str = "02:00:00"
-        return self.base_preset_handler(min_time_str,
-                                        max_time_str,
-                                        delta_time_str)
-
-    def base_preset_handler(self, min_time_str, max_time_str, delta_time_str):
-        start = time.fromisoformat(min_time_str)
-        stop = time.fromisoformat(max_time_str)
-        delta = time.fromisoformat(delta_time_str)
-        return [(start + i * delta).isoformat() for i in range((start - stop)/delta)]
-
-
+        try:
+            rule = make_rule(min_time_str, max_time_str,
+                             self.preset_intervals[preset_type])
+        except ScheduleRuleError as e:
+            raise SchedulerPresetTypeHelperError(str(e))
+        self.clear_rules()
+        return self.db_manager.add_schedule_rule(self.uid, rule)
+
+    def clear_rules(self):
+        for rule_id, _ in self.get_rules():
+            self.db_manager.delete_schedule_rule(self.uid, rule_id)
+
+    def get_rules(self):
+        return self.db_manager.get_schedule_rules_by_uid(self.uid)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+
+
+"""
+Multi-process updates handling.
+
+    Polling process receives updates and routes them to worker processes
+by chat id, so all updates of one user are handled by the same worker (in
+order of arrival), while different users are handled in parallel on all
+CPU cores. Conversation state is kept in shared SessionStore.
+"""
+
+
+import itertools
+import multiprocessing
+from concurrent.futures import Future
+from threading import Lock, Thread
+
+
+# kinds of routed items
+MESSAGE = 'message'
+CALLBACK_QUERY = 'callback_query'
+# scheduled words dispatch, payload is {uid: number of words}
+FIRES = 'fires'
+# payload is list of users, whose cached vocabulary is outdated
+INVALIDATE = 'invalidate'
+
+
+class UpdateRouter:
+    """
+    Starts `workers` processes running target(index, queue, acks) and
+    routes items to them. Each queue item is (kind, payload, ticket)
+    tuple, None means that worker has to stop. Once item with ticket is
+    handled, worker puts its ticket into acks queue, and future returned
+    by route is resolved.
+    """
+
+    def __init__(self, workers: int, target):
+        self.queues = [multiprocessing.Queue() for _ in range(workers)]
+        self.acks = multiprocessing.Queue()
+        self.processes = [
+            multiprocessing.Process(target=target, args=(i, q, self.acks),
+                                    name='UpdateWorker{}'.format(i),
+                                    daemon=True)
+            for i, q in enumerate(self.queues)]
+        # ticket: future of routed update
+        self._pending = {}
+        self._tickets = itertools.count()
+        self._lock = Lock()
+        self._collector = None
+
+    def __len__(self):
+        return len(self.queues)
+
+    def worker_index(self, chat_id: int) -> int:
+        return chat_id % len(self.queues)
+
+    def route(self, chat_id: int, kind: str, payload) -> Future:
+        """
+        :return: future resolved once worker has handled the update
+        """
+        future = Future()
+        with self._lock:
+            ticket = next(self._tickets)
+            self._pending[ticket] = future
+        self.queues[self.worker_index(chat_id)].put((kind, payload, ticket))
+        return future
+
+    def _collect_acks(self):
+        while True:
+            ticket = self.acks.get()
+            if ticket is None:
+                break
+            with self._lock:
+                future = self._pending.pop(ticket, None)
+            if future is not None:
+                future.set_result(None)
+
+    def route_fires(self, counts: dict) -> None:
+        """
+        Splits scheduled fires between workers, which own users
+
+        :param counts: dict({uid: number of words})
+        :return: None
+        """
+        parts = {}
+        for uid, count in counts.items():
+            parts.setdefault(self.worker_index(uid), {})[uid] = count
+        for index, part in parts.items():
+            self.queues[index].put((FIRES, part, None))
+
+    def route_invalidations(self, uids) -> None:
+        parts = {}
+        for uid in uids:
+            parts.setdefault(self.worker_index(uid), []).append(uid)
+        for index, part in parts.items():
+            self.queues[index].put((INVALIDATE, part, None))
+
+    def start(self) -> None:
+        for p in self.processes:
+            p.start()
+        self._collector = Thread(target=self._collect_acks, name='Acks',
+                                 daemon=True)
+        self._collector.start()
+
+    def stop(self) -> None:
+        for q in self.queues:
+            q.put(None)
+        for p in self.processes:
+            p.join()
+        self.acks.put(None)
+        self._collector.join()